@@ -0,0 +1,110 @@
+"""Hot/cold tiering: completed tasks created more than `task_archive_after_days` ago move from tasks
+to tasks_archive, which only carries the index behind listing an owner's tasks.
+
+GET /tasks leaves archived tasks out unless asked for them with include_archived. Everything
+addressing a task by id still finds it: GET and DELETE /tasks/{id} as is, while marking it undone
+or editing it moves it back into tasks. Tasks keep their id both ways, and keep counting in
+GET /tasks/stats (see counters.py).
+
+With `task_archive_enabled` every worker archives what is due each `task_archive_interval_seconds`,
+`task_archive_batch_size` tasks per transaction so no lock is held long. On PostgreSQL tasks a
+writer holds are skipped until the next pass. ``python -m app.archive`` archives everything due
+once, to run it from cron instead.
+"""
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete, insert, select
+from sqlalchemy.orm import Session
+from . import database, events, models, versions
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+def archive_rows(connection, condition):
+    """Moves the tasks matching `condition` to tasks_archive in the connection's transaction. Returns their (id, owner id)."""
+    tasks = models.Task.__table__
+    rows = connection.execute(delete(tasks).where(condition).returning(*tasks.c)).all()
+    if rows:
+        connection.execute(insert(models.TaskArchive.__table__), [dict(row._mapping) for row in rows])
+    return [(row.id, row.owner_id) for row in rows]
+
+def due(cutoff: datetime, batch_size: int, dialect: str):
+    """The condition matching the next batch of completed tasks created before `cutoff`."""
+    tasks = models.Task.__table__
+    batch = select(tasks.c.id).where(tasks.c.done, tasks.c.created_at < cutoff).order_by(tasks.c.id).limit(batch_size)
+    if dialect == "postgresql":
+        # tasks being written are left for the next pass instead of waited for
+        batch = batch.with_for_update(skip_locked=True)
+    return tasks.c.id.in_(batch)
+
+class Archiver:
+    def __init__(self, after_days: float, interval_seconds: float, batch_size: int):
+        self.after_days = after_days
+        self.interval_seconds = interval_seconds
+        self.batch_size = batch_size
+        # the databases holding tasks, the first one keeping versions. Tests point this at their own database
+        self.engines = database.shard_router.engines if database.shard_router is not None else [database.engine]
+        self._task = None
+
+    def archive_due(self):
+        """Archives every task due, a batch per transaction. Returns owner id -> archived task ids."""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.after_days)
+        archived = {}
+        for engine in self.engines:
+            while True:
+                # versions live on the first database, with sharded tasks they commit right after the batch
+                with Session(engine, binds={models.TaskVersion: self.engines[0]}) as db:
+                    connection = db.connection()
+                    rows = archive_rows(connection, due(cutoff, self.batch_size, connection.dialect.name))
+                    if rows:
+                        # the owners' lists lost these tasks
+                        versions.bump_owners(db, {owner_id for _, owner_id in rows})
+                    db.commit()
+                for id, owner_id in rows:
+                    archived.setdefault(owner_id, []).append(id)
+                if len(rows) < self.batch_size:
+                    break
+        return archived
+
+    async def archive(self):
+        archived = await run_in_threadpool(self.archive_due)
+        for owner_id, ids in archived.items():
+            await events.task_event("archived", owner_id, sorted(ids))
+        return archived
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.archive()
+            except Exception:
+                logger.exception("Archiving tasks failed, retrying with the next pass")
+
+archiver = Archiver(settings.task_archive_after_days, settings.task_archive_interval_seconds, settings.task_archive_batch_size)
+
+def main():
+    parser = argparse.ArgumentParser(description="Move the completed tasks due for archival to tasks_archive.")
+    parser.add_argument("--after-days", type=float, default=settings.task_archive_after_days)
+    args = parser.parse_args()
+
+    archiver.after_days = args.after_days
+    archived = archiver.archive_due()
+    print(f"{sum(len(ids) for ids in archived.values())} tasks of {len(archived)} users archived")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+    """A bounded LRU cache whose entries also expire after their own time to live.
+
+    Entries can be tagged with an owner (e.g. a user id) so everything cached for it
+    can be dropped at once. Safe to share between the event loop and threadpool workers.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys_by_owner = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, owner=None, ttl: float = None):
+        """Cache `value` for `ttl` seconds, capped at the cache wide time to live."""
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, time.monotonic() + ttl, owner)
+            if owner is not None:
+                self._keys_by_owner.setdefault(owner, set()).add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, owner):
+        with self._lock:
+            for key in list(self._keys_by_owner.get(owner, ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_owner.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[2] is not None:
+            keys = self._keys_by_owner.get(entry[2])
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_owner[entry[2]]
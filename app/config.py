@@ -1,10 +1,69 @@
-from pydantic_settings import BaseSettings
+from typing import Literal, Optional
+from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
     database_connection_string: str
     secret_key: str
+    # serve requests through an AsyncEngine (asyncpg / aiosqlite) instead of the threadpool backed sync engine
+    database_async: bool = False
+    # comma separated read replicas for read only endpoints. A user's reads stay on the primary for the sticky
+    # seconds after each of their writes, in other workers too through the primary_until cookie their write
+    # answers with, and a replica that fails to connect is skipped for the retry seconds
+    database_replica_connection_strings: str = ""
+    replica_sticky_seconds: float = 5
+    replica_retry_seconds: float = 30
+    # comma separated databases holding the tasks of some users, the primary database being shard 0 and keeping
+    # users, shares and the directory. "hash" places users by their id, "directory" by the shard_directory table,
+    # whose entries each worker caches for the given seconds (see app/shards.py)
+    database_shard_connection_strings: str = ""
+    shard_map: Literal["hash", "directory"] = "hash"
+    shard_directory_cache_seconds: float = 5
+    # completed tasks created more than the given days ago move to tasks_archive, a batch per transaction,
+    # checked every interval by each worker when enabled (see app/archive.py)
+    task_archive_enabled: bool = False
+    task_archive_after_days: float = 30
+    task_archive_interval_seconds: float = 300
+    task_archive_batch_size: int = 1000
+    # connection pool of every engine, per worker process. The statement timeout only applies to PostgreSQL
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout_seconds: float = 30
+    db_pool_pre_ping: bool = True
+    db_pool_recycle_seconds: int = 1800
+    db_statement_timeout_ms: Optional[int] = None
+    # statements running at least this long are logged to the app.slow_query logger, unset disables the log
+    slow_query_threshold_ms: Optional[float] = None
+    # counters behind the ETags of GET /tasks, "memory" only holds with a single worker and leaves reads served
+    # by a replica without an ETag, "database" is shared by all and read along with the tasks
+    task_version_store: Literal["memory", "database"] = "memory"
+    # acknowledge PATCH /tasks/{id} once queued and write the queue as one UPDATE every flush interval,
+    # or once it holds max items. Queued toggles are lost if the worker crashes (see app/writebehind.py)
+    task_status_write_behind: bool = False
+    write_behind_flush_ms: int = 50
+    write_behind_max_items: int = 1000
+    # GET /tasks/events: events kept per worker to resume streams from, and buffered per subscriber before it's
+    # told to refetch. With "postgresql" events reach the subscribers of every worker through LISTEN/NOTIFY
+    task_events_backend: Literal["memory", "postgresql"] = "memory"
+    task_events_replay_size: int = 1000
+    task_events_buffer_size: int = 100
+    task_events_keepalive_seconds: float = 15
+    # token buckets per client IP and per username in front of login and sign up, burst then refill a minute.
+    # Set the SQLite path to share the buckets between the workers of a host
+    rate_limit_enabled: bool = True
+    rate_limit_ip_burst: int = 20
+    rate_limit_ip_per_minute: float = 10
+    rate_limit_username_burst: int = 5
+    rate_limit_username_per_minute: float = 5
+    rate_limit_sqlite_path: Optional[str] = None
+    # verified tokens and their users are cached per worker, entries never outlive the token itself
+    principal_cache_size: int = 10000
+    principal_cache_ttl_seconds: int = 300
+    # bcrypt runs in its own "thread" or "process" pool, calls past workers + queue size get a 503
+    bcrypt_rounds: int = 12
+    password_hash_executor: str = "thread"
+    password_hash_workers: int = 4
+    password_hash_queue_size: int = 32
 
-    class Config:
-        env_file = ".env"
+    model_config = SettingsConfigDict(env_file=".env")
 
 settings = Settings()
@@ -0,0 +1,89 @@
+"""Per user task counters behind GET /tasks/stats.
+
+Triggers on tasks keep task_counters up to date in the transaction of every insert, update and
+delete, whichever code path (single, bulk, import, cascade) issued it. On PostgreSQL they are
+statement level and aggregate their transition tables, so a bulk statement writes each owner's
+row once. Archived tasks still count: the same triggers on tasks_archive add back what moving
+them out of tasks took away. Shares don't copy tasks, the shared counts are read from the
+sharing owners' rows.
+
+The queries live in crud.py. Run ``python -m app.counters`` to recompute the counters from the
+tasks table, after restoring tasks outside of the app or to check the triggers (``--user-id``
+limits it to one user).
+"""
+import argparse
+
+POSTGRESQL_CREATE = [
+    """CREATE OR REPLACE FUNCTION task_counters_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        -- each branch only reads the transition tables its trigger declares
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO task_counters (user_id, total, done)
+            SELECT owner_id, count(*), count(*) FILTER (WHERE done) FROM new_rows GROUP BY owner_id
+            ON CONFLICT (user_id) DO UPDATE SET total = task_counters.total + excluded.total, done = task_counters.done + excluded.done;
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE task_counters SET total = task_counters.total - removed.total, done = task_counters.done - removed.done
+            FROM (SELECT owner_id, count(*) AS total, count(*) FILTER (WHERE done) AS done FROM old_rows GROUP BY owner_id) AS removed
+            WHERE task_counters.user_id = removed.owner_id;
+        ELSE
+            INSERT INTO task_counters (user_id, total, done)
+            SELECT owner_id, sum(total), sum(done) FROM (
+                SELECT owner_id, 1 AS total, done::int AS done FROM new_rows
+                UNION ALL
+                SELECT owner_id, -1, -done::int FROM old_rows
+            ) AS changes GROUP BY owner_id HAVING sum(total) <> 0 OR sum(done) <> 0
+            ON CONFLICT (user_id) DO UPDATE SET total = task_counters.total + excluded.total, done = task_counters.done + excluded.done;
+        END IF;
+        RETURN NULL;
+    END $$""",
+    "CREATE TRIGGER task_counters_insert AFTER INSERT ON tasks REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+    "CREATE TRIGGER task_counters_update AFTER UPDATE ON tasks REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+    "CREATE TRIGGER task_counters_delete AFTER DELETE ON tasks REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+    "CREATE TRIGGER task_counters_insert AFTER INSERT ON tasks_archive REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+    "CREATE TRIGGER task_counters_delete AFTER DELETE ON tasks_archive REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+]
+# the triggers go with the tasks table
+POSTGRESQL_DROP = "DROP FUNCTION IF EXISTS task_counters_apply() CASCADE"
+
+SQLITE_CREATE = [
+    """CREATE TRIGGER IF NOT EXISTS task_counters_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO task_counters (user_id, total, done) VALUES (new.owner_id, 1, new.done)
+        ON CONFLICT (user_id) DO UPDATE SET total = total + 1, done = done + excluded.done;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_counters_update AFTER UPDATE OF done, owner_id ON tasks BEGIN
+        UPDATE task_counters SET total = total - 1, done = done - old.done WHERE user_id = old.owner_id;
+        INSERT INTO task_counters (user_id, total, done) VALUES (new.owner_id, 1, new.done)
+        ON CONFLICT (user_id) DO UPDATE SET total = total + 1, done = done + excluded.done;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_counters_delete AFTER DELETE ON tasks BEGIN
+        UPDATE task_counters SET total = total - 1, done = done - old.done WHERE user_id = old.owner_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_archive_counters_insert AFTER INSERT ON tasks_archive BEGIN
+        INSERT INTO task_counters (user_id, total, done) VALUES (new.owner_id, 1, new.done)
+        ON CONFLICT (user_id) DO UPDATE SET total = total + 1, done = done + excluded.done;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_archive_counters_delete AFTER DELETE ON tasks_archive BEGIN
+        UPDATE task_counters SET total = total - 1, done = done - old.done WHERE user_id = old.owner_id;
+    END""",
+]
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute the per user task counters behind GET /tasks/stats.")
+    parser.add_argument("--user-id", type=int)
+    args = parser.parse_args()
+
+    # models build their DDL from this module, so the rest of the app is only imported when run
+    from sqlalchemy.orm import Session
+    from . import crud
+    from .database import SessionLocal, shard_router
+    if shard_router is None:
+        with SessionLocal() as db:
+            print(f"{crud.backfill_task_counters(db, args.user_id)} counters written")
+        return
+    # every shard counts the tasks it holds
+    for shard, engine in enumerate(shard_router.engines):
+        with Session(engine) as db:
+            print(f"shard {shard}: {crud.backfill_task_counters(db, args.user_id)} counters written")
+
+if __name__ == "__main__":
+    main()
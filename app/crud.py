@@ -0,0 +1,487 @@
+import heapq
+from itertools import islice
+from fastapi import HTTPException, status
+from sqlalchemy import case, delete, exists, func, insert, literal, select, text, tuple_, union_all, update
+from sqlalchemy.orm import Session, joinedload, load_only
+from sqlalchemy.sql import operators
+from . import models, schemas, shards, versions
+from . import search as search_engine
+
+# Data access shared by the routers. Everything here takes a sync Session so it can run both in the
+# threadpool and inside AsyncSession.run_sync (see database.run), and returns fully loaded objects
+# since nothing may lazy load once back on the event loop.
+
+def get_user(db: Session, id: int):
+    return db.query(models.User).filter(models.User.id == id).first()
+
+def get_user_by_username(db: Session, username: str):
+    return db.query(models.User).filter(models.User.username == username).first()
+
+def create_user(db: Session, user: schemas.UserCreate):
+    user_exists = db.query(models.User).filter(models.User.email == user.email, models.User.username == user.username).first()
+
+    if user_exists:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"User with these credentials already exists")
+
+    new_user = models.User(**user.model_dump())
+    db.add(new_user)
+    if getattr(db, "shard_router", None) is not None:
+        db.flush()
+        shards.place_user(db, db.shard_router, new_user)
+    db.commit()
+    db.refresh(new_user)
+    return new_user
+
+def update_user_password(db: Session, id: int, password: str):
+    user = db.get(models.User, id)
+    user.password = password
+    db.commit()
+
+OWNER_FIELDS = ("id", "username", "email", "created_at")
+
+def get_tasks(db: Session, owner_id: int, limit: int, skip: int, search: str, ranked: bool, cursor_position, fields=schemas.TASK_FIELDS, include_archived: bool = False, sharing_owner_ids: list = None):
+    """A page of tasks projected to `fields`, and the (created_at, id) position of its last row.
+
+    `sharing_owner_ids` are the owners sharing with `owner_id` when the caller already looked them up.
+
+    This is the hot read path: it selects plain rows into JSON ready dicts, skipping ORM
+    instances and pydantic validation, since every value comes straight from typed columns.
+    """
+    task_keys = [field for field in schemas.TASK_FIELDS if field in fields and field != "owner"]
+    include_owner = "owner" in fields
+    dialect = db.get_bind().dialect.name
+
+    # archived tasks come from a second statement of the same columns and order, ranking isn't asked for then
+    listings = [listing(model, task_keys, include_owner, dialect, search, ranked, cursor_position)
+                for model in ((models.Task, models.TaskArchive) if include_archived else (models.Task,))]
+    relevance = listings[0][2]
+
+    # a statement per owner, the caller and whoever shares with them, walks that owner's (created_at, id)
+    # index in page order and stops at the page. Filtering on several owners at once would read and
+    # sort all of their tasks instead
+    if sharing_owner_ids is None:
+        sharing_owner_ids = get_sharing_owner_ids(db, owner_id)
+    owner_ids = [owner_id, *sharing_owner_ids]
+    pages = [(statement.where(model.owner_id == owner), bind_arguments)
+             for model, statement, _ in listings
+             for bind_arguments, owners in owner_shards(db, owner_ids) for owner in owners]
+
+    # rows are the task columns, then created_at and id for the cursor, then the owner's columns
+    task_count = len(task_keys)
+    owner_start = task_count + 2
+
+    if len(pages) == 1:
+        statement, bind_arguments = pages[0]
+        if cursor_position is None:
+            statement = statement.offset(skip)
+        rows = db.execute(statement.limit(limit), bind_arguments=bind_arguments).all()
+    else:
+        rows = merged_page(db, pages, relevance, task_count + 1, 0 if cursor_position is not None else skip, limit)
+
+    if include_owner:
+        tasks = [{**dict(zip(task_keys, row)), "owner": dict(zip(OWNER_FIELDS, row[owner_start:owner_start + len(OWNER_FIELDS)]))} for row in rows]
+    else:
+        tasks = [dict(zip(task_keys, row)) for row in rows]
+    last_position = tuple(rows[-1][task_count:owner_start]) if rows else None
+
+    return tasks, last_position
+
+def listing(model, task_keys: list, include_owner: bool, dialect: str, search: str, ranked: bool, cursor_position):
+    """(model, the SELECT of a page of `model`'s rows in page order, the relevance it's ranked by or None)."""
+    statement = select(*(model.__table__.c[key] for key in task_keys), model.created_at, model.id)
+    if include_owner:
+        statement = statement.add_columns(*(models.User.__table__.c[key] for key in OWNER_FIELDS)).join(models.User, models.User.id == model.owner_id)
+
+    statement, relevance = search_engine.apply(statement, model, dialect, search)
+
+    if ranked and relevance is not None:
+        statement = statement.order_by(relevance, model.id)
+    else:
+        relevance = None
+        statement = statement.order_by(model.created_at, model.id)
+
+    if cursor_position is not None:
+        statement = statement.where(tuple_(model.created_at, model.id) > tuple_(*cursor_position))
+
+    return model, statement, relevance
+
+def merged_page(db: Session, pages: list, relevance, id_index: int, skip: int, limit: int):
+    """Rows skip to skip + limit of several (statement, bind arguments) of the same columns and order, merged in that order.
+
+    Each statement answers its first skip + limit rows. With `relevance` they're ranked by it, and
+    it's added as the last column; otherwise created_at and id are the two columns from `id_index` - 1.
+    """
+    if relevance is not None:
+        descending = getattr(relevance, "modifier", None) is operators.desc_op
+        rank = relevance.element if descending else relevance
+        pages = [(statement.add_columns(rank), bind_arguments) for statement, bind_arguments in pages]
+        key = (lambda row: (-row[-1], row[id_index])) if descending else (lambda row: (row[-1], row[id_index]))
+    else:
+        key = lambda row: (row[id_index - 1], row[id_index])
+
+    results = [db.execute(statement.limit(skip + limit), bind_arguments=bind_arguments).all() for statement, bind_arguments in pages]
+    return list(islice(heapq.merge(*results, key=key), skip, skip + limit))
+
+def owner_shards(db: Session, owner_ids, writing: bool = False):
+    """(bind arguments, owners) for each shard holding tasks of `owner_ids`, a single one when tasks aren't sharded."""
+    router = getattr(db, "shard_router", None)
+    if router is None:
+        return [({}, list(owner_ids))]
+    shard_of = router.writable_shard_of if writing else router.shard_of
+    placed = {}
+    for owner_id in owner_ids:
+        placed.setdefault(shard_of(owner_id), []).append(owner_id)
+    return [({"shard": shard}, owners) for shard, owners in placed.items()]
+
+def task_shards(db: Session, owner_ids):
+    """Bind arguments of the shards to look for a task id on, a single one when tasks aren't sharded.
+
+    Ids don't name a shard, tasks keep theirs when their owner moves. The shards of `owner_ids`, whose
+    tasks the caller may see, come first, the others only tell someone else's task from a missing one.
+    """
+    router = getattr(db, "shard_router", None)
+    if router is None:
+        return [{}]
+    order = dict.fromkeys([*(router.shard_of(owner_id) for owner_id in owner_ids), *range(len(router.engines))])
+    return [{"shard": shard} for shard in order]
+
+def new_task_ids(db: Session, count: int):
+    """Ids for `count` new tasks when they're sharded, unique across shards, None to let the database number them."""
+    router = getattr(db, "shard_router", None)
+    return router.new_task_ids(db, count) if router is not None else None
+
+def tasks_engine(db: Session):
+    """The engine holding the current user's tasks, for reads outliving the session."""
+    return db.get_bind(models.Task)
+
+def get_task(db: Session, id: int, owner_id: int, fields=schemas.TASK_FIELDS, sharing_owner_ids=()):
+    task = find_task(db, id, fields, [owner_id, *sharing_owner_ids])
+
+    if not task:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"task with id: {id} was not found")
+
+    if owner_id != task.owner_id and not db.query(exists().where(models.TaskShare.owner_id == task.owner_id, models.TaskShare.user_id == owner_id)).scalar():
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to perform request action")
+
+    return project(task, fields)
+
+def find_task(db: Session, id: int, fields, owner_ids):
+    # the task may be shared from an owner on another shard. Archived tasks are only looked for once
+    # it isn't among the active ones
+    for bind_arguments in task_shards(db, owner_ids):
+        for model in (models.Task, models.TaskArchive):
+            task = db.scalars(projected(select(model), fields, {"id", "owner_id"}, model).where(model.id == id), bind_arguments=bind_arguments).first()
+            if task is not None:
+                return task
+    return None
+
+def projected(task_query, fields, required: set, model=models.Task):
+    """Load only the columns behind `fields` (plus `required` ones) and join the owner into the same query when asked for."""
+    columns = [getattr(model, field) for field in schemas.TASK_FIELDS if field != "owner" and (field in fields or field in required)]
+    task_query = task_query.options(load_only(*columns))
+    if "owner" in fields:
+        task_query = task_query.options(joinedload(model.owner, innerjoin=True))
+    return task_query
+
+def project(task, fields):
+    item = {field: getattr(task, field) for field in schemas.TASK_FIELDS if field in fields and field != "owner"}
+    if "owner" in fields:
+        item["owner"] = schemas.UserResponse.model_validate(task.owner)
+    return item
+
+def sharing_owner_ids(user_id: int):
+    """Owners whose tasks are shared with `user_id`."""
+    return select(models.TaskShare.owner_id).where(models.TaskShare.user_id == user_id)
+
+def get_sharing_owner_ids(db: Session, user_id: int):
+    return db.scalars(sharing_owner_ids(user_id)).all()
+
+# Single task mutations are one owner scoped statement with RETURNING. Only when it matches nothing does
+# a second, primary key probe tell a missing task (404) from someone else's (403), or from an archived
+# one of the caller's, which is then changed in the archive. Every mutation also bumps its owner's
+# version behind the ETags of GET /tasks, in the same transaction.
+
+def create_task(db: Session, owner: schemas.Principal, task: schemas.TaskCreate):
+    ids = new_task_ids(db, 1)
+    values = {"owner_id": owner.id, **task.model_dump(), **({"id": ids[0]} if ids else {})}
+    new_task = db.execute(insert(models.Task).values(**values).returning(*models.Task.__table__.c)).one()
+    versions.bump_owner(db, owner.id)
+    db.commit()
+
+    return task_response(new_task, owner)
+
+def delete_task(db: Session, id: int, owner_id: int):
+    deleted = db.execute(delete(models.Task).where(*owned_task(id, owner_id)).returning(models.Task.id)).first()
+
+    if deleted is None:
+        raise_unless_archived(db, id, owner_id)
+        delete_archived(db, owner_id, [id])
+
+    versions.bump_owner(db, owner_id)
+    db.commit()
+
+def update_task(db: Session, id: int, owner: schemas.Principal, task: schemas.TaskCreate):
+    statement = (
+        update(models.Task).where(*owned_task(id, owner.id)).values(**task.model_dump())
+        .returning(*models.Task.__table__.c)
+        .execution_options(synchronize_session=False))
+    updated_task = db.execute(statement).first()
+
+    if updated_task is None:
+        raise_unless_archived(db, id, owner.id)
+        restore_tasks(db, owner.id, [id])
+        updated_task = db.execute(statement).first()
+
+    versions.bump_owner(db, owner.id)
+    db.commit()
+
+    return task_response(updated_task, owner)
+
+def update_task_status(db: Session, id: int, owner_id: int, done: bool):
+    updated = db.execute(
+        update(models.Task).where(*owned_task(id, owner_id)).values(done=done)
+        .returning(models.Task.id)
+        .execution_options(synchronize_session=False)).first()
+
+    if updated is None:
+        raise_unless_archived(db, id, owner_id)
+        set_archived_status(db, owner_id, [id], done)
+
+    versions.bump_owner(db, owner_id)
+    db.commit()
+
+# Archived tasks (see archive.py) are changed where they are, except that marking them undone or editing
+# them moves them back into tasks first, with their id.
+
+def restore_tasks(db: Session, owner_id: int, ids: list, bind_arguments: dict = None):
+    """Moves `owner_id`'s archived tasks among `ids` back into tasks, undone. Returns their ids."""
+    archive = models.TaskArchive
+    restored = db.execute(
+        delete(archive).where(archive.id.in_(ids), archive.owner_id == owner_id)
+        .returning(archive.id, archive.title, archive.content, archive.created_at, archive.owner_id)
+        .execution_options(synchronize_session=False), bind_arguments=bind_arguments).all()
+    if restored:
+        db.execute(insert(models.Task), [{**row._mapping, "done": False} for row in restored], bind_arguments=bind_arguments)
+    return [row.id for row in restored]
+
+def set_archived_status(db: Session, owner_id: int, ids: list, done: bool):
+    """Status changes of `owner_id`'s archived tasks among `ids`, which are all done already. Returns their ids."""
+    if not done:
+        return restore_tasks(db, owner_id, ids)
+    archive = models.TaskArchive
+    return db.scalars(select(archive.id).where(archive.id.in_(ids), archive.owner_id == owner_id)).all()
+
+def delete_archived(db: Session, owner_id: int, ids: list):
+    archive = models.TaskArchive
+    return db.scalars(
+        delete(archive).where(archive.id.in_(ids), archive.owner_id == owner_id)
+        .returning(archive.id)
+        .execution_options(synchronize_session=False)).all()
+
+def owned_task(id: int, owner_id: int):
+    return models.Task.id == id, models.Task.owner_id == owner_id
+
+def raise_unless_archived(db: Session, id: int, owner_id: int):
+    found_owner_id, archived = find_task_owners(db, [id], owner_id).get(id, (None, False))
+    if found_owner_id == owner_id and archived:
+        return
+
+    # an active task of the caller's was archived or restored since the owner scoped statement
+    if found_owner_id is None or found_owner_id == owner_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"task with id {id} does not exist")
+
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to perform request action")
+
+def task_response(task, owner: schemas.Principal):
+    # the caller owns the task, so its owner is already known without a users lookup
+    return schemas.TaskResponse(**task._mapping, owner=owner.model_dump())
+
+def create_tasks(db: Session, owner_id: int, tasks: list):
+    rows = [{"owner_id": owner_id, **task.model_dump()} for task in tasks]
+    ids = new_task_ids(db, len(rows))
+    if ids:
+        rows = [{"id": id, **row} for id, row in zip(ids, rows)]
+    created = db.scalars(insert(models.Task).returning(models.Task.id, sort_by_parameter_order=True), rows)
+    ids = created.all()
+    versions.bump_owner(db, owner_id)
+    db.commit()
+
+    return [schemas.BulkItemResult(id=id, status=status.HTTP_201_CREATED) for id in ids]
+
+def update_tasks_status(db: Session, owner_id: int, ids: list, done: bool):
+    ids = list(dict.fromkeys(ids))
+    updated = db.scalars(
+        update(models.Task)
+        .where(models.Task.id.in_(ids), models.Task.owner_id == owner_id)
+        .values(done=done)
+        .returning(models.Task.id)
+        .execution_options(synchronize_session=False))
+    affected = set(updated.all())
+    found = find_task_owners(db, missed_ids(ids, affected), owner_id)
+    archived = archived_ids(found, owner_id)
+    if archived:
+        affected.update(set_archived_status(db, owner_id, archived, done))
+    results = bulk_results(ids, affected, found, status.HTTP_200_OK)
+    if affected:
+        versions.bump_owner(db, owner_id)
+    db.commit()
+
+    return results
+
+def apply_task_statuses(db: Session, toggles: dict):
+    """Writes queued status toggles, task id -> (owner id, done), in one UPDATE. Returns the (id, owner id) of the changed tasks."""
+    changed = []
+    # one UPDATE per shard, toggles come from many owners
+    for bind_arguments, owners in owner_shards(db, {owner_id for owner_id, _ in toggles.values()}, writing=True):
+        owners = set(owners)
+        shard_toggles = {id: toggle for id, toggle in toggles.items() if toggle[0] in owners}
+        updated = db.execute(
+            update(models.Task)
+            .where(tuple_(models.Task.id, models.Task.owner_id).in_([(id, owner_id) for id, (owner_id, _) in shard_toggles.items()]))
+            .values(done=case({id: done for id, (_, done) in shard_toggles.items()}, value=models.Task.id))
+            .returning(models.Task.id, models.Task.owner_id)
+            .execution_options(synchronize_session=False), bind_arguments=bind_arguments)
+        written = updated.all()
+        changed += written
+
+        # undone toggles the UPDATE missed may be of archived tasks
+        written_ids = {id for id, _ in written}
+        undone = {}
+        for id, (owner_id, done) in shard_toggles.items():
+            if not done and id not in written_ids:
+                undone.setdefault(owner_id, []).append(id)
+        for owner_id, ids in undone.items():
+            changed += [(id, owner_id) for id in restore_tasks(db, owner_id, ids, bind_arguments)]
+    if changed:
+        versions.bump_owners(db, {owner_id for _, owner_id in changed})
+    db.commit()
+
+    return changed
+
+def delete_tasks(db: Session, owner_id: int, ids: list):
+    ids = list(dict.fromkeys(ids))
+    deleted = db.scalars(
+        delete(models.Task)
+        .where(models.Task.id.in_(ids), models.Task.owner_id == owner_id)
+        .returning(models.Task.id)
+        .execution_options(synchronize_session=False))
+    affected = set(deleted.all())
+    found = find_task_owners(db, missed_ids(ids, affected), owner_id)
+    archived = archived_ids(found, owner_id)
+    if archived:
+        affected.update(delete_archived(db, owner_id, archived))
+    results = bulk_results(ids, affected, found, status.HTTP_204_NO_CONTENT)
+    if affected:
+        versions.bump_owner(db, owner_id)
+    db.commit()
+
+    return results
+
+def missed_ids(ids: list, affected: set):
+    # only ids the owner scoped statement missed need a probe to tell 404 from 403, or archived tasks
+    return [id for id in ids if id not in affected]
+
+def archived_ids(found: dict, owner_id: int):
+    return [id for id, (found_owner_id, archived) in found.items() if found_owner_id == owner_id and archived]
+
+def bulk_results(ids: list, affected: set, found: dict, success_status: int):
+    results = []
+    for id in ids:
+        if id in affected:
+            results.append(schemas.BulkItemResult(id=id, status=success_status))
+        elif id in found:
+            results.append(schemas.BulkItemResult(id=id, status=status.HTTP_403_FORBIDDEN, detail="Not authorized to perform request action"))
+        else:
+            results.append(schemas.BulkItemResult(id=id, status=status.HTTP_404_NOT_FOUND, detail=f"task with id {id} does not exist"))
+    return results
+
+def find_task_owners(db: Session, ids: list, owner_id: int):
+    """id -> (owner id, whether it's archived) of the tasks among `ids`, in one probe per shard until all are found."""
+    found = {}
+    for bind_arguments in task_shards(db, [owner_id]):
+        missing = [id for id in ids if id not in found]
+        if not missing:
+            break
+        rows = db.execute(union_all(
+            select(models.Task.id, models.Task.owner_id, literal(False)).where(models.Task.id.in_(missing)),
+            select(models.TaskArchive.id, models.TaskArchive.owner_id, literal(True)).where(models.TaskArchive.id.in_(missing))),
+            bind_arguments=bind_arguments)
+        found.update((id, (found_owner_id, bool(archived))) for id, found_owner_id, archived in rows)
+    return found
+
+# Task counts come from task_counters, kept up to date by the triggers of counters.py
+
+def get_task_stats(db: Session, user_id: int):
+    if getattr(db, "shard_router", None) is not None:
+        return get_sharded_task_stats(db, user_id)
+
+    # index lookups in a single statement, whatever the number of tasks
+    counter = models.TaskCounter
+    own = counter.user_id == user_id
+    shared = (models.TaskShare, models.TaskShare.owner_id == counter.user_id)
+    row = db.execute(select(
+        select(counter.total).where(own).scalar_subquery(),
+        select(counter.done).where(own).scalar_subquery(),
+        select(func.sum(counter.total)).join(*shared).where(models.TaskShare.user_id == user_id).scalar_subquery(),
+        select(func.sum(counter.done)).join(*shared).where(models.TaskShare.user_id == user_id).scalar_subquery())).one()
+
+    return task_stats(*(int(value or 0) for value in row))
+
+def get_sharded_task_stats(db: Session, user_id: int):
+    # one statement per shard of the user and of the owners sharing with them
+    counter = models.TaskCounter
+    counts = {}
+    for shared, owner_ids in ((False, [user_id]), (True, get_sharing_owner_ids(db, user_id))):
+        for bind_arguments, owners in owner_shards(db, owner_ids):
+            row = db.execute(select(func.sum(counter.total), func.sum(counter.done)).where(counter.user_id.in_(owners)), bind_arguments=bind_arguments).one()
+            total, done = counts.get(shared, (0, 0))
+            counts[shared] = (total + int(row[0] or 0), done + int(row[1] or 0))
+    return task_stats(*counts[False], *counts.get(True, (0, 0)))
+
+def task_stats(total: int, done: int, shared_total: int, shared_done: int):
+    return schemas.TaskStats(
+        total=total, done=done, open=total - done,
+        shared=schemas.TaskCounts(total=shared_total, done=shared_done, open=shared_total - shared_done))
+
+def backfill_task_counters(db: Session, user_id: int = None):
+    """Recompute task_counters from tasks and archived tasks, for every user or only `user_id`. Returns the rows written."""
+    if db.bind.dialect.name == "postgresql":
+        # writers would otherwise update counters between the count and the rewrite
+        db.execute(text("LOCK TABLE tasks, tasks_archive IN SHARE MODE"))
+
+    sources = [select(model.owner_id, model.done) for model in (models.Task, models.TaskArchive)]
+    cleared = delete(models.TaskCounter)
+    if user_id is not None:
+        sources = [source.where(source.selected_columns.owner_id == user_id) for source in sources]
+        cleared = cleared.where(models.TaskCounter.user_id == user_id)
+    tasks = union_all(*sources).subquery()
+    counted = select(tasks.c.owner_id, func.count(), func.count().filter(tasks.c.done)).group_by(tasks.c.owner_id)
+
+    db.execute(cleared)
+    written = db.execute(insert(models.TaskCounter).from_select(["user_id", "total", "done"], counted)).rowcount
+    db.commit()
+    return written
+
+def share_tasks(db: Session, owner_id: int, task_share: schemas.TaskShare):
+    user_to_share = db.query(models.User).filter(models.User.email == task_share.email).first()
+    if not user_to_share:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+
+    if user_to_share.id == owner_id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Cannot share tasks with yourself")
+
+    # a share references the owner's whole task list, so sharing and unsharing are one single row statement
+    # however many tasks there are, and recipients see the owner's tasks as they change. The recipient's
+    # ETags change with the row, they're built from the owners sharing with them (see versions.py)
+    if task_share.share:
+        db.execute(insert(models.TaskShare).from_select(
+            ["user_id", "owner_id"],
+            select(literal(user_to_share.id), literal(owner_id))
+            .where(~exists().where(models.TaskShare.user_id == user_to_share.id, models.TaskShare.owner_id == owner_id))))
+        db.commit()
+        return user_to_share.id, {"message": "Tasks shared successfully"}
+
+    else:
+        db.execute(delete(models.TaskShare).where(models.TaskShare.owner_id == owner_id, models.TaskShare.user_id == user_to_share.id))
+        db.commit()
+        return user_to_share.id, {"message": "Tasks unshared successfully"}
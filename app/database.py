@@ -1,13 +1,333 @@
-from sqlalchemy import create_engine
+import hashlib
+import hmac
+import itertools
+import math
+import threading
+import time
+from contextvars import ContextVar
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from starlette.datastructures import MutableHeaders
+from starlette.requests import cookie_parser
+from .cache import TTLCache
 from .config import settings
+from .shards import ShardRouter, is_sharded
 
 DATABASE_CONNECTION_STRING = settings.database_connection_string
 
-engine = create_engine(DATABASE_CONNECTION_STRING)
+ASYNC_DRIVERS = {"postgresql": "postgresql+asyncpg", "sqlite": "sqlite+aiosqlite"}
 
-SessionLocal = sessionmaker(autoflush=False, bind=engine)
+def async_url(url: str):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys, and so ON DELETE CASCADE, when asked to on every connection
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+class TimedPoolMixin:
+    """Records how many checkouts had to wait for a connection, for how long, and how many gave up."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self._stats_lock = threading.Lock()
+
+    def _do_get(self):
+        # QueuePool's hook that hands out (or waits for) a connection, there is no public event before a checkout
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+                self.timeouts += timed_out
+
+    def stats(self):
+        return {
+            "size": self.size(),
+            "checked_out": self.checkedout(),
+            "idle": self.checkedin(),
+            "overflow": max(0, self.overflow()),
+            "max_overflow": self._max_overflow,
+            "checkouts": self.checkouts,
+            "wait_seconds_total": self.wait_seconds,
+            "wait_seconds_max": self.max_wait_seconds,
+            "timeouts": self.timeouts,
+        }
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+# engines whose pools GET /health/pool reports on, by name
+pools = {}
+
+def engine_options(url: str, is_async: bool, kwargs: dict):
+    url = make_url(url)
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        # sqlite connections are shared with the threadpool FastAPI runs sync endpoints in
+        if not is_async:
+            kwargs.setdefault("connect_args", {"check_same_thread": False})
+        if url.database in (None, "", ":memory:"):
+            return kwargs
+
+    if "poolclass" not in kwargs:
+        kwargs.update(
+            poolclass=TimedAsyncAdaptedQueuePool if is_async else TimedQueuePool,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_max_overflow,
+            pool_timeout=settings.db_pool_timeout_seconds,
+            pool_pre_ping=settings.db_pool_pre_ping,
+            pool_recycle=settings.db_pool_recycle_seconds)
+
+    if backend == "postgresql" and settings.db_statement_timeout_ms is not None:
+        timeout = str(settings.db_statement_timeout_ms)
+        if is_async:
+            kwargs.setdefault("connect_args", {"server_settings": {"statement_timeout": timeout}})
+        else:
+            kwargs.setdefault("connect_args", {"options": f"-c statement_timeout={timeout}"})
+    return kwargs
+
+def make_engine(url: str, name: str = None, **kwargs):
+    engine = create_engine(url, **engine_options(url, False, kwargs))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", enable_sqlite_foreign_keys)
+    if name is not None:
+        pools[name] = engine.pool
+    return engine
+
+def make_async_engine(url: str, name: str = None, **kwargs):
+    engine = create_async_engine(async_url(url), **engine_options(url, True, kwargs))
+    if engine.dialect.name == "sqlite":
+        event.listen(engine.sync_engine, "connect", enable_sqlite_foreign_keys)
+    if name is not None:
+        pools[name] = engine.sync_engine.pool
+    return engine
+
+def pool_stats():
+    return {name: pool.stats() if isinstance(pool, TimedPoolMixin) else {"status": pool.status()} for name, pool in pools.items()}
+
+# id of the user the request is served for, set by oauth2.get_current_user, it keys read-your-writes
+current_user_id: ContextVar = ContextVar("current_user_id", default=None)
+
+class PrimaryCookie:
+    """The primary_until cookie: whose reads stay on the primary, and until when (a unix time).
+
+    Signed with the secret key, so a client can't pin other users to the primary or extend its own
+    stay. It carries read-your-writes across workers, each of which only remembers its own commits.
+    """
+    NAME = "primary_until"
+    __slots__ = ("user_id", "until", "changed")
+
+    def __init__(self, user_id: int = None, until: float = 0):
+        self.user_id = user_id
+        self.until = until
+        self.changed = False
+
+    @staticmethod
+    def signature(user_id: int, until: int):
+        return hmac.new(settings.secret_key.encode(), f"{user_id}:{until}".encode(), hashlib.sha256).hexdigest()[:32]
+
+    @classmethod
+    def parse(cls, value: str):
+        try:
+            user_id, until, signature = value.split(":")
+            user_id, until = int(user_id), int(until)
+        except ValueError:
+            return cls()
+        if not hmac.compare_digest(signature, cls.signature(user_id, until)):
+            return cls()
+        return cls(user_id, until)
+
+    def covers(self, user_id: int):
+        return user_id == self.user_id and time.time() < self.until
+
+    def stick(self, user_id: int, seconds: float):
+        until = math.ceil(time.time() + seconds)
+        if user_id != self.user_id:
+            self.user_id, self.until = user_id, 0
+        if until > self.until:
+            self.until = until
+            self.changed = True
+
+    def header(self):
+        max_age = max(0, math.ceil(self.until - time.time()))
+        value = f"{self.user_id}:{self.until}:{self.signature(self.user_id, self.until)}"
+        return f"{self.NAME}={value}; Max-Age={max_age}; Path=/; HttpOnly; SameSite=Lax"
+
+# the primary_until cookie of the request being served, set by PrimaryCookieMiddleware
+primary_cookie: ContextVar = ContextVar("primary_cookie", default=None)
+
+class PrimaryCookieMiddleware:
+    """Pure ASGI middleware reading the primary_until cookie, and setting it again when the request wrote."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        cookies = cookie_parser(MutableHeaders(scope=scope).get("cookie", ""))
+        cookie = PrimaryCookie.parse(cookies[PrimaryCookie.NAME]) if PrimaryCookie.NAME in cookies else PrimaryCookie()
+
+        async def send_with_cookie(message):
+            # the handler committed before its response starts, streamed ones included
+            if message["type"] == "http.response.start" and cookie.changed:
+                MutableHeaders(scope=message).append("set-cookie", cookie.header())
+            await send(message)
+
+        # the threadpool and run_sync work on a copy of this context, the cookie object itself is shared
+        token = primary_cookie.set(cookie)
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            primary_cookie.reset(token)
+
+class ReplicaRouter:
+    """Picks the replica a read only session runs on, or None for the primary.
+
+    Users read from the primary for `sticky_seconds` after each of their commits, so they see their
+    own writes despite replication lag. This worker remembers the commits it served, the others learn
+    of them from the primary_until cookie sent back to the client (see PrimaryCookie). A replica that
+    fails to connect is skipped for `retry_seconds`.
+    """
+
+    def __init__(self, replicas: list, sticky_seconds: float, retry_seconds: float):
+        self.replicas = replicas
+        self.sticky_seconds = sticky_seconds
+        self.retry_seconds = retry_seconds
+        # user id -> True while the user's reads stay on the primary
+        self.sticky = TTLCache(maxsize=100000, ttl=sticky_seconds)
+        self._down_until = {}
+        self._turn = itertools.count()
+        for replica in replicas:
+            event.listen(replica, "handle_error", self._on_error)
+
+    def replica(self, user_id):
+        if not self.replicas or (user_id is not None and self.is_sticky(user_id)):
+            return None
+        now = time.monotonic()
+        healthy = [replica for replica in self.replicas if self._down_until.get(replica, 0) <= now]
+        return healthy[next(self._turn) % len(healthy)] if healthy else None
+
+    def is_sticky(self, user_id):
+        cookie = primary_cookie.get()
+        return bool(self.sticky.get(user_id)) or (cookie is not None and cookie.covers(user_id))
+
+    def stick(self, user_id, seconds: float = None):
+        """Keeps `user_id`'s reads on the primary for `seconds`, `sticky_seconds` unless given."""
+        if not self.replicas or user_id is None:
+            return
+        seconds = self.sticky_seconds if seconds is None else seconds
+        self.sticky.set(user_id, True, ttl=seconds)
+        # only the user the request is served for takes the cookie, not owners of toggles it flushed
+        cookie = primary_cookie.get()
+        if cookie is not None and user_id == current_user_id.get():
+            cookie.stick(user_id, seconds)
+
+    def mark_down(self, replica):
+        self._down_until[replica] = time.monotonic() + self.retry_seconds
+
+    def _on_error(self, context):
+        # a failed connect has no connection yet, a dropped one is a disconnect
+        if context.connection is None or context.is_disconnect:
+            self.mark_down(context.engine)
+
+class RoutingSession(Session):
+    """A Session that, when read only, runs on the replica its router picks at first use.
+
+    Writes always go to the primary, and sessions aren't read only unless asked (see get_read_db).
+    With a shard router, tasks and task counters go to the shard of the current user instead, or
+    to the one passed as the `shard` bind argument.
+    """
+
+    def __init__(self, *args, router: ReplicaRouter = None, read_only: bool = False, shard_router: ShardRouter = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.router = router
+        self.read_only = read_only
+        self.shard_router = shard_router
+        self.replica = None
+        self._routed = False
+
+    def get_bind(self, mapper=None, clause=None, shard: int = None, **kwargs):
+        if self.shard_router is not None and (shard is not None or is_sharded(mapper, clause)):
+            if shard is None:
+                user_id = current_user_id.get()
+                if user_id is None:
+                    raise RuntimeError("Tasks are sharded by owner, pass the shard when there's no current user")
+                writing = self._flushing or getattr(clause, "is_dml", False)
+                shard = self.shard_router.writable_shard_of(user_id) if writing else self.shard_router.shard_of(user_id)
+            # shard 0 is the primary, and its replicas
+            if shard:
+                return self.shard_router.engines[shard]
+        if self.read_only and self.router is not None and not self._flushing and not getattr(clause, "is_dml", False):
+            if not self._routed:
+                self.replica = self.router.replica(current_user_id.get())
+                self._routed = True
+            if self.replica is not None:
+                return self.replica
+        return super().get_bind(mapper, clause=clause, **kwargs)
+
+@event.listens_for(RoutingSession, "after_commit")
+def stick_to_primary(session):
+    if session.router is not None:
+        session.router.stick(current_user_id.get())
+
+REPLICA_CONNECTION_STRINGS = [url.strip() for url in settings.database_replica_connection_strings.split(",") if url.strip()]
+
+engine = make_engine(DATABASE_CONNECTION_STRING, name="primary")
+
+replica_router = ReplicaRouter(
+    [make_engine(url, name=f"replica_{n}") for n, url in enumerate(REPLICA_CONNECTION_STRINGS)],
+    settings.replica_sticky_seconds, settings.replica_retry_seconds)
+
+SHARD_CONNECTION_STRINGS = [url.strip() for url in settings.database_shard_connection_strings.split(",") if url.strip()]
+
+shard_router = ShardRouter(
+    [engine, *(make_engine(url, name=f"shard_{n}") for n, url in enumerate(SHARD_CONNECTION_STRINGS, 1))],
+    settings.shard_map, settings.shard_directory_cache_seconds) if SHARD_CONNECTION_STRINGS else None
+
+SessionLocal = sessionmaker(class_=RoutingSession, autoflush=False, bind=engine, router=replica_router, shard_router=shard_router)
+
+async_engine = make_async_engine(DATABASE_CONNECTION_STRING, name="primary_async") if settings.database_async else None
+
+# routing happens in the sync session underneath, so it deals in the replicas' sync engines
+async_replica_router = ReplicaRouter(
+    [make_async_engine(url, name=f"replica_{n}_async").sync_engine for n, url in enumerate(REPLICA_CONNECTION_STRINGS)] if settings.database_async else [],
+    settings.replica_sticky_seconds, settings.replica_retry_seconds)
+
+async_shard_router = ShardRouter(
+    [async_engine.sync_engine, *(make_async_engine(url, name=f"shard_{n}_async").sync_engine for n, url in enumerate(SHARD_CONNECTION_STRINGS, 1))],
+    settings.shard_map, settings.shard_directory_cache_seconds) if settings.database_async and SHARD_CONNECTION_STRINGS else None
+
+def stick(user_id, seconds: float = None):
+    """Keeps `user_id`'s reads on the primary, for writes committed after the response (see app/writebehind.py)."""
+    for router in (replica_router, async_replica_router):
+        router.stick(user_id, seconds)
+
+AsyncSessionLocal = async_sessionmaker(sync_session_class=RoutingSession, autoflush=False, expire_on_commit=False, bind=async_engine, router=async_replica_router, shard_router=async_shard_router)
 
 Base = declarative_base()
 
@@ -16,4 +336,46 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def get_read_db():
+    """For endpoints that only read, their session may run on a replica."""
+    db = SessionLocal(read_only=True)
+    try:
+        yield db
+    finally:
+        db.close()
+
+async def get_async_read_db():
+    async with AsyncSessionLocal(read_only=True) as db:
+        yield db
+
+if settings.database_async:
+    get_db = get_async_db
+    get_read_db = get_async_read_db
+
+async def run(db, fn, *args, **kwargs):
+    """Call `fn(session, *args, **kwargs)` without blocking the event loop.
+
+    Data access is written once against a sync `Session`: with an `AsyncSession` it runs through
+    `run_sync`, otherwise in the threadpool like a sync endpoint would.
+    """
+    try:
+        return await run_session(db, fn, *args, **kwargs)
+    except exc.DBAPIError:
+        session = db.sync_session if isinstance(db, AsyncSession) else db
+        if getattr(session, "replica", None) is None:
+            raise
+        # the replica failed, serve this request from the primary
+        await run_session(db, Session.rollback)
+        session.replica = None
+        return await run_session(db, fn, *args, **kwargs)
+
+async def run_session(db, fn, *args, **kwargs):
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, db, *args, **kwargs)
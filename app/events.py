@@ -0,0 +1,272 @@
+"""Task change events, streamed to clients by GET /tasks/events instead of them polling GET /tasks.
+
+The task routes publish an event after each committed mutation: ``created``, ``updated``,
+``status`` and ``deleted`` on the owner's channel (with the task ``ids``, and ``done`` for status
+changes), ``shared`` and ``unshared`` on the recipient's. The archiver publishes ``archived`` for
+the tasks it moved out of the default GET /tasks list. A subscriber follows its own channels and
+those of the owners sharing with it, and starts or stops following an owner as shares come in.
+
+Every worker keeps the last `task_events_replay_size` events, so a stream reconnecting with the
+Last-Event-ID it saw resumes where it left off. When that can't be done (the events are gone, or
+the id is from another worker or process) and when a subscriber falls `task_events_buffer_size`
+events behind, it gets a ``reset`` event instead: refetch GET /tasks, then carry on with the stream.
+
+Events are delivered within the worker that published them, unless `task_events_backend` is
+"postgresql": then they go through NOTIFY to the listener of every worker, publisher included.
+"""
+import asyncio
+import logging
+import secrets
+import threading
+from collections import deque
+import orjson
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+from . import database
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = "task_events"
+# PostgreSQL refuses NOTIFY payloads of 8000 bytes and more
+NOTIFY_MAX_BYTES = 7999
+
+def tasks_channel(owner_id: int):
+    return ("tasks", owner_id)
+
+def shares_channel(user_id: int):
+    return ("shares", user_id)
+
+class Subscriber:
+    __slots__ = ("user_id", "channels", "loop", "ready", "events", "reset")
+
+    def __init__(self, user_id: int, loop):
+        self.user_id = user_id
+        self.channels = {tasks_channel(user_id), shares_channel(user_id)}
+        self.loop = loop
+        self.ready = asyncio.Event()
+        self.events = deque()
+        self.reset = False
+
+    def drain(self):
+        """Buffered events, or a single reset event when some were dropped."""
+        self.ready.clear()
+        if self.reset:
+            self.reset = False
+            self.events.clear()
+            return [{"type": "reset"}]
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+class Broker:
+    """Fans events out to the subscribers of this worker, keeping the latest ones for resuming streams."""
+
+    def __init__(self, replay_size: int, buffer_size: int):
+        # a fresh epoch per process, ids handed out before a restart can't be resumed from
+        self.epoch = secrets.token_hex(4)
+        self.buffer_size = buffer_size
+        self._last_id = 0
+        # (id number, channel, event) of the latest events, oldest first
+        self._recent = deque(maxlen=replay_size)
+        # channel -> subscribers following it
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id: int):
+        subscriber = Subscriber(user_id, asyncio.get_running_loop())
+        with self._lock:
+            for channel in subscriber.channels:
+                self._subscribers.setdefault(channel, set()).add(subscriber)
+        return subscriber
+
+    def follow(self, subscriber: Subscriber, owner_ids):
+        with self._lock:
+            for owner_id in owner_ids:
+                subscriber.channels.add(tasks_channel(owner_id))
+                self._subscribers.setdefault(tasks_channel(owner_id), set()).add(subscriber)
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            for channel in subscriber.channels:
+                followers = self._subscribers.get(channel)
+                if followers is not None:
+                    followers.discard(subscriber)
+                    if not followers:
+                        del self._subscribers[channel]
+
+    def __len__(self):
+        with self._lock:
+            return len({subscriber for followers in self._subscribers.values() for subscriber in followers})
+
+    def deliver(self, channel: tuple, event: dict):
+        with self._lock:
+            self._last_id += 1
+            event = {"id": f"{self.epoch}-{self._last_id}", **event}
+            self._recent.append((self._last_id, channel, event))
+            followers = list(self._subscribers.get(channel, ()))
+            # follow the owner from this event on, so nothing between the share and the next drain is missed
+            if event["type"] in ("shared", "unshared"):
+                for subscriber in followers:
+                    owner_channel = tasks_channel(event["owner_id"])
+                    owners_followers = self._subscribers.setdefault(owner_channel, set())
+                    if event["type"] == "shared":
+                        subscriber.channels.add(owner_channel)
+                        owners_followers.add(subscriber)
+                    else:
+                        subscriber.channels.discard(owner_channel)
+                        owners_followers.discard(subscriber)
+        for subscriber in followers:
+            self._push(subscriber, event)
+
+    def _push(self, subscriber: Subscriber, event: dict):
+        if len(subscriber.events) >= self.buffer_size:
+            # a slow reader doesn't hold memory, it refetches instead
+            subscriber.reset = True
+            subscriber.events.clear()
+        else:
+            subscriber.events.append(event)
+        wake(subscriber)
+
+    def reset_all(self):
+        """After events may have been missed (the listener reconnected), every subscriber refetches."""
+        with self._lock:
+            subscribers = {subscriber for followers in self._subscribers.values() for subscriber in followers}
+        for subscriber in subscribers:
+            subscriber.reset = True
+            subscriber.events.clear()
+            wake(subscriber)
+
+    def replay(self, subscriber: Subscriber, last_event_id: str):
+        """Events after `last_event_id` on the subscriber's channels, or None if they can't be told."""
+        epoch, _, position = last_event_id.partition("-")
+        if epoch != self.epoch or not position.isdigit():
+            return None
+        position = int(position)
+        with self._lock:
+            recent = list(self._recent)
+            last_id = self._last_id
+        oldest = recent[0][0] if recent else last_id + 1
+        if not oldest - 1 <= position <= last_id:
+            return None
+        return [event for number, channel, event in recent if number > position and channel in subscriber.channels]
+
+def wake(subscriber: Subscriber):
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is subscriber.loop:
+        subscriber.ready.set()
+    elif not subscriber.loop.is_closed():
+        subscriber.loop.call_soon_threadsafe(subscriber.ready.set)
+
+broker = Broker(settings.task_events_replay_size, settings.task_events_buffer_size)
+
+def encode(channel: tuple, event: dict):
+    payload = orjson.dumps({"channel": channel, "event": event})
+    if len(payload) > NOTIFY_MAX_BYTES:
+        # too many ids for one notification, clients refetch the owner's tasks instead
+        payload = orjson.dumps({"channel": channel, "event": {**event, "ids": None}})
+    return payload.decode()
+
+def notify(engine, payload: str):
+    with engine.begin() as connection:
+        connection.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": NOTIFY_CHANNEL, "payload": payload})
+
+async def publish(channel: tuple, event: dict):
+    if settings.task_events_backend == "postgresql":
+        # to the database the listeners are on
+        await run_in_threadpool(notify, listener.engine, encode(channel, event))
+    else:
+        broker.deliver(channel, event)
+
+async def task_event(type: str, owner_id: int, ids=None, **fields):
+    """For a committed change of `owner_id`'s tasks, `ids` None when they're too many to list."""
+    await publish(tasks_channel(owner_id), {"type": type, "owner_id": owner_id, "ids": ids, **fields})
+
+async def share_event(owner_id: int, user_id: int, shared: bool):
+    await publish(shares_channel(user_id), {"type": "shared" if shared else "unshared", "owner_id": owner_id})
+
+class NotifyListener:
+    """LISTENs on a connection of its own, outside the pool, and delivers notifications to the broker.
+
+    The connection is read from the event loop whenever it becomes readable, so it takes no thread.
+    """
+
+    def __init__(self, engine, retry_seconds: float = 5):
+        self.engine = engine
+        self.retry_seconds = retry_seconds
+        self._connection = None
+        self._retry = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        try:
+            cargs, cparams = self.engine.dialect.create_connect_args(self.engine.url)
+            connection = self.engine.dialect.dbapi.connect(*cargs, **cparams)
+            connection.autocommit = True
+            connection.cursor().execute(f"LISTEN {NOTIFY_CHANNEL}")
+        except Exception:
+            logger.exception("Listening for task events failed, retrying in %s seconds", self.retry_seconds)
+            self._retry = loop.call_later(self.retry_seconds, self.start)
+            return
+        self._connection = connection
+        loop.add_reader(connection.fileno(), self._read)
+
+    def _read(self):
+        try:
+            self._connection.poll()
+        except Exception:
+            logger.exception("Lost the task events connection, reconnecting")
+            self.stop()
+            # whatever was published meanwhile is lost
+            broker.reset_all()
+            self.start()
+            return
+        while self._connection.notifies:
+            notification = self._connection.notifies.pop(0)
+            message = orjson.loads(notification.payload)
+            broker.deliver(tuple(message["channel"]), message["event"])
+
+    def stop(self):
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        if self._connection is not None:
+            asyncio.get_running_loop().remove_reader(self._connection.fileno())
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+            self._connection = None
+
+listener = NotifyListener(database.engine)
+
+def format_event(event: dict):
+    data = orjson.dumps({key: value for key, value in event.items() if key != "id"}).decode()
+    if "id" in event:
+        return f"id: {event['id']}\nevent: {event['type']}\ndata: {data}\n\n"
+    return f"event: {event['type']}\ndata: {data}\n\n"
+
+async def stream(subscriber: Subscriber, last_event_id: str = None, keepalive_seconds: float = 15):
+    """Server-sent events for `subscriber` until the client goes away."""
+    try:
+        if last_event_id:
+            events = broker.replay(subscriber, last_event_id)
+            for event in events if events is not None else [{"type": "reset"}]:
+                yield format_event(event)
+        else:
+            # ends the response headers' wait, EventSource only reports open on the first bytes
+            yield ": connected\n\n"
+        while True:
+            try:
+                await asyncio.wait_for(subscriber.ready.wait(), keepalive_seconds)
+            except asyncio.TimeoutError:
+                # keeps proxies from closing the idle connection
+                yield ": keepalive\n\n"
+                continue
+            for event in subscriber.drain():
+                yield format_event(event)
+    finally:
+        broker.unsubscribe(subscriber)
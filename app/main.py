@@ -1,16 +1,56 @@
-from fastapi import FastAPI
-from . import models
-from .database import engine
-from .routers import task, user, auth
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, status
+from fastapi.responses import JSONResponse
+from . import archive, database, events, metrics, ratelimit, shards, utils, writebehind
+from .config import settings
+from .routers import task, user, auth, health, metrics as metrics_router
 
-models.Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if settings.task_status_write_behind:
+        writebehind.queue.start()
+    if settings.task_events_backend == "postgresql":
+        events.listener.start()
+    if settings.task_archive_enabled:
+        archive.archiver.start()
+    yield
+    await archive.archiver.stop()
+    events.listener.stop()
+    # write the queued toggles before the worker exits
+    await writebehind.queue.stop()
+    utils.hashing_pool.shutdown()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(database.PrimaryCookieMiddleware)
 
 app.include_router(task.router)
 app.include_router(user.router)
 app.include_router(auth.router)
+app.include_router(health.router)
+app.include_router(metrics_router.router)
+
+@app.exception_handler(utils.HashingPoolBusy)
+def hashing_pool_busy(request: Request, exc: utils.HashingPoolBusy):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Server is busy, try again later"},
+        headers={"Retry-After": str(exc.retry_after)})
+
+@app.exception_handler(ratelimit.RateLimited)
+def rate_limited(request: Request, exc: ratelimit.RateLimited):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": "Too many requests, try again later"},
+        headers={"Retry-After": str(exc.retry_after)})
+
+@app.exception_handler(shards.ShardMoving)
+def shard_moving(request: Request, exc: shards.ShardMoving):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Your tasks are being moved, try again shortly"},
+        headers={"Retry-After": str(exc.retry_after)})
 
 @app.get("/")
 def root():
-    return {"message": "Welcome to my API"}
\ No newline at end of file
+    return {"message": "Welcome to my API"}
@@ -0,0 +1,172 @@
+"""Request, query and span timings, rendered in the Prometheus text format at GET /metrics.
+
+Everything is kept in process, per worker, so scrape each worker (or run one worker per container).
+"""
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .config import settings
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+slow_query_logger = logging.getLogger("app.slow_query")
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def render(self):
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total in sorted(series):
+            names = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(names + [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(names)} {total}")
+            lines.append(f"{self.name}_count{format_labels(names)} {cumulative}")
+        return lines
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def gauge(name: str, help: str, samples, kind: str = "gauge"):
+    """Lines of a gauge (or counter) from (labels, value) pairs, labels being a list of (name, value)."""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{format_labels(labels)} {value}" for labels, value in samples)
+    return lines
+
+request_seconds = Histogram("http_request_duration_seconds", "Time to serve a request, until its last body chunk.", ("method", "route", "status"))
+request_statements = Histogram("http_request_db_statements", "SQL statements executed per request.", ("route",), STATEMENT_BUCKETS)
+request_db_seconds = Histogram("http_request_db_seconds", "Time spent executing SQL per request.", ("route",))
+statement_seconds = Histogram("db_statement_duration_seconds", "Time to execute a single SQL statement.", ())
+span_seconds = Histogram("span_duration_seconds", "Time spent in instrumented functions.", ("span",))
+
+histograms = [request_seconds, request_statements, request_db_seconds, statement_seconds, span_seconds]
+
+# functions returning more lines for GET /metrics, for state owned by other modules (pools, caches)
+collectors = []
+
+def collector(fn):
+    collectors.append(fn)
+    return fn
+
+def render():
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    for collect in collectors:
+        lines.extend(collect())
+    return "\n".join(lines) + "\n"
+
+def clear():
+    for histogram in histograms:
+        histogram.clear()
+
+def timed(span: str):
+    """Records each call of the decorated (sync) function in span_duration_seconds."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                span_seconds.observe(time.perf_counter() - start, span)
+        return wrapper
+    return decorator
+
+class RequestStats:
+    __slots__ = ("statements", "db_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.db_seconds = 0.0
+
+# set by the middleware, the threadpool and run_sync both run the handler's database work in a copy of this context
+request_stats: ContextVar = ContextVar("request_stats", default=None)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["statement_start"].pop()
+    statement_seconds.observe(elapsed)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += elapsed
+    if settings.slow_query_threshold_ms is not None and elapsed * 1000 >= settings.slow_query_threshold_ms:
+        slow_query_logger.warning("%.1f ms: %s", elapsed * 1000, statement)
+
+@event.listens_for(Engine, "handle_error")
+def drop_failed_statement(context):
+    # after_cursor_execute doesn't run for a statement that raised
+    starts = context.connection.info.get("statement_start") if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so streamed responses are timed until their last chunk."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_stats.reset(token)
+            # the route's template keeps ids out of the labels, FastAPI sets it on the scope once matched
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            request_seconds.observe(elapsed, scope["method"], path, status_code)
+            request_statements.observe(stats.statements, path)
+            request_db_seconds.observe(stats.db_seconds, path)
@@ -1,8 +1,24 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, Boolean
+from sqlalchemy import DDL, BigInteger, Column, DateTime, ForeignKey, Index, Integer, String, Boolean, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql import expression
 from sqlalchemy.sql.sqltypes import TIMESTAMP
-from sqlalchemy.sql.expression import text
 from sqlalchemy.orm import relationship
 from .database import Base
+from . import counters, search
+
+class utcnow(expression.FunctionElement):
+    # server side "now", rendered on SQLite in the exact format SQLAlchemy binds datetimes with
+    # so that stored and bound timestamps compare correctly
+    type = DateTime()
+    inherit_cache = True
+
+@compiles(utcnow)
+def _default_utcnow(element, compiler, **kw):
+    return "now()"
+
+@compiles(utcnow, "sqlite")
+def _sqlite_utcnow(element, compiler, **kw):
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
 
 class Task(Base):
     __tablename__ = "tasks"
@@ -10,11 +26,36 @@ class Task(Base):
     id = Column(Integer, primary_key=True, nullable=False)
     title = Column(String, nullable=False)
     content = Column(String, nullable=False)
-    done = Column(Boolean, server_default='False', nullable=False)
-    created_at = Column(TIMESTAMP(timezone=True), server_default=text('now()'), nullable=False)
+    done = Column(Boolean, server_default=expression.false(), nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=utcnow(), nullable=False)
     owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
     owner = relationship("User")
 
+    __table_args__ = (
+        # backs keyset pagination of an owner's tasks ordered by (created_at, id)
+        Index("ix_tasks_owner_id_created_at_id", "owner_id", "created_at", "id"),
+        # full-text search over title and content, SQLite uses the tasks_fts table below instead
+        Index("ix_tasks_search", search.document(title, content), postgresql_using="gin").ddl_if(dialect="postgresql"),
+        # ids are never reused, so archived tasks can come back with theirs (see app/archive.py)
+        {"sqlite_autoincrement": True},
+    )
+
+class TaskArchive(Base):
+    """Completed tasks moved out of tasks by app/archive.py, with their ids. Only indexed for listing an owner's tasks, and on SQLite for search."""
+    __tablename__ = "tasks_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False, nullable=False)
+    title = Column(String, nullable=False)
+    content = Column(String, nullable=False)
+    done = Column(Boolean, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    owner = relationship("User")
+
+    __table_args__ = (
+        Index("ix_tasks_archive_owner_id_created_at_id", "owner_id", "created_at", "id"),
+    )
+
 class User(Base):
     __tablename__ = "users"
 
@@ -22,4 +63,66 @@ class User(Base):
     username = Column(String, unique=True, nullable=False)
     email = Column(String, unique=True, nullable=False)
     password = Column(String, nullable=False)
-    created_at = Column(TIMESTAMP(timezone=True), server_default=text('now()'), nullable=False)
\ No newline at end of file
+    created_at = Column(TIMESTAMP(timezone=True), server_default=utcnow(), nullable=False)
+
+class TaskShare(Base):
+    """Makes all of an owner's tasks visible to another user, without copying them."""
+    __tablename__ = "task_shares"
+
+    # primary key order backs the "who shares with me" lookup of GET /tasks
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    owner_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=utcnow(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_task_shares_owner_id", "owner_id"),
+    )
+
+class TaskVersion(Base):
+    """Per user counter behind the ETags of GET /tasks, when versions are shared through the database."""
+    __tablename__ = "task_versions"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    version = Column(BigInteger, nullable=False)
+
+class ShardDirectory(Base):
+    """The shard of each user, when shards are placed by directory (see app/shards.py)."""
+    __tablename__ = "shard_directory"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    shard = Column(Integer, nullable=False)
+    # set while the user's tasks are copied to another shard, their writes are refused meanwhile
+    moving = Column(Boolean, server_default=expression.false(), nullable=False)
+
+class TaskIdCounter(Base):
+    """The next task id, when tasks are sharded (see app/shards.py). A single row, on the primary."""
+    __tablename__ = "task_id_counter"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    next_id = Column(BigInteger, nullable=False)
+
+class TaskCounter(Base):
+    """Per user task counts, maintained by the triggers of app/counters.py."""
+    __tablename__ = "task_counters"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    total = Column(BigInteger, nullable=False)
+    done = Column(BigInteger, nullable=False)
+
+for statement in search.SQLITE_FTS_CREATE:
+    event.listen(Task.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+event.listen(Task.__table__, "after_drop", DDL(search.SQLITE_FTS_DROP).execute_if(dialect="sqlite"))
+
+for statement in search.SQLITE_ARCHIVE_FTS_CREATE:
+    event.listen(TaskArchive.__table__, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+event.listen(TaskArchive.__table__, "after_drop", DDL(search.SQLITE_ARCHIVE_FTS_DROP).execute_if(dialect="sqlite"))
+
+# the counter triggers reference both tables, so they're created once all tables are
+for statement in counters.POSTGRESQL_CREATE:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect="postgresql"))
+for statement in counters.SQLITE_CREATE:
+    event.listen(Base.metadata, "after_create", DDL(statement).execute_if(dialect="sqlite"))
+
+event.listen(Base.metadata, "after_drop", DDL(counters.POSTGRESQL_DROP).execute_if(dialect="postgresql"))
@@ -2,8 +2,11 @@ from jose import ExpiredSignatureError, JWSError, jwt
 from datetime import datetime, timedelta
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from . import schemas, database, models
+from sqlalchemy import event
+import hashlib
+import time
+from . import schemas, database, crud, models, metrics
+from .cache import TTLCache
 from .config import settings
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
@@ -13,6 +16,9 @@ SECRET_KEY = settings.secret_key
 ALGORITHM = "HS256" # HMAC SHA256
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# token digest -> schemas.Principal, so authenticated requests skip the JWT decode and the users lookup
+principal_cache = TTLCache(maxsize=settings.principal_cache_size, ttl=settings.principal_cache_ttl_seconds)
+
 def create_access_token(payload: dict):
     plain_payload = payload.copy()
 
@@ -22,6 +28,7 @@ def create_access_token(payload: dict):
 
     return encoded_jwt
 
+@metrics.timed("oauth2.verify_access_token")
 def verify_access_token(token: str, credentials_exception):
     try:
         payload = jwt.decode(token=token, key=SECRET_KEY, algorithms=[ALGORITHM])
@@ -29,7 +36,7 @@ def verify_access_token(token: str, credentials_exception):
 
         if id is None:
             raise credentials_exception
-        token_data = schemas.TokenData(id=str(id))
+        token_data = schemas.TokenData(id=str(id), exp=payload.get("exp"))
     except JWSError:
         raise credentials_exception
     except ExpiredSignatureError:
@@ -37,13 +44,32 @@ def verify_access_token(token: str, credentials_exception):
     
     return token_data
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db = Depends(database.get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED, 
         detail="Could not validate credentials",
         headers={"WWW-Authenticate:": "Bearer"})
-    
+
+    token_digest = hashlib.sha256(token.encode()).digest()
+    principal = principal_cache.get(token_digest)
+    if principal is not None:
+        database.current_user_id.set(principal.id)
+        return principal
+
     token_data = verify_access_token(token, credentials_exception)
-    user = db.query(models.User).filter(models.User.id == token_data.id).first()
-    
-    return user
\ No newline at end of file
+    user = await database.run(db, crud.get_user, int(token_data.id))
+
+    if user is None:
+        raise credentials_exception
+
+    principal = schemas.Principal(id=user.id, username=user.username, email=user.email, created_at=user.created_at)
+    expires_in = token_data.exp - time.time() if token_data.exp is not None else None
+    principal_cache.set(token_digest, principal, owner=user.id, ttl=expires_in)
+    database.current_user_id.set(principal.id)
+
+    return principal
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def invalidate_principal(mapper, connection, target):
+    principal_cache.invalidate(target.id)
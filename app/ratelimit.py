@@ -0,0 +1,110 @@
+"""Token buckets in front of the bcrypt backed endpoints, checked before any hashing.
+
+Every client IP and every username has a bucket holding up to `burst` tokens, refilled at
+`per_minute` tokens a minute. Each login or sign up takes a token from both, and is answered
+429 with a Retry-After once one of them is empty. Concurrency is capped separately by the
+bounded hashing pool (see utils.HashingPool).
+"""
+import math
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from .config import settings
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Too many requests")
+        self.retry_after = retry_after
+
+def refill(tokens: float, updated: float, now: float, burst: int, per_minute: float):
+    return min(burst, tokens + (now - updated) * per_minute / 60)
+
+def wait_seconds(tokens: float, per_minute: float):
+    # until the bucket holds one token again
+    return math.ceil((1 - tokens) * 60 / per_minute)
+
+class MemoryBucketStore:
+    """Buckets of this worker, the least recently used are forgotten (as if full) past `maxsize`."""
+    shared = False
+
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, burst: int, per_minute: float):
+        """Takes a token from `key`'s bucket, returns 0 or the seconds to wait when it's empty."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = refill(tokens, updated, now, burst, per_minute)
+            retry_after = 0 if tokens >= 1 else wait_seconds(tokens, per_minute)
+            self._buckets[key] = (tokens - 1 if not retry_after else tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+class SQLiteBucketStore:
+    """Buckets in a SQLite file, shared by the workers of a host."""
+    shared = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def connection(self):
+        # sqlite3 connections can't be shared between threads, keep one per threadpool thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def take(self, key: str, burst: int, per_minute: float):
+        # wall clock time, monotonic clocks aren't comparable between processes
+        now = time.time()
+        connection = self.connection()
+        # IMMEDIATE takes the write lock up front, so workers can't both spend the last token
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = refill(*row, now, burst, per_minute) if row else burst
+            retry_after = 0 if tokens >= 1 else wait_seconds(tokens, per_minute)
+            connection.execute(
+                "INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                (key, tokens - 1 if not retry_after else tokens, now))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return retry_after
+
+store = SQLiteBucketStore(settings.rate_limit_sqlite_path) if settings.rate_limit_sqlite_path else MemoryBucketStore()
+
+async def take(key: str, burst: int, per_minute: float):
+    if store.shared:
+        return await run_in_threadpool(store.take, key, burst, per_minute)
+    return store.take(key, burst, per_minute)
+
+async def check(request: Request, username: str):
+    """Raises RateLimited when the client's IP or `username` is out of tokens."""
+    if not settings.rate_limit_enabled:
+        return
+    # behind a proxy, run uvicorn with --proxy-headers so this is the client's address
+    client_ip = request.client.host if request.client else "unknown"
+    # the IP bucket first, a flood from one address doesn't drain its victims' username buckets
+    retry_after = await take(f"ip:{client_ip}", settings.rate_limit_ip_burst, settings.rate_limit_ip_per_minute)
+    if not retry_after:
+        retry_after = await take(f"username:{username.lower()}", settings.rate_limit_username_burst, settings.rate_limit_username_per_minute)
+    if retry_after:
+        raise RateLimited(retry_after)
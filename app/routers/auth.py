@@ -1,20 +1,27 @@
-from fastapi import status, Response, HTTPException, Depends, APIRouter
+from fastapi import status, Request, Response, HTTPException, Depends, APIRouter
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from .. import database, models, schemas, utils, oauth2
+from ..database import get_db, run
+from .. import schemas, utils, oauth2, crud, ratelimit
 
 router = APIRouter(tags=['Authentication'])
 
 @router.post("/login", response_model=schemas.Token)
-def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
-    user = db.query(models.User).filter(models.User.username == user_credentials.username).first()
+async def login(request: Request, user_credentials: OAuth2PasswordRequestForm = Depends(), db = Depends(get_db)):
+    await ratelimit.check(request, user_credentials.username)
+
+    user = await run(db, crud.get_user_by_username, user_credentials.username)
 
     if not user:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid credentials")
     
-    isValid = utils.verify(user_credentials.password, user.password)
+    isValid, new_hash = await utils.hashing_pool.run(utils.verify_and_update, user_credentials.password, user.password)
     if not isValid:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
-    
+
     access_token = oauth2.create_access_token({"user_id": user.id})
-    return {"access_token": access_token, "token_type": "bearer"}
\ No newline at end of file
+
+    # the stored hash predates the configured bcrypt cost
+    if new_hash:
+        await run(db, crud.update_user_password, user.id, new_hash)
+
+    return {"access_token": access_token, "token_type": "bearer"}
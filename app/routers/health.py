@@ -0,0 +1,13 @@
+import os
+from fastapi import APIRouter
+from .. import database
+
+router = APIRouter(
+    prefix="/health",
+    tags=['Health']
+)
+
+@router.get("/pool")
+def get_pool_stats():
+    # pools are per worker process, the pid tells workers apart
+    return {"pid": os.getpid(), "pools": database.pool_stats()}
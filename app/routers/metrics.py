@@ -0,0 +1,46 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from .. import database, metrics, utils
+from ..oauth2 import principal_cache
+
+router = APIRouter(
+    tags=['Health']
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# pool_stats() key -> (metric name, type, help)
+POOL_METRICS = {
+    "checked_out": ("db_pool_checked_out", "gauge", "Connections handed out by the pool."),
+    "idle": ("db_pool_idle", "gauge", "Connections waiting in the pool."),
+    "overflow": ("db_pool_overflow", "gauge", "Connections opened beyond the pool size."),
+    "checkouts": ("db_pool_checkouts_total", "counter", "Connections handed out since the pool was created."),
+    "wait_seconds_total": ("db_pool_wait_seconds_total", "counter", "Time checkouts spent waiting for a connection."),
+    "timeouts": ("db_pool_timeouts_total", "counter", "Checkouts that gave up waiting for a connection."),
+}
+
+@metrics.collector
+def pool_metrics():
+    # pools that aren't instrumented (NullPool, StaticPool) only have a status string
+    stats = {name: pool_stats for name, pool_stats in database.pool_stats().items() if "checked_out" in pool_stats}
+    lines = []
+    for key, (name, kind, help) in POOL_METRICS.items():
+        lines.extend(metrics.gauge(name, help, (([("pool", pool)], pool_stats[key]) for pool, pool_stats in stats.items()), kind))
+    return lines
+
+@metrics.collector
+def hashing_pool_metrics():
+    stats = utils.hashing_pool.stats()
+    return (metrics.gauge("password_hash_pending", "Hashing calls running or queued.", [([], stats["pending"])])
+            + metrics.gauge("password_hash_max_pending", "Hashing calls allowed before answering 503.", [([], stats["max_pending"])]))
+
+@metrics.collector
+def principal_cache_metrics():
+    stats = principal_cache.stats()
+    return (metrics.gauge("principal_cache_hits_total", "Authenticated requests served from the principal cache.", [([], stats["hits"])], "counter")
+            + metrics.gauge("principal_cache_misses_total", "Authenticated requests that decoded the token and loaded the user.", [([], stats["misses"])], "counter")
+            + metrics.gauge("principal_cache_entries", "Principals currently cached.", [([], stats["size"])]))
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
@@ -1,119 +1,191 @@
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
-from typing import List, Optional
-from sqlalchemy import func
+from datetime import datetime, timezone
+from fastapi import FastAPI, Request, Response, status, HTTPException, Depends, APIRouter, Header, Query
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
 from sqlalchemy.orm import Session
-from ..database import engine, get_db
-from .. import models, schemas, utils, oauth2
+from typing import List, Literal, Optional
+from ..database import get_db, get_read_db, run, stick
+from .. import schemas, oauth2, pagination, crud, transfer, versions, writebehind, events
+from ..config import settings
 
 router = APIRouter(
     prefix="/tasks",
     tags=['Tasks']
 )
 
-@router.get("/", response_model=List[schemas.TaskResponse])
-def get_tasks(db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user), limit: int = 10, skip: int = 0, search: Optional[str] = ""):
-   tasks = db.query(models.Task).filter(models.Task.owner_id == current_user.id, models.Task.title.contains(search)).limit(limit).offset(skip).all()
-   return tasks
-
-@router.get("/{id}", response_model=schemas.TaskResponse)
-def get_task(id: int, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
-    task = db.query(models.Task).filter(models.Task.id == id).first() # filter is the equivalent of WHERE on a SQL query statement
-    
-    if not task:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"task with id: {id} was not found")
-    
-    if current_user.id != task.owner_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to perform request action")
-    
+def task_fields(fields: Optional[str], include_owner: bool):
+    selected = set(schemas.TASK_FIELDS) if fields is None else {field.strip() for field in fields.split(",") if field.strip()}
+
+    unknown = selected.difference(schemas.TASK_FIELDS)
+    if unknown:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    if not include_owner:
+        selected.discard("owner")
+    return selected
+
+# the route returns its ORJSONResponse as is, `responses` only documents the items (see crud.get_tasks)
+@router.get("/", response_class=ORJSONResponse, responses={status.HTTP_200_OK: {"model": List[schemas.TaskPartial]}})
+async def get_tasks(request: Request, db = Depends(get_read_db), current_user: schemas.Principal = Depends(writebehind.flushed_user), limit: int = Query(10, ge=0), skip: int = Query(0, ge=0), search: Optional[str] = "", ranked: bool = False, cursor: Optional[str] = None, fields: Optional[str] = None, include_owner: bool = True, include_archived: bool = False):
+    # polling clients send back the ETag, unchanged lists are answered before any task query or serialization
+    tag, sharing_owner_ids = await versions.etag(db, current_user.id, request)
+    if versions.not_modified(request, tag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=versions.headers(tag))
+
+    # keyset pagination: pass an empty `cursor` for the first page, then the X-Next-Cursor header of the previous one.
+    # `skip` is the legacy offset path and is ignored whenever a cursor is given.
+    # archived tasks aren't in the search index ranking relies on, see app/archive.py
+    if include_archived and ranked and search:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Ranked search results can't include archived tasks")
+
+    cursor_position = None
+    if cursor is not None:
+        if ranked and search:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Ranked search results can only be paged with skip")
+        if cursor:
+            try:
+                cursor_position = pagination.decode_cursor(cursor)
+            except ValueError:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+
+    # `fields` (comma separated) and include_owner=false narrow both the SELECT and the payload
+    tasks, last_position = await run(db, crud.get_tasks, current_user.id, limit, skip, search, ranked, cursor_position, task_fields(fields, include_owner), include_archived, sharing_owner_ids)
+
+    response = ORJSONResponse(tasks, headers=versions.headers(tag))
+    if not (ranked and search) and len(tasks) == limit and last_position:
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor(*last_position)
+
+    return response
+
+# stats, events, export, import and bulk routes are declared before the /{id} ones so their paths aren't taken for an id
+
+@router.get("/stats", response_model=schemas.TaskStats)
+async def get_task_stats(db = Depends(get_read_db), current_user: schemas.Principal = Depends(writebehind.flushed_user)):
+    return await run(db, crud.get_task_stats, current_user.id)
+
+@router.get("/events", response_class=StreamingResponse)
+async def task_events(db = Depends(get_read_db), current_user: schemas.Principal = Depends(oauth2.get_current_user), last_event_id: Optional[str] = Header(None)):
+    # server-sent events of the caller's and shared tasks, see app/events.py. Subscribe before reading the
+    # shares, so a share made in between is followed either way
+    subscriber = events.broker.subscribe(current_user.id)
+    try:
+        events.broker.follow(subscriber, await run(db, crud.get_sharing_owner_ids, current_user.id))
+    except BaseException:
+        events.broker.unsubscribe(subscriber)
+        raise
+
+    # the session is closed before streaming starts, idle subscribers hold no connection
+    return StreamingResponse(events.stream(subscriber, last_event_id, settings.task_events_keepalive_seconds), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@router.get("/export", response_class=StreamingResponse)
+async def export_tasks(db = Depends(get_read_db), current_user: schemas.Principal = Depends(writebehind.flushed_user), format: Literal["ndjson", "csv"] = "ndjson"):
+    # the stream outlives the request's session, so it reads through a connection of its own
+    engine = await run(db, crud.tasks_engine)
+    if isinstance(db, AsyncSession):
+        chunks = transfer.export_tasks_async(AsyncEngine(engine), current_user.id, format)
+    else:
+        chunks = transfer.export_tasks(engine, current_user.id, format)
+
+    return StreamingResponse(chunks, media_type=transfer.MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="tasks.{format}"'})
+
+@router.post("/import", status_code=status.HTTP_201_CREATED)
+async def import_tasks(request: Request, db = Depends(get_db), current_user: schemas.Principal = Depends(writebehind.flushed_user), format: Literal["ndjson", "csv"] = "ndjson"):
+    # the body is parsed as it arrives and loaded a batch at a time, all in one transaction
+    now = datetime.now(timezone.utc)
+    imported = 0
+    batch = []
+    async for record in transfer.parse_records(request.stream(), format):
+        batch.append(transfer.import_row(record, imported + len(batch) + 1, current_user.id, now))
+        if len(batch) == transfer.BATCH_SIZE:
+            await run(db, transfer.insert_batch, batch)
+            imported += len(batch)
+            batch = []
+
+    if batch:
+        await run(db, transfer.insert_batch, batch)
+        imported += len(batch)
+    await run(db, versions.bump_owner, current_user.id)
+    await run(db, Session.commit)
+    if imported:
+        await events.task_event("created", current_user.id)
+
+    return {"imported": imported}
+
+
+@router.post("/bulk", status_code=status.HTTP_201_CREATED, response_model=schemas.BulkResponse)
+async def create_tasks(bulk: schemas.TaskBulkCreate, db = Depends(get_db), current_user: schemas.Principal = Depends(writebehind.flushed_user)):
+    results = await run(db, crud.create_tasks, current_user.id, bulk.tasks)
+    await publish_bulk("created", current_user.id, results, status.HTTP_201_CREATED)
+    return {"results": results}
+
+@router.patch("/bulk", response_model=schemas.BulkResponse)
+async def update_tasks_status(bulk: schemas.TaskBulkStatus, db = Depends(get_db), current_user: schemas.Principal = Depends(writebehind.flushed_user)):
+    results = await run(db, crud.update_tasks_status, current_user.id, bulk.ids, bulk.done)
+    await publish_bulk("status", current_user.id, results, status.HTTP_200_OK, done=bulk.done)
+    return {"results": results}
+
+@router.delete("/bulk", response_model=schemas.BulkResponse)
+async def delete_tasks(bulk: schemas.TaskBulkDelete, db = Depends(get_db), current_user: schemas.Principal = Depends(writebehind.flushed_user)):
+    results = await run(db, crud.delete_tasks, current_user.id, bulk.ids)
+    await publish_bulk("deleted", current_user.id, results, status.HTTP_204_NO_CONTENT)
+    return {"results": results}
+
+async def publish_bulk(type: str, owner_id: int, results: list, success_status: int, **fields):
+    ids = [result.id for result in results if result.status == success_status]
+    if ids:
+        await events.task_event(type, owner_id, ids, **fields)
+
+@router.get("/{id}", response_model=schemas.TaskPartial, response_model_exclude_unset=True)
+async def get_task(id: int, request: Request, response: Response, db = Depends(get_read_db), current_user: schemas.Principal = Depends(writebehind.flushed_user), fields: Optional[str] = None, include_owner: bool = True):
+    tag, sharing_owner_ids = await versions.etag(db, current_user.id, request)
+    if versions.not_modified(request, tag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=versions.headers(tag))
+
+    task = await run(db, crud.get_task, id, current_user.id, task_fields(fields, include_owner), sharing_owner_ids)
+    response.headers.update(versions.headers(tag))
     return task
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.TaskResponse)
-def create_task(task: schemas.TaskCreate, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
-    new_task = models.Task(owner_id=current_user.id, **task.dict())
-    db.add(new_task)
-    db.commit()
-    db.refresh(new_task)
-
+async def create_task(task: schemas.TaskCreate, db = Depends(get_db), current_user: schemas.Principal = Depends(writebehind.flushed_user)):
+    new_task = await run(db, crud.create_task, current_user, task)
+    await events.task_event("created", current_user.id, [new_task.id])
     return new_task
 
 @router.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_task(id: int, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
-    task_query = db.query(models.Task).filter(models.Task.id == id)
-
-    quered_task = task_query.first()
-
-    if quered_task == None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"task with id {id} does not exist")
-    
-    if current_user.id != quered_task.owner_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to perform request action")
-    
-    task_query.delete(synchronize_session=False)
-    db.commit()
+async def delete_task(id: int, db = Depends(get_db), current_user: schemas.Principal = Depends(writebehind.flushed_user)):
+    await run(db, crud.delete_task, id, current_user.id)
+    await events.task_event("deleted", current_user.id, [id])
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 @router.put("/{id}", response_model=schemas.TaskResponse)
-def update_task(id: int, task: schemas.TaskCreate, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
-    task_query = db.query(models.Task).filter(models.Task.id==id)
-    
-    updated_task = task_query.first()
-
-    if updated_task == None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"task with id {id} does not exist")
-    
-    if current_user.id != updated_task.owner_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to perform request action")
-    
-    task_query.update(task.dict(), synchronize_session=False)
-    db.commit()
-
-    return task_query.first()
+async def update_task(id: int, task: schemas.TaskCreate, db = Depends(get_db), current_user: schemas.Principal = Depends(writebehind.flushed_user)):
+    updated_task = await run(db, crud.update_task, id, current_user, task)
+    await events.task_event("updated", current_user.id, [id])
+    return updated_task
 
 @router.patch("/{id}", status_code=status.HTTP_200_OK)
-def update_task_status(id: int, status: schemas.TaskStatus, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
-    task_query = db.query(models.Task).filter(models.Task.id==id)
-    
-    updated_task = task_query.first()
-
-    if updated_task == None:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"task with id {id} does not exist")
-    
-    if current_user.id != updated_task.owner_id:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to perform request action")
-    
-    task_query.update({'done': status.done}, synchronize_session=False)
-    db.commit()
+async def update_task_status(id: int, status: schemas.TaskStatus, response: Response, db = Depends(get_db), current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+    if settings.task_status_write_behind:
+        # accepted, written with the next flush (see app/writebehind.py)
+        if writebehind.queue.add(id, current_user.id, status.done):
+            await writebehind.queue.flush()
+        # the toggle commits after this response, keep reading from the primary until it has replicated
+        stick(current_user.id, writebehind.queue.flush_seconds + settings.replica_sticky_seconds)
+        # the event goes out once the toggle is written
+        response.status_code = 202
+    else:
+        await run(db, crud.update_task_status, id, current_user.id, status.done)
+        await events.task_event("status", current_user.id, [id], done=status.done)
 
     message = "task marked as done" if status.done else "task marked as undone"
     
     return {"status": message}
 
 @router.post("/share")
-def share_tasks(task_share: schemas.TaskShare, db: Session = Depends(get_db), current_user: models.User = Depends(oauth2.get_current_user)):
-    # buggy implemenetation, did not have enough time to debug / think this one through since time is tight
-
-    user_to_share = db.query(models.User).filter(models.User.email == task_share.email).first()
-    if not user_to_share:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-
-    if user_to_share.id == current_user.id:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Cannot share tasks with yourself")
-
-    if task_share.share:
-        current_user_tasks = db.query(models.Task).filter(models.Task.owner_id == current_user.id).all()
-        for task in current_user_tasks:
-            new_task = models.Task(title=task.title, content=task.content, done = task.done, owner_id=user_to_share.id)
-            db.add(new_task)
-        db.commit()
-        return {"message": "Tasks shared successfully"}
-
-    else:
-        task_ids_to_unshare = db.query(models.Task.id).filter(models.Task.owner_id == current_user.id).subquery()
-        
-        db.query(models.Task).filter(
-            models.Task.owner_id == current_user.id,
-            models.Task.id.in_(task_ids_to_unshare)
-        ).delete(synchronize_session=False)
-        db.commit()
-        return {"message": "Tasks unshared successfully"}
\ No newline at end of file
+async def share_tasks(task_share: schemas.TaskShare, db = Depends(get_db), current_user: schemas.Principal = Depends(writebehind.flushed_user)):
+    user_id, message = await run(db, crud.share_tasks, current_user.id, task_share)
+    await events.share_event(current_user.id, user_id, task_share.share)
+    return message
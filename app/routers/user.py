@@ -1,7 +1,6 @@
-from fastapi import FastAPI, Response, status, HTTPException, Depends, APIRouter
-from sqlalchemy.orm import Session
-from ..database import engine, get_db
-from .. import models, schemas, utils
+from fastapi import FastAPI, Request, Response, status, HTTPException, Depends, APIRouter
+from ..database import get_db, get_read_db, run
+from .. import models, schemas, utils, crud, ratelimit
 
 router = APIRouter(
     prefix="/users",
@@ -9,26 +8,19 @@ router = APIRouter(
 )
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.UserResponse)
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    hashed_password = utils.hash(user.password)
-    user.password = hashed_password
-
-    user_exists = db.query(models.User).filter(models.User.email == user.email, models.User.username == user.username).first()
+async def create_user(request: Request, user: schemas.UserCreate, db = Depends(get_db)):
+    await ratelimit.check(request, user.username)
 
-    if user_exists:
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"User with these credentials already exists")
+    hashed_password = await utils.hashing_pool.run(utils.hash, user.password)
+    user.password = hashed_password
 
-    new_user = models.User(**user.dict())
-    db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
-    return new_user
+    return await run(db, crud.create_user, user)
 
 @router.get("/{id}", response_model=schemas.UserResponse)
-def get_user(id: int, db: Session = Depends(get_db)):
-    user = db.query(models.User).filter(models.User.id == id).first()
+async def get_user(id: int, db = Depends(get_read_db)):
+    user = await run(db, crud.get_user, id)
 
     if not user:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"user with id {id} not found")
     
-    return user
\ No newline at end of file
+    return user
@@ -1,6 +1,9 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
 from datetime import datetime
-from typing import Optional
+from typing import List, Optional
+
+# upper bound on the number of items a single bulk request may carry
+BULK_MAX_ITEMS = 10000
 
 class UserCreate(BaseModel):
     username: str
@@ -13,8 +16,7 @@ class UserResponse(BaseModel):
     email: EmailStr
     created_at: datetime
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
 
 class UserLogin(BaseModel):
     username: str
@@ -29,18 +31,61 @@ class TaskBase(BaseModel):
 class TaskCreate(TaskBase):
     pass
 
+class TaskImport(TaskBase):
+    # restores keep their original creation time
+    created_at: Optional[datetime] = None
+
 class TaskResponse(TaskBase):
     created_at: datetime
     id: int
     owner_id: int
     owner: UserResponse
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+# what GET /tasks/ and GET /tasks/{id} can be narrowed to with `fields`
+TASK_FIELDS = ("id", "title", "content", "done", "created_at", "owner_id", "owner")
+
+class TaskPartial(BaseModel):
+    """A TaskResponse narrowed to the requested fields, unset ones are left out of the response."""
+    id: Optional[int] = None
+    title: Optional[str] = None
+    content: Optional[str] = None
+    done: Optional[bool] = None
+    created_at: Optional[datetime] = None
+    owner_id: Optional[int] = None
+    owner: Optional[UserResponse] = None
 
 class TaskStatus(BaseModel):
     done: bool = False
 
+class TaskBulkCreate(BaseModel):
+    tasks: List[TaskCreate] = Field(min_length=1, max_length=BULK_MAX_ITEMS)
+
+class TaskBulkStatus(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=BULK_MAX_ITEMS)
+    done: bool = False
+
+class TaskBulkDelete(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=BULK_MAX_ITEMS)
+
+class BulkItemResult(BaseModel):
+    id: int
+    status: int
+    detail: Optional[str] = None
+
+class BulkResponse(BaseModel):
+    results: List[BulkItemResult]
+
+class TaskCounts(BaseModel):
+    total: int
+    done: int
+    open: int
+
+class TaskStats(TaskCounts):
+    # tasks of the owners sharing with the caller
+    shared: TaskCounts
+
 class TaskShare(BaseModel):
     email: EmailStr
     share: bool
@@ -50,4 +95,14 @@ class Token(BaseModel):
     token_type: str
 
 class TokenData(BaseModel):
-    id: Optional[str] = None
\ No newline at end of file
+    id: Optional[str] = None
+    exp: Optional[int] = None
+
+class Principal(BaseModel):
+    """The authenticated caller, detached from any database session."""
+    id: int
+    username: str
+    email: str
+    created_at: datetime
+
+    model_config = ConfigDict(frozen=True)
\ No newline at end of file
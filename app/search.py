@@ -0,0 +1,63 @@
+import re
+from sqlalchemy import literal_column, table, column, func
+
+def sqlite_fts_create(table_name: str):
+    """An external-content FTS5 index of `table_name`'s title and content, and the triggers keeping it in sync."""
+    fts = f"{table_name}_fts"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(title, content, content='{table_name}', content_rowid='id')",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table_name} BEGIN
+        INSERT INTO {fts}(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table_name} BEGIN
+        INSERT INTO {fts}({fts}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+        f"""CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF title, content ON {table_name} BEGIN
+        INSERT INTO {fts}({fts}, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO {fts}(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    ]
+
+# SQLite keeps external-content FTS5 indexes of tasks and of archived tasks in sync through triggers,
+# so both match the same words
+SQLITE_FTS_CREATE = sqlite_fts_create("tasks")
+SQLITE_FTS_DROP = "DROP TABLE IF EXISTS tasks_fts"
+SQLITE_ARCHIVE_FTS_CREATE = sqlite_fts_create("tasks_archive")
+SQLITE_ARCHIVE_FTS_DROP = "DROP TABLE IF EXISTS tasks_archive_fts"
+
+# table name -> its FTS5 index
+fts_indexes = {name: table(f"{name}_fts", column("rowid"), column("rank")) for name in ("tasks", "tasks_archive")}
+
+def terms(search: str):
+    return re.findall(r"\w+", search or "")
+
+def document(title, content):
+    # must stay identical to the expression of the ix_tasks_search index for PostgreSQL to use it
+    return func.to_tsvector(literal_column("'simple'"), title.concat(literal_column("' '")).concat(content))
+
+def apply(task_query, Task, dialect: str, search: str):
+    """Restrict `task_query` to tasks whose title or content has words starting with every term of `search`.
+
+    Returns the filtered query and an expression ordering it by relevance, or `None` when there
+    is nothing to rank by. A `search` without any terms leaves the query untouched. `Task` is the
+    model of tasks or of archived tasks, on other databases their rows are matched by substring.
+    """
+    search_terms = terms(search)
+    if not search_terms:
+        return task_query, None
+
+    if dialect == "postgresql":
+        tsquery = func.to_tsquery(literal_column("'simple'"), " & ".join(f"{term}:*" for term in search_terms))
+        tsvector = document(Task.title, Task.content)
+        return task_query.filter(tsvector.op("@@")(tsquery)), func.ts_rank(tsvector, tsquery).desc()
+
+    if dialect == "sqlite":
+        fts = fts_indexes[Task.__tablename__]
+        match = " ".join('"{}"*'.format(term.replace('"', '""')) for term in search_terms)
+        task_query = task_query.join(fts, fts.c.rowid == Task.id).filter(literal_column(fts.name).op("MATCH")(match))
+        # FTS5's rank is bm25, lower is more relevant
+        return task_query, fts.c.rank
+
+    for term in search_terms:
+        task_query = task_query.filter(Task.title.contains(term, autoescape=True) | Task.content.contains(term, autoescape=True))
+    return task_query, None
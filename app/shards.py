@@ -0,0 +1,330 @@
+"""Owner based sharding: every user's tasks live in one of several databases, the user's shard.
+
+Shard 0 is the primary database. It keeps users, shares, task versions and the shard directory,
+plus the tasks of the users placed on it. The other shards hold the tasks and task counters of
+their users. Each shard also has copies of its users' rows, so the tasks' foreign key and the
+owner join work there. The copies have no password.
+
+Sessions route statements on tasks, archived tasks and task counters to the shard of the current
+user, unless a shard is passed as a bind argument. A recipient's view of shared tasks gathers
+them from the owners' shards. Task ids come from a single counter on the primary, which each
+worker takes blocks of TASK_ID_BLOCK ids from, so they're unique across shards. An id doesn't
+name a shard: a task is looked for on the shards of the users who may see it.
+
+"hash" places a user by a hash of their id, so changing the number of shards moves users. Stop
+the app, change the shards, run ``rebalance``, then start it again. "directory" places users with
+the rows of shard_directory. New users get their hash shard there, users without a row are on
+shard 0, and ``move-user`` moves a user while the app runs. During a move the user's writes are
+answered 503 and their reads come from the old shard. Moved tasks keep their ids.
+
+    python -m app.shards init               # migrate every shard and start the task id counter
+    python -m app.shards status             # users and tasks per shard
+    python -m app.shards move-user 42 2     # directory map only
+    python -m app.shards rebalance          # hash: move everyone to their shard, directory: even out tasks
+"""
+import argparse
+import math
+import pathlib
+import threading
+import time
+import zlib
+from sqlalchemy import column, event, func, insert, inspect, select, table, update
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.util import find_tables
+from .cache import TTLCache
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# ids a worker takes from the counter at a time, those it hasn't handed out when it stops are skipped
+TASK_ID_BLOCK = 1000
+
+# session.info key of the rest of the id block reserved in the session's transaction
+PENDING_IDS = "pending_task_ids"
+
+SHARDED_TABLES = {"tasks", "tasks_archive", "task_counters"}
+
+# the directory is read below the ORM, this module is imported before the models
+directory = table("shard_directory", column("user_id"), column("shard"), column("moving"))
+id_counter = table("task_id_counter", column("id"), column("next_id"))
+
+class ShardMoving(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("User is being moved to another shard")
+        self.retry_after = retry_after
+
+def is_sharded(mapper=None, clause=None):
+    """Whether a statement for `mapper`, or on the tables of `clause`, reads or writes sharded tables."""
+    if mapper is not None:
+        return getattr(getattr(inspect(mapper, raiseerr=False), "local_table", None), "name", None) in SHARDED_TABLES
+    if clause is not None:
+        # core statements, like the column selects of get_tasks, come without a mapper
+        return any(getattr(table, "name", None) in SHARDED_TABLES for table in find_tables(clause, check_columns=True, include_crud=True))
+    return False
+
+class ShardRouter:
+    """Tells the shard of a user, engines[0] being the primary database."""
+
+    def __init__(self, engines: list, shard_map: str, cache_seconds: float):
+        self.engines = engines
+        self.shard_map = shard_map
+        self.cache_seconds = cache_seconds
+        # user id -> (shard, moving), directory map only
+        self._placements = TTLCache(maxsize=100000, ttl=cache_seconds)
+        # the next id of the block taken from the counter, and the end of that block
+        self._next_id = self._block_end = 0
+        self._ids_lock = threading.Lock()
+
+    def hashed(self, user_id: int):
+        # crc32 rather than hash(), every process must agree
+        return zlib.crc32(user_id.to_bytes(8, "big")) % len(self.engines)
+
+    def cached(self, user_id: int):
+        """The (shard, moving) of `user_id` if known without a query, or None."""
+        if self.shard_map == "hash":
+            return self.hashed(user_id), False
+        return self._placements.get(user_id)
+
+    def placement(self, user_id: int):
+        placement = self.cached(user_id)
+        if placement is None:
+            with self.engines[0].connect() as connection:
+                row = connection.execute(select(directory.c.shard, directory.c.moving).where(directory.c.user_id == user_id)).first()
+            placement = (row.shard, bool(row.moving)) if row else (0, False)
+            self._placements.set(user_id, placement)
+        return placement
+
+    def shard_of(self, user_id: int):
+        return self.placement(user_id)[0]
+
+    def writable_shard_of(self, user_id: int):
+        shard, moving = self.placement(user_id)
+        if moving:
+            raise ShardMoving(max(1, math.ceil(self.cache_seconds)))
+        return shard
+
+    def new_task_ids(self, db, count: int):
+        """`count` task ids no shard has handed out, in increasing order within a block.
+
+        A new block is reserved in `db`'s own transaction on the primary: a transaction of its own
+        would wait for `db`'s on SQLite once `db` wrote there. The rest of such a block is handed out
+        to other sessions only once `db` committed, see keep_task_ids. Until then the counter row stays
+        locked, which other writers notice once per block.
+        """
+        ids = []
+        pending = db.info.get(PENDING_IDS)
+        while len(ids) < count:
+            with self._ids_lock:
+                taken = min(count - len(ids), self._block_end - self._next_id)
+                ids.extend(range(self._next_id, self._next_id + taken))
+                self._next_id += taken
+            if len(ids) == count:
+                break
+            if not pending:
+                size = max(TASK_ID_BLOCK, count - len(ids))
+                end = db.connection(bind_arguments={"shard": 0}).scalar(
+                    update(id_counter).values(next_id=id_counter.c.next_id + size).returning(id_counter.c.next_id))
+                pending = range(end - size, end)
+            taken = pending[:count - len(ids)]
+            ids.extend(taken)
+            pending = db.info[PENDING_IDS] = pending[len(taken):]
+        return ids
+
+    def keep_task_ids(self, ids: range):
+        with self._ids_lock:
+            self._next_id, self._block_end = ids.start, ids.stop
+
+    def clear(self):
+        self._placements.clear()
+
+@event.listens_for(Session, "after_commit")
+def keep_task_ids(session):
+    # the block is the router's to hand out once the counter moved past it for good
+    pending = session.info.pop(PENDING_IDS, None)
+    router = getattr(session, "shard_router", None)
+    if pending and router is not None:
+        router.keep_task_ids(pending)
+
+@event.listens_for(Session, "after_rollback")
+def discard_task_ids(session):
+    # the counter is back where it was, the block may be handed out again
+    session.info.pop(PENDING_IDS, None)
+
+def start_task_ids(router: ShardRouter):
+    """Starts the task id counter after every task id of every shard, unless it's already there."""
+    from . import models
+    last = 0
+    for engine in router.engines:
+        with engine.connect() as connection:
+            for model in (models.Task, models.TaskArchive):
+                last = max(last, connection.scalar(select(func.coalesce(func.max(model.id), 0))))
+    with router.engines[0].begin() as connection:
+        current = connection.scalar(select(id_counter.c.next_id).where(id_counter.c.id == 1))
+        if current is None:
+            connection.execute(insert(id_counter).values(id=1, next_id=last + 1))
+        elif current <= last:
+            connection.execute(update(id_counter).where(id_counter.c.id == 1).values(next_id=last + 1))
+
+def place_user(db, router: ShardRouter, user):
+    """Places a new user on their hash shard and copies their row there, in `db`'s transaction."""
+    from . import models
+    shard = router.hashed(user.id)
+    if router.shard_map == "directory":
+        db.execute(insert(directory).values(user_id=user.id, shard=shard, moving=False))
+    if shard:
+        db.execute(insert(models.User).values(id=user.id, username=user.username, email=user.email, created_at=user.created_at, password=""),
+                   bind_arguments={"shard": shard})
+    return shard
+
+def copy_users(router: ShardRouter, shard: int, user_ids):
+    """Copies the rows of `user_ids` from the primary to `shard`, where missing."""
+    from . import models
+    user_ids = list(user_ids)
+    if not shard or not user_ids:
+        return
+    users = models.User.__table__
+    with router.engines[0].connect() as primary, router.engines[shard].begin() as target:
+        for start in range(0, len(user_ids), 1000):
+            batch = user_ids[start:start + 1000]
+            present = set(target.scalars(select(users.c.id).where(users.c.id.in_(batch))))
+            rows = primary.execute(select(users.c.id, users.c.username, users.c.email, users.c.created_at)
+                                   .where(users.c.id.in_([id for id in batch if id not in present]))).mappings().all()
+            if rows:
+                target.execute(users.insert(), [{**row, "password": ""} for row in rows])
+
+def move_tasks(router: ShardRouter, user_id: int, source: int, target: int, batch_size: int = 1000):
+    """Copies the user's tasks, archived ones included, from `source` to `target` with their ids, then deletes them from `source`."""
+    from . import models
+    tasks, archived = models.Task.__table__, models.TaskArchive.__table__
+    copy_users(router, target, [user_id])
+    moved = 0
+    with router.engines[source].connect() as reader, router.engines[target].begin() as writer:
+        for table in (tasks, archived):
+            rows = reader.execute(select(table).where(table.c.owner_id == user_id).order_by(table.c.id))
+            for batch in rows.mappings().partitions(batch_size):
+                writer.execute(table.insert(), [dict(row) for row in batch])
+                moved += len(batch)
+    with router.engines[source].begin() as connection:
+        connection.execute(tasks.delete().where(tasks.c.owner_id == user_id))
+        connection.execute(archived.delete().where(archived.c.owner_id == user_id))
+        if source:
+            connection.execute(models.User.__table__.delete().where(models.User.__table__.c.id == user_id))
+    return moved
+
+def set_placement(router: ShardRouter, user_id: int, shard: int, moving: bool):
+    from . import models
+    with router.engines[0].begin() as connection:
+        connection.execute(models.ShardDirectory.__table__.delete().where(models.ShardDirectory.user_id == user_id))
+        connection.execute(models.ShardDirectory.__table__.insert().values(user_id=user_id, shard=shard, moving=moving))
+    router.clear()
+
+def move_user(router: ShardRouter, user_id: int, target: int, grace_seconds: float = None):
+    """Moves a user to `target` while the app runs, directory map only. Returns the tasks moved."""
+    if router.shard_map != "directory":
+        raise ValueError("users can only be moved with the directory shard map, rebalance a hash map instead")
+    grace_seconds = router.cache_seconds if grace_seconds is None else grace_seconds
+    router.clear()
+    source = router.shard_of(user_id)
+    if source == target:
+        return 0
+    # every worker sees the move before the copy starts, and the new shard before the old rows go
+    set_placement(router, user_id, source, moving=True)
+    time.sleep(grace_seconds)
+    try:
+        moved = move_tasks(router, user_id, source, target)
+    except BaseException:
+        set_placement(router, user_id, source, moving=False)
+        raise
+    set_placement(router, user_id, target, moving=False)
+    return moved
+
+def task_owners(router: ShardRouter, shard: int):
+    """Owner id -> task count on `shard`."""
+    from . import models
+    tasks = models.Task.__table__
+    with router.engines[shard].connect() as connection:
+        return dict(connection.execute(select(tasks.c.owner_id, func.count()).group_by(tasks.c.owner_id)).all())
+
+def user_ids(router: ShardRouter):
+    from . import models
+    with router.engines[0].connect() as connection:
+        return list(connection.scalars(select(models.User.id)))
+
+def rebalance(router: ShardRouter, tolerance: float = 0.1, grace_seconds: float = None, log=print):
+    """Hash map: moves every user's tasks to their hash shard, with the app stopped.
+
+    Directory map: moves users from the shard with the most tasks to the one with the fewest,
+    while their difference is above `tolerance` of the average.
+    """
+    moves = 0
+    if router.shard_map == "hash":
+        users = user_ids(router)
+        for shard in range(1, len(router.engines)):
+            copy_users(router, shard, [user_id for user_id in users if router.hashed(user_id) == shard])
+        for shard in range(len(router.engines)):
+            for user_id in task_owners(router, shard):
+                target = router.hashed(user_id)
+                if target != shard:
+                    log(f"user {user_id}: {move_tasks(router, user_id, shard, target)} tasks from shard {shard} to {target}")
+                    moves += 1
+        return moves
+
+    while True:
+        owners = [task_owners(router, shard) for shard in range(len(router.engines))]
+        totals = [sum(counts.values()) for counts in owners]
+        fullest, emptiest = totals.index(max(totals)), totals.index(min(totals))
+        gap = totals[fullest] - totals[emptiest]
+        if gap <= tolerance * sum(totals) / len(totals):
+            return moves
+        # the user that brings both shards closest to even, without overshooting
+        candidates = [(count, user_id) for user_id, count in owners[fullest].items() if count <= gap / 2]
+        if not candidates:
+            return moves
+        count, user_id = max(candidates)
+        log(f"user {user_id}: {move_user(router, user_id, emptiest, grace_seconds)} tasks from shard {fullest} to {emptiest}")
+        moves += 1
+
+def migrate(url: str):
+    from alembic import command
+    from alembic.config import Config
+    config = Config(str(ROOT / "alembic.ini"))
+    config.set_main_option("script_location", str(ROOT / "migrations"))
+    config.set_main_option("sqlalchemy.url", url)
+    config.attributes["configure_logger"] = False
+    command.upgrade(config, "head")
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the shards holding the users' tasks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("init", help="migrate every shard and start the task id counter")
+    commands.add_parser("status", help="users and tasks per shard")
+    move = commands.add_parser("move-user", help="move a user to another shard, directory map only")
+    move.add_argument("user_id", type=int)
+    move.add_argument("shard", type=int)
+    balance = commands.add_parser("rebalance", help="move users to their hash shard, or even out a directory map")
+    balance.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    from .database import shard_router
+    if shard_router is None:
+        parser.error("set DATABASE_SHARD_CONNECTION_STRINGS first")
+
+    if args.command == "init":
+        for engine in shard_router.engines:
+            migrate(engine.url.render_as_string(hide_password=False))
+        start_task_ids(shard_router)
+        if shard_router.shard_map == "hash":
+            users = user_ids(shard_router)
+            for shard in range(1, len(shard_router.engines)):
+                copy_users(shard_router, shard, [user_id for user_id in users if shard_router.hashed(user_id) == shard])
+        print(f"{len(shard_router.engines)} shards ready")
+    elif args.command == "status":
+        for shard in range(len(shard_router.engines)):
+            owners = task_owners(shard_router, shard)
+            print(f"shard {shard}: {len(owners)} users with tasks, {sum(owners.values())} tasks")
+    elif args.command == "move-user":
+        print(f"{move_user(shard_router, args.user_id, args.shard)} tasks moved")
+    else:
+        print(f"{rebalance(shard_router, args.tolerance)} users moved")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import csv
+import io
+from datetime import datetime
+import orjson
+from fastapi import HTTPException, status
+from pydantic import ValidationError
+from sqlalchemy import insert, select, union_all
+from sqlalchemy.orm import Session
+from . import crud, models, schemas
+
+# Streaming export and import of a user's tasks, as NDJSON or CSV. Both sides work a batch of rows
+# at a time so memory stays flat whatever the size of the account.
+
+EXPORT_FIELDS = ("id", "title", "content", "done", "created_at")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+BATCH_SIZE = 1000
+
+def export_statement(owner_id: int):
+    # archived tasks are exported with the active ones, a restore brings them all back
+    tasks = union_all(*(select(*(model.__table__.c[field] for field in EXPORT_FIELDS)).where(model.owner_id == owner_id)
+                        for model in (models.Task, models.TaskArchive)))
+    # yield_per streams the result through a server side cursor, BATCH_SIZE rows at a time
+    return (tasks.order_by(tasks.selected_columns.created_at, tasks.selected_columns.id)
+            .execution_options(yield_per=BATCH_SIZE))
+
+def encode(rows, format: str, header: bool = False):
+    if format == "ndjson":
+        return b"".join(orjson.dumps(dict(zip(EXPORT_FIELDS, row))) + b"\n" for row in rows)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    writer.writerows((id, title, content, "true" if done else "false", created_at.isoformat()) for id, title, content, done, created_at in rows)
+    return buffer.getvalue().encode()
+
+def export_tasks(engine, owner_id: int, format: str):
+    """Sync generator of encoded chunks, on its own connection since it outlives the request's session."""
+    with engine.connect() as connection:
+        header = format == "csv"
+        for rows in connection.execute(export_statement(owner_id)).partitions():
+            yield encode(rows, format, header)
+            header = False
+        if header:
+            yield encode([], format, header)
+
+async def export_tasks_async(engine, owner_id: int, format: str):
+    async with engine.connect() as connection:
+        header = format == "csv"
+        result = await connection.stream(export_statement(owner_id))
+        async for rows in result.partitions():
+            yield encode(rows, format, header)
+            header = False
+        if header:
+            yield encode([], format, header)
+
+def invalid_record(record: int, error):
+    return HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid task at record {record}: {error}")
+
+async def ndjson_records(chunks):
+    pending = b""
+    record = 0
+
+    def parse(line):
+        nonlocal record
+        record += 1
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            raise invalid_record(record, e)
+
+    async for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield parse(line)
+    if pending.strip():
+        yield parse(pending)
+
+async def csv_records(chunks):
+    header = None
+    record = ""
+    quotes = 0
+    pending = b""
+    parsed = 0
+
+    def parse(text):
+        nonlocal header, parsed
+        values = next(csv.reader([text]), [])
+        if header is None:
+            header = values
+            return None
+        parsed += 1
+        return dict(zip(header, values))
+
+    def decode(line: bytes):
+        try:
+            return line.decode()
+        except UnicodeDecodeError as e:
+            # the line belongs to the record after the last complete one
+            raise invalid_record(parsed + 1, e)
+
+    async for chunk in chunks:
+        # lines are split before decoding, no multi-byte UTF-8 sequence holds a line break byte
+        lines = (pending + chunk).splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith((b"\n", b"\r")) else b""
+        for line in lines:
+            line = decode(line)
+            record += line
+            quotes += line.count('"')
+            # a line break ends the record unless it sits inside a quoted value
+            if quotes % 2 == 0:
+                if record.strip() and (values := parse(record)) is not None:
+                    yield values
+                record, quotes = "", 0
+
+    record += decode(pending)
+    if record.strip() and (values := parse(record)) is not None:
+        yield values
+
+def parse_records(chunks, format: str):
+    return ndjson_records(chunks) if format == "ndjson" else csv_records(chunks)
+
+def import_row(record, line: int, owner_id: int, now: datetime):
+    try:
+        task = schemas.TaskImport.model_validate(record)
+    except (ValidationError, TypeError) as e:
+        raise invalid_record(line, e)
+    return {"title": task.title, "content": task.content, "done": task.done, "created_at": task.created_at or now, "owner_id": owner_id}
+
+def insert_batch(db: Session, rows: list):
+    """Load a batch into the request's transaction, through COPY when the driver supports it."""
+    # the arguments of the INSERT below, so both paths reach the owner's shard
+    dbapi_connection = db.connection(bind_arguments={"mapper": models.Task, "clause": insert(models.Task)}).connection.dbapi_connection
+    ids = crud.new_task_ids(db, len(rows))
+    if ids:
+        rows = [{"id": id, **row} for id, row in zip(ids, rows)]
+    columns = list(rows[0])
+    cursor = dbapi_connection.cursor()
+    if hasattr(cursor, "copy_expert"):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows([row[column].isoformat() if column == "created_at" else row[column] for column in columns] for row in rows)
+        buffer.seek(0)
+        # csv.writer leaves empty strings unquoted, which COPY would otherwise read as NULL
+        cursor.copy_expert(f"COPY tasks ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (title, content))", buffer)
+        cursor.close()
+        return
+    cursor.close()
+    db.execute(insert(models.Task), rows)
@@ -1,9 +1,106 @@
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from passlib.context import CryptContext
+from . import metrics
+from .config import settings
 
-pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto')
+pwd_context = CryptContext(schemes=['bcrypt'], deprecated='auto', bcrypt__rounds=settings.bcrypt_rounds)
 
 def hash(password: str):
     return pwd_context.hash(password)
 
 def verify(plainPassword: str, hashedPassword: str):
-    return pwd_context.verify(plainPassword, hashedPassword)
\ No newline at end of file
+    return pwd_context.verify(plainPassword, hashedPassword)
+
+def verify_and_update(plainPassword: str, hashedPassword: str):
+    """Like `verify`, also returning a new hash when the stored one doesn't use the configured cost (else None)."""
+    return pwd_context.verify_and_update(plainPassword, hashedPassword)
+
+def _timed(fn, *args):
+    # runs in the worker, so the measured time excludes queueing
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+class HashingPoolBusy(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__("Password hashing pool is saturated")
+        self.retry_after = retry_after
+
+class HashingPool:
+    """Runs bcrypt in dedicated workers with a bounded backlog.
+
+    Calls beyond `workers + queue_size` outstanding ones raise HashingPoolBusy right away
+    instead of queueing, so a login burst can't hold every request thread.
+    """
+
+    def __init__(self, workers: int, queue_size: int, kind: str = "thread"):
+        self.workers = workers
+        self.max_pending = workers + queue_size
+        self.kind = kind
+        self.pending = 0
+        self.timings = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                executor_class = ProcessPoolExecutor if self.kind == "process" else ThreadPoolExecutor
+                self._executor = executor_class(max_workers=self.workers)
+            return self._executor
+
+    async def run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                raise HashingPoolBusy(self.retry_after())
+            self.pending += 1
+
+        submitted = time.perf_counter()
+        try:
+            future = self.executor.submit(_timed, fn, *args)
+        except BaseException:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+
+        result, run_seconds = await asyncio.wrap_future(future)
+        self._record(fn.__name__, time.perf_counter() - submitted, run_seconds)
+        return result
+
+    def retry_after(self):
+        # roughly how long the current backlog takes to drain
+        timings = list(self.timings.values())
+        calls = sum(timing["count"] for timing in timings)
+        average = sum(timing["run_seconds"] for timing in timings) / calls if calls else 1
+        return max(1, math.ceil(self.pending * average / self.workers))
+
+    def stats(self):
+        with self._lock:
+            return {"pending": self.pending, "max_pending": self.max_pending, "timings": {name: dict(timing) for name, timing in self.timings.items()}}
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _release(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    def _record(self, name: str, total_seconds: float, run_seconds: float):
+        with self._lock:
+            timing = self.timings.setdefault(name, {"count": 0, "run_seconds": 0.0, "wait_seconds": 0.0, "max_seconds": 0.0})
+            timing["count"] += 1
+            timing["run_seconds"] += run_seconds
+            timing["wait_seconds"] += max(0.0, total_seconds - run_seconds)
+            timing["max_seconds"] = max(timing["max_seconds"], total_seconds)
+        # measured in the worker, so this works for the process executor too
+        metrics.span_seconds.observe(run_seconds, f"utils.{name}")
+
+hashing_pool = HashingPool(settings.password_hash_workers, settings.password_hash_queue_size, settings.password_hash_executor)
@@ -0,0 +1,124 @@
+"""Per user version counters, so GET /tasks can answer If-None-Match without querying tasks.
+
+Every task mutation bumps its owner's version within its own transaction: the database store
+writes it along with the tasks, the in-process one applies it once the transaction committed.
+Nothing is written for the users the owner shares with. Their ETags are built when read, from
+their own version and those of the owners found in task_shares, so sharing and unsharing change
+them too. Reads take the versions before querying, so a write racing a read can only make an
+ETag stale on the next request, never hide new data behind an old one.
+"""
+import hashlib
+import secrets
+import threading
+from fastapi import Request
+from sqlalchemy import event, func, literal, select, union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from . import models
+from .config import settings
+from .database import run
+
+# session.info key of the users whose in-process versions move on when the session commits
+PENDING = "pending_version_bumps"
+
+def sharing_owner_ids(user_id: int):
+    return select(models.TaskShare.owner_id).where(models.TaskShare.user_id == user_id)
+
+class MemoryVersionStore:
+    """Versions in a dict of this worker, only the owners sharing with a user are read from the database."""
+    shared = False
+
+    def __init__(self):
+        # a fresh epoch per process, so ETags handed out before a restart never match again
+        self.epoch = secrets.token_hex(4)
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def versions(self, db: Session, user_id: int):
+        owner_ids = sorted(db.scalars(sharing_owner_ids(user_id)))
+        with self._lock:
+            return [(id, self._versions.get(id, 0)) for id in (user_id, *owner_ids)]
+
+    def bump(self, db: Session, user_ids):
+        # applied by apply_bumps once the transaction commits, a reader taking the new version
+        # before the tasks are visible would keep an ETag of data it never got
+        db.info.setdefault(PENDING, set()).update(user_ids)
+
+    def apply(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._versions.clear()
+
+class DatabaseVersionStore:
+    """Versions in the task_versions table, seen by every worker."""
+    shared = True
+    epoch = "db"
+
+    def versions(self, db: Session, user_id: int):
+        # the caller and the owners sharing with them, with their versions, in a single statement
+        users = union_all(select(literal(user_id).label("user_id")), sharing_owner_ids(user_id)).subquery()
+        rows = db.execute(select(users.c.user_id, func.coalesce(models.TaskVersion.version, 0))
+                          .outerjoin(models.TaskVersion, models.TaskVersion.user_id == users.c.user_id)).all()
+        return sorted(((id, version) for id, version in rows), key=lambda row: (row[0] != user_id, row[0]))
+
+    def bump(self, db: Session, user_ids):
+        # in the caller's transaction, so the versions commit, or roll back, with the tasks
+        dialect_insert = postgresql.insert if db.get_bind(models.TaskVersion).dialect.name == "postgresql" else sqlite.insert
+        statement = dialect_insert(models.TaskVersion).values([{"user_id": user_id, "version": 1} for user_id in sorted(user_ids)])
+        db.execute(statement.on_conflict_do_update(
+            index_elements=[models.TaskVersion.user_id],
+            set_={"version": models.TaskVersion.version + 1}))
+
+store = DatabaseVersionStore() if settings.task_version_store == "database" else MemoryVersionStore()
+
+@event.listens_for(Session, "after_commit")
+def apply_bumps(session):
+    user_ids = session.info.pop(PENDING, None)
+    if user_ids and isinstance(store, MemoryVersionStore):
+        store.apply(user_ids)
+
+@event.listens_for(Session, "after_rollback")
+def discard_bumps(session):
+    session.info.pop(PENDING, None)
+
+def bump_owner(db: Session, owner_id: int):
+    """Before committing a change of `owner_id`'s tasks, in the same transaction."""
+    bump_owners(db, [owner_id])
+
+def bump_owners(db: Session, owner_ids):
+    store.bump(db, set(owner_ids))
+
+async def etag(db, user_id: int, request: Request):
+    """The ETag of `request` for `user_id`, and the owners sharing with `user_id` it was built from.
+
+    The ETag is None when `db` reads from a replica while the versions live in this worker: they
+    are the primary's, the replica may not have the tasks behind them yet, and a tag pinned on
+    such a body would answer 304 to every later poll.
+    """
+    versions = await run(db, store.versions, user_id)
+    owner_ids = [id for id, _ in versions[1:]]
+    session = db.sync_session if isinstance(db, AsyncSession) else db
+    if not store.shared and getattr(session, "replica", None) is not None:
+        return None, owner_ids
+    # the same versions are served in as many representations as there are query strings
+    state = " ".join(f"{id}:{version}" for id, version in versions)
+    digest = hashlib.blake2b(f"{state} {request.url.path}?{request.url.query}".encode(), digest_size=8).hexdigest()
+    return f'"{store.epoch}-{digest}"', owner_ids
+
+def not_modified(request: Request, tag: str):
+    if_none_match = request.headers.get("if-none-match")
+    if tag is None or not if_none_match:
+        return False
+    candidates = {candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")}
+    return tag in candidates or "*" in candidates
+
+def headers(tag: str):
+    # private: the ETag is only meaningful with the caller's token
+    if tag is None:
+        return {"Cache-Control": "private, no-cache"}
+    return {"ETag": tag, "Cache-Control": "private, no-cache"}
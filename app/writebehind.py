@@ -0,0 +1,105 @@
+"""Write behind for PATCH /tasks/{id}, on when settings.task_status_write_behind is set.
+
+Toggles are acknowledged with a 202 as soon as they're queued. Repeated toggles of a task collapse
+into its last value, and the queue is written as one UPDATE every `write_behind_flush_ms`, as soon
+as it holds `write_behind_max_items` tasks, and when the app shuts down. Toggles of unknown or
+foreign tasks are dropped by the owner scoped UPDATE instead of answered with a 404 or 403.
+
+Toggles are only held by the worker that took them: a crash loses up to a flush interval of them.
+Requests of the task's owner write the owner's queued toggles first, so they read their own
+toggles; users the tasks are shared with see them after the next flush.
+"""
+import asyncio
+import logging
+import threading
+from fastapi import Depends
+from fastapi.concurrency import run_in_threadpool
+from . import crud, database, events, oauth2, schemas
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+class ToggleQueue:
+    def __init__(self, flush_seconds: float, max_items: int):
+        self.flush_seconds = flush_seconds
+        self.max_items = max_items
+        # sessions the toggles are written with, tests point this at their own database
+        self.session_factory = database.SessionLocal
+        # task id -> (owner id, done), the last toggle of each task wins
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flushing = asyncio.Lock()
+        self._task = None
+
+    def add(self, id: int, owner_id: int, done: bool):
+        """Queues a toggle, returns whether the queue is full and should be flushed now."""
+        with self._lock:
+            self._pending[id] = (owner_id, done)
+            return len(self._pending) >= self.max_items
+
+    def has_pending(self, owner_id: int):
+        with self._lock:
+            return any(owner == owner_id for owner, _ in self._pending.values())
+
+    def __len__(self):
+        return len(self._pending)
+
+    async def flush(self):
+        # one flush at a time, toggles queued meanwhile go with the next one
+        async with self._flushing:
+            with self._lock:
+                toggles, self._pending = self._pending, {}
+            if not toggles:
+                return
+            try:
+                changed = await run_in_threadpool(self._write, toggles)
+            except Exception:
+                with self._lock:
+                    # put the batch back, behind any newer toggle of the same tasks
+                    self._pending = {**toggles, **self._pending}
+                raise
+            # one status event per owner and value, for the toggles that were written
+            written = {}
+            for id, owner_id in changed:
+                written.setdefault((owner_id, toggles[id][1]), []).append(id)
+            for (owner_id, done), ids in written.items():
+                await events.task_event("status", owner_id, sorted(ids), done=done)
+
+    def _write(self, toggles: dict):
+        with self.session_factory() as db:
+            changed = crud.apply_task_statuses(db, toggles)
+            # nothing was committed by the owners' requests, keep their reads on the primary from now on
+            router = getattr(db, "router", None)
+            if router is not None:
+                for owner_id in {owner_id for _, owner_id in changed}:
+                    router.stick(owner_id)
+        return changed
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Writing %d queued task toggles failed, retrying with the next flush", len(self))
+
+queue = ToggleQueue(settings.write_behind_flush_ms / 1000, settings.write_behind_max_items)
+
+async def flushed_user(current_user: schemas.Principal = Depends(oauth2.get_current_user)):
+    """The current user, once their queued toggles are written, for every task route reading or writing after them."""
+    if queue.has_pending(current_user.id):
+        await queue.flush()
+    return current_user
@@ -0,0 +1,139 @@
+"""Measure the tasks table and GET /tasks before and after archiving completed tasks.
+
+Boots the app on a throwaway SQLite file, seeds ``--users`` users with ``--tasks`` tasks each,
+``--done`` of them (a fraction) completed and created a year ago, then times ``--requests`` task
+listings picked at random, runs the archiver once and times them again::
+
+    python -m benchmarks.bench_archive --users 200 --tasks 500
+
+Prints the rows and bytes of tasks (its indexes included) and of tasks_archive, and the latency of
+a first page, a deep page and a search, with and without include_archived. Pass
+``--database-url`` to run against another database instead.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import httpx
+
+from benchmarks.bench_load import boot, summarize
+
+# operation -> GET /tasks parameters
+LISTINGS = {
+    "first page": {},
+    "deep page": {"skip": 40},
+    "search": {"search": "beta"},
+}
+
+
+def seed(users: int, tasks: int, done: float, rng: random.Random):
+    from sqlalchemy import insert
+    from sqlalchemy.orm import Session
+    from app import models
+    from app.database import engine
+    from app.oauth2 import create_access_token
+
+    now = datetime.now(timezone.utc)
+    with Session(engine) as db:
+        user_ids = db.scalars(insert(models.User).returning(models.User.id), [
+            {"username": f"bench-archive-{n}", "email": f"bench-archive-{n}@example.com", "password": "-"}
+            for n in range(users)]).all()
+        for user_id in user_ids:
+            db.execute(insert(models.Task), [
+                {"title": f"title {n}", "content": f"content {n} {rng.choice(['alpha', 'beta', 'gamma'])}", "owner_id": user_id,
+                 "done": completed, "created_at": now - timedelta(days=365 if completed else rng.random())}
+                for n in range(tasks) for completed in [rng.random() < done]])
+        db.commit()
+    return [{"Authorization": f"Bearer {create_access_token({'user_id': user_id})}"} for user_id in user_ids]
+
+
+def table_sizes():
+    """Table name -> (rows, bytes) for tasks and tasks_archive, indexes included."""
+    from sqlalchemy import text
+    from app.database import engine
+
+    sizes = {}
+    with engine.connect() as connection:
+        for table in ("tasks", "tasks_archive"):
+            rows = connection.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+            if engine.dialect.name == "postgresql":
+                size = connection.execute(text("SELECT pg_total_relation_size(:table)"), {"table": table}).scalar()
+            else:
+                size = connection.execute(text(
+                    "SELECT sum(pgsize) FROM dbstat WHERE name IN (SELECT name FROM sqlite_master WHERE tbl_name = :table)"),
+                    {"table": table}).scalar()
+            sizes[table] = (rows, size or 0)
+    return sizes
+
+
+def vacuum():
+    from sqlalchemy import text
+    from app.database import engine
+
+    # rows deleted from tasks leave free pages behind until then
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.execute(text("VACUUM ANALYZE" if engine.dialect.name == "postgresql" else "VACUUM"))
+
+
+async def measure(app, users: list, requests: int, rng: random.Random, **params):
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for operation, listing in LISTINGS.items():
+            latencies = []
+            errors = 0
+            started = time.perf_counter()
+            for _ in range(requests):
+                start = time.perf_counter()
+                res = await client.get("/tasks/", params={**listing, **params}, headers=rng.choice(users))
+                latencies.append(time.perf_counter() - start)
+                errors += res.status_code >= 400
+            results[operation] = summarize(latencies, errors, time.perf_counter() - started)
+    return results
+
+
+def report(title: str, sizes: dict, results: dict):
+    print(title)
+    for table, (rows, size) in sizes.items():
+        print(f"  {table:<14} {rows:>9} rows {size / 2**20:>8.1f} MiB")
+    for operation, result in results.items():
+        print(f"  {operation:<14} p50 {result['p50_ms']:>7.2f} ms  p95 {result['p95_ms']:>7.2f} ms  errors {result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--tasks", type=int, default=500)
+    parser.add_argument("--done", type=float, default=0.9)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-url")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.environ.setdefault("BCRYPT_ROUNDS", "4")
+        app = boot(args.database_url or f"sqlite:///{directory}/bench_archive.db")
+        from app.archive import Archiver
+        from app.database import engine
+
+        rng = random.Random(args.seed)
+        users = seed(args.users, args.tasks, args.done, rng)
+        vacuum()
+        report("before archiving", table_sizes(), asyncio.run(measure(app, users, args.requests, rng)))
+
+        started = time.perf_counter()
+        archived = Archiver(after_days=30, interval_seconds=0, batch_size=1000).archive_due()
+        print(f"archived {sum(len(ids) for ids in archived.values())} tasks in {time.perf_counter() - started:.1f} s")
+        vacuum()
+        sizes = table_sizes()
+        report("after archiving", sizes, asyncio.run(measure(app, users, args.requests, rng)))
+        report("after archiving, include_archived", sizes, asyncio.run(measure(app, users, args.requests, rng, include_archived=True)))
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Compare the sync (threadpool) and async database stacks under concurrent load.
+
+Starts uvicorn once per mode against the configured database and drives GET /tasks
+with ``--concurrency`` clients for ``--duration`` seconds::
+
+    python -m benchmarks.bench_async --concurrency 200 --duration 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+USER = {"email": "bench-async@example.com", "username": "bench-async", "password": "bench-async"}
+
+
+def serve(database_async: bool, port: int):
+    env = {**os.environ, "DATABASE_ASYNC": str(database_async).lower()}
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        env=env)
+
+
+async def wait_until_up(client: httpx.AsyncClient):
+    for _ in range(100):
+        try:
+            await client.get("/")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+async def authorize(client: httpx.AsyncClient, tasks: int):
+    await client.post("/users/", json=USER)
+    res = await client.post("/login", data={"username": USER["username"], "password": USER["password"]})
+    client.headers["Authorization"] = f"Bearer {res.json()['access_token']}"
+
+    existing = await client.get("/tasks/", params={"limit": tasks})
+    for n in range(tasks - len(existing.json())):
+        await client.post("/tasks/", json={"title": f"title {n}", "content": f"content {n}"})
+
+
+async def drive(base_url: str, concurrency: int, duration: float, tasks: int):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        await wait_until_up(client)
+        await authorize(client, tasks)
+
+        latencies = []
+        errors = 0
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                res = await client.get("/tasks/", params={"limit": 10})
+                latencies.append(time.perf_counter() - start)
+                errors += res.status_code != 200
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return len(latencies) / elapsed, quantiles[49] * 1000, quantiles[98] * 1000, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--tasks", type=int, default=50)
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    print(f"{'mode':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for database_async in (False, True):
+        server = serve(database_async, args.port)
+        try:
+            rps, p50, p99, errors = asyncio.run(drive(f"http://127.0.0.1:{args.port}", args.concurrency, args.duration, args.tasks))
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{'async' if database_async else 'sync':>6} {rps:>8.0f} {p50:>8.1f} {p99:>8.1f} {errors:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Compare syncing ``--items`` tasks one request at a time against the /tasks/bulk endpoints.
+
+Runs the app in process against the configured database::
+
+    python -m benchmarks.bench_bulk --items 1000
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from app.main import app
+
+USER = {"email": "bench-bulk@example.com", "username": "bench-bulk", "password": "bench-bulk"}
+
+
+async def per_item(client: httpx.AsyncClient, tasks: list):
+    ids = []
+    for task in tasks:
+        res = await client.post("/tasks/", json=task)
+        ids.append(res.json()["id"])
+    for id in ids:
+        await client.patch(f"/tasks/{id}", json={"done": True})
+    for id in ids:
+        await client.delete(f"/tasks/{id}")
+
+
+async def bulk(client: httpx.AsyncClient, tasks: list):
+    res = await client.post("/tasks/bulk", json={"tasks": tasks})
+    ids = [result["id"] for result in res.json()["results"]]
+    await client.patch("/tasks/bulk", json={"ids": ids, "done": True})
+    await client.request("DELETE", "/tasks/bulk", json={"ids": ids})
+
+
+async def run(items: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await client.post("/users/", json=USER)
+        res = await client.post("/login", data={"username": USER["username"], "password": USER["password"]})
+        client.headers["Authorization"] = f"Bearer {res.json()['access_token']}"
+
+        tasks = [{"title": f"title {n}", "content": f"content {n}"} for n in range(items)]
+        print(f"{'mode':>9} {'seconds':>8} {'tasks/s':>9}")
+        for name, sync in (("per-item", per_item), ("bulk", bulk)):
+            start = time.perf_counter()
+            await sync(client, tasks)
+            elapsed = time.perf_counter() - start
+            print(f"{name:>9} {elapsed:>8.2f} {items / elapsed:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(run(args.items))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""Drive a mixed workload through every main endpoint and compare it against a saved baseline.
+
+Boots ``app.main.app`` in process against a throwaway SQLite file, seeds ``--users`` users
+with ``--tasks`` tasks each, then runs ``--concurrency`` httpx clients for ``--duration``
+seconds picking login, list, search, create, toggle and share requests by weight::
+
+    python -m benchmarks.bench_load --save-baseline benchmarks/baseline.json
+    python -m benchmarks.bench_load --baseline benchmarks/baseline.json --threshold 0.2
+
+With ``--baseline`` the run exits with status 1 when an operation's p95 latency grew, or its
+throughput shrank, by more than ``--threshold`` (a fraction) compared to the baseline, or when
+more of its requests failed. A baseline saved with other workload options is refused.
+Pass ``--database-url`` to run against another database instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+# operation -> relative weight in the mix
+WORKLOAD = {"login": 1, "list": 10, "search": 4, "create": 3, "toggle": 3, "share": 1}
+
+# options a run is only comparable with a baseline under when they're the same
+CONFIG_KEYS = ("users", "tasks", "concurrency", "duration", "seed")
+
+
+def boot(database_url: str):
+    # settings are read when app is first imported, so the database must be chosen before that
+    os.environ["DATABASE_CONNECTION_STRING"] = database_url
+    os.environ.setdefault("SECRET_KEY", "bench-load")
+    # every simulated client shares one address, the limiter would turn most logins into 429s
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    from alembic import command
+    from alembic.config import Config
+
+    config = Config(str(ROOT / "alembic.ini"))
+    config.set_main_option("script_location", str(ROOT / "migrations"))
+    config.set_main_option("sqlalchemy.url", database_url)
+    config.attributes["configure_logger"] = False
+    command.upgrade(config, "head")
+
+    from app.main import app
+    return app
+
+
+def seed(users: int, tasks: int):
+    from sqlalchemy import insert
+    from sqlalchemy.orm import Session
+    from app import models, utils
+    from app.database import engine
+    from app.oauth2 import create_access_token
+
+    password = utils.hash("bench-load")
+    with Session(engine) as db:
+        accounts = db.execute(insert(models.User).returning(models.User.id, models.User.username), [
+            {"username": f"bench-load-{n}", "email": f"bench-load-{n}@example.com", "password": password}
+            for n in range(users)]).all()
+        for account in accounts:
+            db.execute(insert(models.Task), [
+                {"title": f"title {n}", "content": f"content {n} {random.choice(['alpha', 'beta', 'gamma'])}", "owner_id": account.id}
+                for n in range(tasks)])
+        db.commit()
+        task_ids = {owner_id: task_id for owner_id, task_id in db.query(models.Task.owner_id, models.Task.id)}
+
+    return [{"id": account.id, "username": account.username, "email": f"{account.username}@example.com",
+             "token": create_access_token({"user_id": account.id}), "task_id": task_ids[account.id]}
+            for account in accounts]
+
+
+async def request(client: httpx.AsyncClient, operation: str, user: dict, users: list, rng: random.Random):
+    headers = {"Authorization": f"Bearer {user['token']}"}
+    if operation == "login":
+        return await client.post("/login", data={"username": user["username"], "password": "bench-load"})
+    if operation == "list":
+        return await client.get("/tasks/", params={"limit": 10}, headers=headers)
+    if operation == "search":
+        return await client.get("/tasks/", params={"limit": 10, "search": rng.choice(["alpha", "beta", "gam"])}, headers=headers)
+    if operation == "create":
+        return await client.post("/tasks/", json={"title": "created", "content": "by bench_load"}, headers=headers)
+    if operation == "toggle":
+        return await client.patch(f"/tasks/{user['task_id']}", json={"done": rng.random() < 0.5}, headers=headers)
+    if operation == "share":
+        return await client.post("/tasks/share", json={"email": rng.choice(users)["email"], "share": rng.random() < 0.5}, headers=headers)
+    raise ValueError(operation)
+
+
+async def drive(app, users: list, concurrency: int, duration: float, seed: int):
+    operations = list(WORKLOAD)
+    weights = list(WORKLOAD.values())
+    latencies = {operation: [] for operation in operations}
+    errors = {operation: 0 for operation in operations}
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker(n: int):
+            rng = random.Random(seed + n)
+            while time.perf_counter() < deadline:
+                operation = rng.choices(operations, weights)[0]
+                user = rng.choice(users)
+                start = time.perf_counter()
+                res = await request(client, operation, user, users, rng)
+                latencies[operation].append(time.perf_counter() - start)
+                # sharing with yourself is refused, that is still a served request
+                errors[operation] += res.status_code >= 500 or (res.status_code >= 400 and operation != "share")
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {operation: summarize(latencies[operation], errors[operation], elapsed) for operation in operations if latencies[operation]}
+
+
+def summarize(latencies: list, errors: int, elapsed: float):
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": quantiles[49] * 1000,
+        "p95_ms": quantiles[94] * 1000,
+        "p99_ms": quantiles[98] * 1000,
+        "errors": errors,
+    }
+
+
+def error_rate(result: dict):
+    return result["errors"] / result["requests"] if result["requests"] else 0
+
+
+def regressions(results: dict, baseline: dict, threshold: float):
+    found = []
+    for operation, expected in baseline["operations"].items():
+        actual = results.get(operation)
+        if actual is None:
+            continue
+        # failing requests may well be fast ones, so any more of them than before is a regression of its own
+        if actual["errors"] and error_rate(actual) > error_rate(expected):
+            found.append(f"{operation}: {actual['errors']} errors in {actual['requests']} requests, "
+                         f"baseline {expected['errors']} in {expected['requests']}")
+        if actual["p95_ms"] > expected["p95_ms"] * (1 + threshold):
+            found.append(f"{operation}: p95 {actual['p95_ms']:.1f} ms, baseline {expected['p95_ms']:.1f} ms")
+        if actual["rps"] < expected["rps"] * (1 - threshold):
+            found.append(f"{operation}: {actual['rps']:.0f} req/s, baseline {expected['rps']:.0f} req/s")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--tasks", type=int, default=500, help="tasks per user")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-url", help="defaults to a new SQLite file in a temporary directory")
+    parser.add_argument("--output", help="write this run's results as JSON")
+    parser.add_argument("--save-baseline", help="write this run's results as the baseline to compare later runs with")
+    parser.add_argument("--baseline", help="compare with a saved baseline, exit with status 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key in CONFIG_KEYS}
+    baseline = json.loads(pathlib.Path(args.baseline).read_text()) if args.baseline else None
+    if baseline is not None and baseline["config"] != config:
+        # other users, tasks, concurrency or duration make for a different workload, not a regression
+        differences = ", ".join(f"{key} {config.get(key)} (baseline {baseline['config'].get(key)})"
+                                for key in sorted({*config, *baseline["config"]}) if config.get(key) != baseline["config"].get(key))
+        sys.exit(f"{args.baseline} was saved with other options: {differences}")
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        app = boot(args.database_url or f"sqlite:///{directory}/bench_load.db")
+        users = seed(args.users, args.tasks)
+        results = asyncio.run(drive(app, users, args.concurrency, args.duration, args.seed))
+
+        from app.database import engine
+        engine.dispose()
+
+    print(f"{'operation':>10} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for operation, result in results.items():
+        print(f"{operation:>10} {result['requests']:>9} {result['rps']:>8.0f} {result['p50_ms']:>8.1f} "
+              f"{result['p95_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['errors']:>7}")
+
+    report = {"config": config, "operations": results}
+    for path in (args.output, args.save_baseline):
+        if path:
+            pathlib.Path(path).write_text(json.dumps(report, indent=2) + "\n")
+
+    if baseline is not None:
+        found = regressions(results, baseline, args.threshold)
+        for regression in found:
+            print(f"regression: {regression}", file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Compare legacy offset paging against keyset (cursor) paging of GET /tasks.
+
+Seeds one user with ``--rows`` tasks in the configured database and times the
+query each mode issues for a page at increasing depths::
+
+    python -m benchmarks.bench_pagination --rows 1000000
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import insert, select, text, tuple_
+from sqlalchemy.orm import Session
+
+from app import models
+from app.database import engine
+
+BENCH_USERNAME = "bench-pagination"
+
+
+def seed(db: Session, rows: int):
+    user = db.query(models.User).filter(models.User.username == BENCH_USERNAME).first()
+    if user is None:
+        user = models.User(username=BENCH_USERNAME, email=f"{BENCH_USERNAME}@example.com", password="x")
+        db.add(user)
+        db.commit()
+
+    existing = db.query(models.Task).filter(models.Task.owner_id == user.id).count()
+    if existing >= rows:
+        return user.id
+
+    missing = rows - existing
+    if db.bind.dialect.name == "postgresql":
+        db.execute(text(
+            "INSERT INTO tasks (title, content, owner_id, created_at) "
+            "SELECT 'title ' || n, 'content ' || n, :owner_id, now() - n * interval '1 second' "
+            "FROM generate_series(1, :missing) AS n"
+        ), {"owner_id": user.id, "missing": missing})
+    else:
+        batch = 10_000
+        for start in range(0, missing, batch):
+            db.execute(insert(models.Task), [
+                {"title": f"title {n}", "content": f"content {n}", "owner_id": user.id}
+                for n in range(start, min(start + batch, missing))
+            ])
+    db.commit()
+    return user.id
+
+
+def page_statement(owner_id: int, limit: int):
+    return (select(models.Task)
+            .where(models.Task.owner_id == owner_id)
+            .order_by(models.Task.created_at, models.Task.id)
+            .limit(limit))
+
+
+def timed(db: Session, statement, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        db.execute(statement).all()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    # create_all skips indexes on tables that already exist
+    for index in models.Task.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+    with Session(engine) as db:
+        owner_id = seed(db, args.rows)
+
+        depths = [0] + [args.rows // 10 ** n for n in range(4, -1, -1) if args.rows // 10 ** n > 0]
+        depths = sorted({min(depth, args.rows - args.limit) for depth in depths})
+
+        print(f"{'depth':>10} {'offset ms':>10} {'keyset ms':>10}")
+        for depth in depths:
+            offset_statement = page_statement(owner_id, args.limit).offset(depth)
+
+            # the cursor a client would hold after paging down to `depth`
+            keyset_statement = page_statement(owner_id, args.limit)
+            if depth:
+                last = db.execute(select(models.Task.created_at, models.Task.id)
+                                  .where(models.Task.owner_id == owner_id)
+                                  .order_by(models.Task.created_at, models.Task.id)
+                                  .offset(depth - 1).limit(1)).one()
+                keyset_statement = keyset_statement.where(
+                    tuple_(models.Task.created_at, models.Task.id) > tuple_(last.created_at, last.id))
+
+            print(f"{depth:>10} {timed(db, offset_statement, args.repeat):>10.2f} {timed(db, keyset_statement, args.repeat):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
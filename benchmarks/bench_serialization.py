@@ -0,0 +1,90 @@
+"""Per-request CPU time and allocations of building a GET /tasks page.
+
+Compares the ORM + pydantic + json path the endpoint used to take against the
+row based path with orjson, for 100, 1,000 and 10,000 item pages::
+
+    python -m benchmarks.bench_serialization
+"""
+import argparse
+import json
+import time
+import tracemalloc
+from typing import List
+
+import orjson
+from pydantic import TypeAdapter
+from sqlalchemy import insert, select
+from sqlalchemy.orm import Session, joinedload
+
+from app import crud, models, schemas
+from app.database import engine
+
+BENCH_USERNAME = "bench-serialization"
+
+tasks_adapter = TypeAdapter(List[schemas.TaskResponse])
+
+
+def seed(db: Session, rows: int):
+    user = db.query(models.User).filter(models.User.username == BENCH_USERNAME).first()
+    if user is None:
+        user = models.User(username=BENCH_USERNAME, email=f"{BENCH_USERNAME}@example.com", password="x")
+        db.add(user)
+        db.commit()
+
+    missing = rows - db.query(models.Task).filter(models.Task.owner_id == user.id).count()
+    if missing > 0:
+        db.execute(insert(models.Task), [
+            {"title": f"title {n}", "content": f"content {n}", "owner_id": user.id} for n in range(missing)])
+        db.commit()
+    return user.id
+
+
+def orm_page(db: Session, owner_id: int, limit: int):
+    tasks = db.scalars(select(models.Task).options(joinedload(models.Task.owner))
+                       .where(models.Task.owner_id == owner_id)
+                       .order_by(models.Task.created_at, models.Task.id).limit(limit)).all()
+    validated = tasks_adapter.validate_python(tasks, from_attributes=True)
+    body = json.dumps(tasks_adapter.dump_python(validated, mode="json")).encode()
+    db.expunge_all()
+    return body
+
+
+def row_page(db: Session, owner_id: int, limit: int):
+    tasks, _ = crud.get_tasks(db, owner_id, limit, 0, "", False, None)
+    return orjson.dumps(tasks)
+
+
+def measure(build, db: Session, owner_id: int, limit: int, repeat: int):
+    build(db, owner_id, limit)  # warm up
+
+    start = time.process_time()
+    for _ in range(repeat):
+        build(db, owner_id, limit)
+    cpu_ms = (time.process_time() - start) / repeat * 1000
+
+    tracemalloc.start()
+    build(db, owner_id, limit)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu_ms, peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+
+    with Session(engine) as db:
+        owner_id = seed(db, 10_000)
+
+        print(f"{'items':>6} {'orm cpu ms':>11} {'rows cpu ms':>12} {'orm peak KiB':>13} {'rows peak KiB':>14}")
+        for limit in (100, 1_000, 10_000):
+            orm_cpu, orm_peak = measure(orm_page, db, owner_id, limit, args.repeat)
+            row_cpu, row_peak = measure(row_page, db, owner_id, limit, args.repeat)
+            print(f"{limit:>6} {orm_cpu:>11.2f} {row_cpu:>12.2f} {orm_peak:>13.0f} {row_peak:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
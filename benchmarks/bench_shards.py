@@ -0,0 +1,207 @@
+"""Measure a write heavy workload against 1, 2 and 4 shards, served by several worker processes.
+
+For each shard count a setup process creates SQLite files (one per shard, set up like
+``python -m app.shards init``) and signs up ``--users`` users through the API. Then ``--workers``
+processes each boot their own copy of the app on those files, like uvicorn workers would, and
+together run ``--concurrency`` clients for ``--duration`` seconds picking create, toggle, list and
+stats requests by weight::
+
+    python -m benchmarks.bench_shards --duration 5 --shards 1 2 4 --workers 4 --commit-ms 20
+
+Prints requests per second and the p50 and p99 latency for each shard count. Sharding pays off
+when the databases are the bottleneck, which SQLite files on a local disk seldom are: every
+commit holds its file's write lock ``--commit-ms`` longer, the way a durable disk or a remote
+database would, and each shard added splits that lock. Pass ``--commit-ms 0`` to measure the
+app alone. The ETag versions stay in each worker (TASK_VERSION_STORE=memory, the benchmark sends
+no ETags). With TASK_VERSION_STORE=database every write also bumps a version on the primary, so
+the primary's write lock caps the gain.
+"""
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks.bench_load import summarize
+
+# operation -> relative weight in the mix
+WORKLOAD = {"create": 4, "toggle": 4, "list": 3, "stats": 1}
+
+
+def boot(directory: str, shard_count: int, setup: bool):
+    urls = [f"sqlite:///{directory}/shard_{shard}.db" for shard in range(shard_count)]
+    # settings are read when app is first imported, so the shards must be chosen before that
+    os.environ["DATABASE_CONNECTION_STRING"] = urls[0]
+    os.environ["DATABASE_SHARD_CONNECTION_STRINGS"] = ",".join(urls[1:])
+    os.environ.setdefault("SECRET_KEY", "bench-shards")
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+    os.environ.setdefault("BCRYPT_ROUNDS", "4")
+    from app import shards
+    from app.database import shard_router
+
+    if setup:
+        for url in urls:
+            shards.migrate(url)
+            # readers of the other workers would otherwise hold up every commit
+            with sqlite3.connect(url.removeprefix("sqlite:///")) as connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+        if shard_router is not None:
+            shards.start_task_ids(shard_router)
+
+    from app.main import app
+    return app
+
+
+def hold_commits(seconds: float):
+    """Makes every commit hold its write lock `seconds` longer, as a slow disk or a remote database would."""
+    from sqlalchemy import event
+    from app.database import engine, shard_router
+
+    def hold(connection):
+        time.sleep(seconds)
+
+    def wait_for_locks(dbapi_connection, connection_record):
+        # the workers' writers queue on the same files, for longer than the 5 s default
+        dbapi_connection.execute("PRAGMA busy_timeout = 60000")
+
+    for shard_engine in shard_router.engines if shard_router else [engine]:
+        event.listen(shard_engine, "connect", wait_for_locks)
+        if seconds:
+            event.listen(shard_engine, "commit", hold)
+
+
+def dispose():
+    from app.database import engine, shard_router
+    for shard_engine in shard_router.engines if shard_router else [engine]:
+        shard_engine.dispose()
+
+
+async def sign_up(client: httpx.AsyncClient, users: int):
+    accounts = []
+    for n in range(users):
+        user = {"email": f"bench-shards-{n}@example.com", "username": f"bench-shards-{n}", "password": "bench-shards"}
+        await client.post("/users/", json=user)
+        token = (await client.post("/login", data={"username": user["username"], "password": user["password"]})).json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        task = (await client.post("/tasks/", json={"title": "first", "content": "by bench_shards"}, headers=headers)).json()
+        accounts.append({"headers": headers, "task_id": task["id"]})
+    return accounts
+
+
+async def request(client: httpx.AsyncClient, operation: str, user: dict, rng: random.Random):
+    if operation == "create":
+        return await client.post("/tasks/", json={"title": "created", "content": "by bench_shards"}, headers=user["headers"])
+    if operation == "toggle":
+        return await client.patch(f"/tasks/{user['task_id']}", json={"done": rng.random() < 0.5}, headers=user["headers"])
+    if operation == "list":
+        return await client.get("/tasks/", params={"limit": 10}, headers=user["headers"])
+    if operation == "stats":
+        return await client.get("/tasks/stats", headers=user["headers"])
+    raise ValueError(operation)
+
+
+async def drive(app, users: list, concurrency: int, args):
+    operations = list(WORKLOAD)
+    weights = list(WORKLOAD.values())
+    latencies = []
+    errors = 0
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        deadline = time.perf_counter() + args.duration
+
+        async def worker(n: int):
+            nonlocal errors
+            rng = random.Random(args.seed + n)
+            while time.perf_counter() < deadline:
+                user = rng.choice(users)
+                start = time.perf_counter()
+                res = await request(client, rng.choices(operations, weights)[0], user, rng)
+                latencies.append(time.perf_counter() - start)
+                errors += res.status_code >= 400
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(args.worker * concurrency + n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return {"latencies": latencies, "errors": errors, "elapsed": elapsed}
+
+
+async def set_up(app, users: int):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60) as client:
+        return await sign_up(client, users)
+
+
+def child(args):
+    accounts = pathlib.Path(args.directory) / "accounts.json"
+    app = boot(args.directory, args.child, setup=args.worker is None)
+    if args.worker is None:
+        accounts.write_text(json.dumps(asyncio.run(set_up(app, args.users))))
+    else:
+        users = json.loads(accounts.read_text())
+        hold_commits(args.commit_ms / 1000)
+        # every worker is booted before any of them starts
+        print("ready", flush=True)
+        sys.stdin.readline()
+        concurrency = args.concurrency // args.workers + (args.worker < args.concurrency % args.workers)
+        print(json.dumps(asyncio.run(drive(app, users, concurrency, args))))
+    dispose()
+
+
+def run(args, shard_count: int):
+    with tempfile.TemporaryDirectory() as directory:
+        command = [sys.executable, "-m", "benchmarks.bench_shards", "--child", str(shard_count), "--directory", directory,
+                   "--users", str(args.users), "--concurrency", str(args.concurrency), "--workers", str(args.workers),
+                   "--duration", str(args.duration), "--commit-ms", str(args.commit_ms), "--seed", str(args.seed)]
+        subprocess.run(command, check=True, capture_output=True)
+        workers = [subprocess.Popen([*command, "--worker", str(n)], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+                   for n in range(args.workers)]
+        for worker in workers:
+            if worker.stdout.readline().strip() != "ready":
+                sys.exit(f"a worker for {shard_count} shards failed to start")
+        for worker in workers:
+            worker.stdin.write("go\n")
+            worker.stdin.flush()
+        results = []
+        for worker in workers:
+            output, _ = worker.communicate()
+            if worker.returncode:
+                sys.exit(f"a worker for {shard_count} shards exited with status {worker.returncode}")
+            results.append(json.loads(output.splitlines()[-1]))
+    latencies = [latency for result in results for latency in result["latencies"]]
+    return summarize(latencies, sum(result["errors"] for result in results), max(result["elapsed"] for result in results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--commit-ms", type=float, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--directory", help=argparse.SUPPRESS)
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    results = {shard_count: run(args, shard_count) for shard_count in args.shards}
+
+    print(f"{args.workers} workers, commits held {args.commit_ms:g} ms")
+    print(f"{'shards':>6} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for shard_count, result in results.items():
+        print(f"{shard_count:>6} {result['requests']:>9} {result['rps']:>8.0f} {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
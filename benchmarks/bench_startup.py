@@ -0,0 +1,72 @@
+"""Measure how long fresh workers take from process start to their first response.
+
+Starts ``--workers`` uvicorn processes at once, the way an autoscaler or a rolling restart
+does, and polls each one's GET / until it answers::
+
+    python -m benchmarks.bench_startup --workers 8
+"""
+import argparse
+import asyncio
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+
+def serve(port: int):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"])
+
+
+async def first_response(client: httpx.AsyncClient, url: str, started: float, timeout: float):
+    while time.perf_counter() - started < timeout:
+        try:
+            res = await client.get(url)
+            if res.status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.005)
+    raise RuntimeError(f"{url} did not answer within {timeout}s")
+
+
+async def measure(workers: int, port: int, timeout: float):
+    servers = []
+    try:
+        async with httpx.AsyncClient(timeout=1) as client:
+            started = []
+            for n in range(workers):
+                started.append(time.perf_counter())
+                servers.append(serve(port + n))
+            return await asyncio.gather(*(first_response(client, f"http://127.0.0.1:{port + n}/", started[n], timeout) for n in range(workers)))
+    finally:
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait()
+
+
+def import_seconds():
+    # importing the app alone, in a fresh interpreter, without uvicorn
+    code = "import time; start = time.perf_counter(); import app.main; print(time.perf_counter() - start)"
+    return float(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    print(f"import app.main: {import_seconds() * 1000:.0f} ms")
+    seconds = asyncio.run(measure(args.workers, args.port, args.timeout))
+    for n, elapsed in enumerate(seconds):
+        print(f"worker {n}: first response after {elapsed * 1000:.0f} ms")
+    print(f"mean {statistics.mean(seconds) * 1000:.0f} ms, max {max(seconds) * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
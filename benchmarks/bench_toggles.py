@@ -0,0 +1,99 @@
+"""Compare PATCH /tasks/{id} under a toggle storm with and without the write behind queue.
+
+Boots the app like bench_load, then ``--concurrency`` clients toggle ``--hot-tasks`` tasks of
+each of ``--users`` users for ``--duration`` seconds, once writing every toggle through and once
+with settings.task_status_write_behind::
+
+    python -m benchmarks.bench_toggles --duration 5
+
+Prints requests and database commits per second, and the p50 and p99 latency, of each mode.
+"""
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import event
+
+from benchmarks.bench_load import boot, seed, summarize
+
+
+async def storm(app, users: list, hot_tasks: dict, concurrency: int, duration: float, seed: int):
+    latencies = []
+    errors = 0
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+        deadline = time.perf_counter() + duration
+
+        async def worker(n: int):
+            nonlocal errors
+            rng = random.Random(seed + n)
+            while time.perf_counter() < deadline:
+                user = rng.choice(users)
+                start = time.perf_counter()
+                res = await client.patch(f"/tasks/{rng.choice(hot_tasks[user['id']])}", json={"done": rng.random() < 0.5},
+                                         headers={"Authorization": f"Bearer {user['token']}"})
+                latencies.append(time.perf_counter() - start)
+                errors += res.status_code >= 400
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(n) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return latencies, errors, elapsed
+
+
+async def run_mode(app, write_behind: bool, users: list, hot_tasks: dict, args, commits: list):
+    from app import writebehind
+    from app.config import settings
+
+    settings.task_status_write_behind = write_behind
+    if write_behind:
+        writebehind.queue.start()
+    commits.clear()
+    latencies, errors, elapsed = await storm(app, users, hot_tasks, args.concurrency, args.duration, args.seed)
+    if write_behind:
+        # the last flush belongs to this run
+        await writebehind.queue.stop()
+    return {**summarize(latencies, errors, elapsed), "commits_per_second": len(commits) / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--hot-tasks", type=int, default=5, help="tasks toggled per user")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--database-url", help="defaults to a new SQLite file in a temporary directory")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        app = boot(args.database_url or f"sqlite:///{directory}/bench_toggles.db")
+        users = seed(args.users, args.hot_tasks)
+
+        from sqlalchemy import select
+        from sqlalchemy.orm import Session
+        from app import models
+        from app.database import engine
+        with Session(engine) as db:
+            hot_tasks = {}
+            for owner_id, id in db.execute(select(models.Task.owner_id, models.Task.id)):
+                hot_tasks.setdefault(owner_id, []).append(id)
+
+        commits = []
+        event.listen(engine, "commit", lambda conn: commits.append(None))
+        results = {mode: asyncio.run(run_mode(app, mode == "write-behind", users, hot_tasks, args, commits))
+                   for mode in ("write-through", "write-behind")}
+        engine.dispose()
+
+    print(f"{'mode':>13} {'requests':>9} {'req/s':>8} {'commits/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for mode, result in results.items():
+        print(f"{mode:>13} {result['requests']:>9} {result['rps']:>8.0f} {result['commits_per_second']:>10.0f} "
+              f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
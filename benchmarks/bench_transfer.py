@@ -0,0 +1,113 @@
+"""Time streaming export and import of ``--rows`` tasks and report the server's peak RSS.
+
+Starts uvicorn against the configured database, exports one user's tasks and imports
+them into another user, both streamed::
+
+    python -m benchmarks.bench_transfer --rows 1000000
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+from sqlalchemy import insert, text
+from sqlalchemy.orm import Session
+
+from app import models
+from app.database import engine
+
+SOURCE = {"email": "bench-export@example.com", "username": "bench-export", "password": "bench-export"}
+TARGET = {"email": "bench-import@example.com", "username": "bench-import", "password": "bench-import"}
+
+
+def peak_rss_mib(pid: int):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def reset_users():
+    models.Base.metadata.create_all(bind=engine)
+    with Session(engine) as db:
+        for user in (SOURCE, TARGET):
+            existing = db.query(models.User).filter(models.User.username == user["username"]).first()
+            if existing is not None:
+                db.delete(existing)
+        db.commit()
+
+
+def fill(rows: int):
+    with Session(engine) as db:
+        owner_id = db.query(models.User.id).filter(models.User.username == SOURCE["username"]).scalar()
+        if db.bind.dialect.name == "postgresql":
+            db.execute(text(
+                "INSERT INTO tasks (title, content, owner_id) "
+                "SELECT 'title ' || n, 'content, with \"quotes\" ' || n, :owner_id FROM generate_series(1, :rows) AS n"
+            ), {"owner_id": owner_id, "rows": rows})
+        else:
+            for start in range(0, rows, 10_000):
+                db.execute(insert(models.Task), [
+                    {"title": f"title {n}", "content": f'content, with "quotes" {n}', "owner_id": owner_id}
+                    for n in range(start, min(start + 10_000, rows))])
+        db.commit()
+
+
+def login(client: httpx.Client, user: dict):
+    client.post("/users/", json=user)
+    res = client.post("/login", data={"username": user["username"], "password": user["password"]})
+    return {"Authorization": f"Bearer {res.json()['access_token']}"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--format", choices=["ndjson", "csv"], default="ndjson")
+    parser.add_argument("--port", type=int, default=8766)
+    args = parser.parse_args()
+
+    reset_users()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(args.port), "--log-level", "warning"])
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{args.port}", timeout=None) as client:
+            for _ in range(100):
+                try:
+                    client.get("/")
+                    break
+                except httpx.TransportError:
+                    time.sleep(0.1)
+
+            source_headers = login(client, SOURCE)
+            target_headers = login(client, TARGET)
+            fill(args.rows)
+            print(f"{'phase':>8} {'seconds':>8} {'MiB':>8} {'peak RSS MiB':>13}")
+            print(f"{'idle':>8} {'':>8} {'':>8} {peak_rss_mib(server.pid):>13.1f}")
+
+            with tempfile.TemporaryFile() as dump:
+                start = time.perf_counter()
+                with client.stream("GET", "/tasks/export", params={"format": args.format}, headers=source_headers) as res:
+                    for chunk in res.iter_bytes():
+                        dump.write(chunk)
+                size = dump.tell() / 2 ** 20
+                print(f"{'export':>8} {time.perf_counter() - start:>8.1f} {size:>8.1f} {peak_rss_mib(server.pid):>13.1f}")
+
+                def body():
+                    dump.seek(0)
+                    while chunk := dump.read(64 * 1024):
+                        yield chunk
+
+                start = time.perf_counter()
+                res = client.post("/tasks/import", params={"format": args.format}, content=body(), headers=target_headers)
+                assert res.json() == {"imported": args.rows}, res.text
+                print(f"{'import':>8} {time.perf_counter() - start:>8.1f} {size:>8.1f} {peak_rss_mib(server.pid):>13.1f}")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    main()
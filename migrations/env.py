@@ -0,0 +1,40 @@
+from logging.config import fileConfig
+from alembic import context
+from sqlalchemy.pool import NullPool
+from app import models
+from app.config import settings
+from app.database import make_engine
+
+config = context.config
+
+if config.config_file_name is not None and config.attributes.get("configure_logger", True):
+    fileConfig(config.config_file_name)
+
+target_metadata = models.Base.metadata
+
+def include_object(object, name, type_, reflected, compare_to):
+    # the SQLite full-text tables and their shadow tables are created by the migrations, not the models,
+    # and autogenerate can't compare expression indexes, it would drop and recreate ix_tasks_search every time
+    return not (type_ == "table" and name.startswith(("tasks_fts", "tasks_archive_fts"))) and name != "ix_tasks_search"
+
+def database_url():
+    return config.get_main_option("sqlalchemy.url") or settings.database_connection_string
+
+def run_migrations_offline():
+    context.configure(url=database_url(), target_metadata=target_metadata, include_object=include_object,
+                      literal_binds=True, dialect_opts={"paramstyle": "named"})
+    with context.begin_transaction():
+        context.run_migrations()
+
+def run_migrations_online():
+    engine = make_engine(database_url(), poolclass=NullPool)
+    with engine.connect() as connection:
+        context.configure(connection=connection, target_metadata=target_metadata, include_object=include_object)
+        with context.begin_transaction():
+            context.run_migrations()
+    engine.dispose()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,67 @@
+"""add task_shares and the tasks indexes
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+# SQLite keeps an external-content FTS5 index of tasks in sync through triggers, see app/search.py
+SQLITE_FTS_CREATE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(title, content, content='tasks', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF title, content ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO tasks_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+]
+
+
+def utcnow():
+    # matches app.models.utcnow, SQLite stores timestamps in the format SQLAlchemy binds them with
+    if op.get_bind().dialect.name == "sqlite":
+        return sa.text("(strftime('%Y-%m-%d %H:%M:%f000', 'now'))")
+    return sa.text("now()")
+
+
+def upgrade():
+    op.create_index("ix_tasks_owner_id_created_at_id", "tasks", ["owner_id", "created_at", "id"])
+    op.create_table(
+        "task_shares",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("owner_id", sa.Integer(), nullable=False),
+        sa.Column("created_at", sa.TIMESTAMP(timezone=True), server_default=utcnow(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["owner_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id", "owner_id"),
+    )
+    op.create_index("ix_task_shares_owner_id", "task_shares", ["owner_id"])
+
+    if op.get_bind().dialect.name == "postgresql":
+        op.create_index("ix_tasks_search", "tasks", [sa.text("to_tsvector('simple', title || ' ' || content)")], postgresql_using="gin")
+    elif op.get_bind().dialect.name == "sqlite":
+        for statement in SQLITE_FTS_CREATE:
+            op.execute(statement)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "sqlite":
+        for trigger in ("tasks_fts_insert", "tasks_fts_delete", "tasks_fts_update"):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        op.execute("DROP TABLE IF EXISTS tasks_fts")
+    elif op.get_bind().dialect.name == "postgresql":
+        op.drop_index("ix_tasks_search", table_name="tasks")
+    op.drop_index("ix_task_shares_owner_id", table_name="task_shares")
+    op.drop_table("task_shares")
+    op.drop_index("ix_tasks_owner_id_created_at_id", table_name="tasks")
@@ -0,0 +1,92 @@
+"""add task_counters and the triggers maintaining them
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+# see app/counters.py
+POSTGRESQL_CREATE = [
+    """CREATE OR REPLACE FUNCTION task_counters_apply() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        -- each branch only reads the transition tables its trigger declares
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO task_counters (user_id, total, done)
+            SELECT owner_id, count(*), count(*) FILTER (WHERE done) FROM new_rows GROUP BY owner_id
+            ON CONFLICT (user_id) DO UPDATE SET total = task_counters.total + excluded.total, done = task_counters.done + excluded.done;
+        ELSIF TG_OP = 'DELETE' THEN
+            UPDATE task_counters SET total = task_counters.total - removed.total, done = task_counters.done - removed.done
+            FROM (SELECT owner_id, count(*) AS total, count(*) FILTER (WHERE done) AS done FROM old_rows GROUP BY owner_id) AS removed
+            WHERE task_counters.user_id = removed.owner_id;
+        ELSE
+            INSERT INTO task_counters (user_id, total, done)
+            SELECT owner_id, sum(total), sum(done) FROM (
+                SELECT owner_id, 1 AS total, done::int AS done FROM new_rows
+                UNION ALL
+                SELECT owner_id, -1, -done::int FROM old_rows
+            ) AS changes GROUP BY owner_id HAVING sum(total) <> 0 OR sum(done) <> 0
+            ON CONFLICT (user_id) DO UPDATE SET total = task_counters.total + excluded.total, done = task_counters.done + excluded.done;
+        END IF;
+        RETURN NULL;
+    END $$""",
+    "CREATE TRIGGER task_counters_insert AFTER INSERT ON tasks REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+    "CREATE TRIGGER task_counters_update AFTER UPDATE ON tasks REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+    "CREATE TRIGGER task_counters_delete AFTER DELETE ON tasks REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+]
+
+SQLITE_CREATE = [
+    """CREATE TRIGGER IF NOT EXISTS task_counters_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO task_counters (user_id, total, done) VALUES (new.owner_id, 1, new.done)
+        ON CONFLICT (user_id) DO UPDATE SET total = total + 1, done = done + excluded.done;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_counters_update AFTER UPDATE OF done, owner_id ON tasks BEGIN
+        UPDATE task_counters SET total = total - 1, done = done - old.done WHERE user_id = old.owner_id;
+        INSERT INTO task_counters (user_id, total, done) VALUES (new.owner_id, 1, new.done)
+        ON CONFLICT (user_id) DO UPDATE SET total = total + 1, done = done + excluded.done;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_counters_delete AFTER DELETE ON tasks BEGIN
+        UPDATE task_counters SET total = total - 1, done = done - old.done WHERE user_id = old.owner_id;
+    END""",
+]
+
+
+def upgrade():
+    op.create_table(
+        "task_counters",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("total", sa.BigInteger(), nullable=False),
+        sa.Column("done", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        # no task may change between the backfill below and the triggers taking over
+        op.execute("LOCK TABLE tasks IN SHARE MODE")
+        for statement in POSTGRESQL_CREATE:
+            op.execute(statement)
+    elif dialect == "sqlite":
+        for statement in SQLITE_CREATE:
+            op.execute(statement)
+
+    op.execute(
+        "INSERT INTO task_counters (user_id, total, done) "
+        "SELECT owner_id, count(*), sum(CASE WHEN done THEN 1 ELSE 0 END) FROM tasks GROUP BY owner_id")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == "postgresql":
+        op.execute("DROP FUNCTION IF EXISTS task_counters_apply() CASCADE")
+    elif dialect == "sqlite":
+        for trigger in ("task_counters_insert", "task_counters_update", "task_counters_delete"):
+            op.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    op.drop_table("task_counters")
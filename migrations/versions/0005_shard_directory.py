@@ -0,0 +1,67 @@
+"""add shard_directory, make SQLite task ids AUTOINCREMENT
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+
+shard_directory maps users to their shard under the directory shard map (see app/shards.py).
+Sharded task ids come from the task_id_counter of 0007, not from the tasks tables. On SQLite
+tasks is rebuilt as AUTOINCREMENT so that ids are never reused, and archived tasks can come
+back with theirs.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+# rebuilding tasks drops its triggers, these are the ones of 0002 and 0004
+SQLITE_TASK_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO tasks_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF title, content ON tasks BEGIN
+        INSERT INTO tasks_fts(tasks_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO tasks_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_counters_insert AFTER INSERT ON tasks BEGIN
+        INSERT INTO task_counters (user_id, total, done) VALUES (new.owner_id, 1, new.done)
+        ON CONFLICT (user_id) DO UPDATE SET total = total + 1, done = done + excluded.done;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_counters_update AFTER UPDATE OF done, owner_id ON tasks BEGIN
+        UPDATE task_counters SET total = total - 1, done = done - old.done WHERE user_id = old.owner_id;
+        INSERT INTO task_counters (user_id, total, done) VALUES (new.owner_id, 1, new.done)
+        ON CONFLICT (user_id) DO UPDATE SET total = total + 1, done = done + excluded.done;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_counters_delete AFTER DELETE ON tasks BEGIN
+        UPDATE task_counters SET total = total - 1, done = done - old.done WHERE user_id = old.owner_id;
+    END""",
+]
+
+
+def upgrade():
+    op.create_table(
+        "shard_directory",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("shard", sa.Integer(), nullable=False),
+        sa.Column("moving", sa.Boolean(), server_default=sa.false(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("user_id"),
+    )
+
+    if op.get_bind().dialect.name == "sqlite":
+        # the copy keeps every id, so the full-text index still matches
+        with op.batch_alter_table("tasks", recreate="always", table_kwargs={"sqlite_autoincrement": True}):
+            pass
+        for statement in SQLITE_TASK_TRIGGERS:
+            op.execute(statement)
+
+
+def downgrade():
+    # tasks stays AUTOINCREMENT on SQLite, nothing depends on it not being
+    op.drop_table("shard_directory")
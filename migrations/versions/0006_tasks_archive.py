@@ -0,0 +1,54 @@
+"""add tasks_archive, counted by the task counter triggers
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+# see app/counters.py, task_counters_apply() comes from 0004
+POSTGRESQL_CREATE = [
+    "CREATE TRIGGER task_counters_insert AFTER INSERT ON tasks_archive REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+    "CREATE TRIGGER task_counters_delete AFTER DELETE ON tasks_archive REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION task_counters_apply()",
+]
+
+SQLITE_CREATE = [
+    """CREATE TRIGGER IF NOT EXISTS task_archive_counters_insert AFTER INSERT ON tasks_archive BEGIN
+        INSERT INTO task_counters (user_id, total, done) VALUES (new.owner_id, 1, new.done)
+        ON CONFLICT (user_id) DO UPDATE SET total = total + 1, done = done + excluded.done;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_archive_counters_delete AFTER DELETE ON tasks_archive BEGIN
+        UPDATE task_counters SET total = total - 1, done = done - old.done WHERE user_id = old.owner_id;
+    END""",
+]
+
+
+def upgrade():
+    op.create_table(
+        "tasks_archive",
+        sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("title", sa.String(), nullable=False),
+        sa.Column("content", sa.String(), nullable=False),
+        sa.Column("done", sa.Boolean(), nullable=False),
+        sa.Column("created_at", sa.TIMESTAMP(timezone=True), nullable=False),
+        sa.Column("owner_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["owner_id"], ["users.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index("ix_tasks_archive_owner_id_created_at_id", "tasks_archive", ["owner_id", "created_at", "id"])
+
+    dialect = op.get_bind().dialect.name
+    for statement in POSTGRESQL_CREATE if dialect == "postgresql" else SQLITE_CREATE if dialect == "sqlite" else []:
+        op.execute(statement)
+
+
+def downgrade():
+    # the triggers go with the table
+    op.drop_index("ix_tasks_archive_owner_id_created_at_id", table_name="tasks_archive")
+    op.drop_table("tasks_archive")
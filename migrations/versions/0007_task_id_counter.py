@@ -0,0 +1,30 @@
+"""add task_id_counter
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+
+Sharded task ids come from this counter on the primary rather than from each shard's own range,
+so a task keeps its id when its owner moves (see app/shards.py). ``python -m app.shards init``
+starts it above every task id of every shard.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "task_id_counter",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("next_id", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+
+def downgrade():
+    op.drop_table("task_id_counter")
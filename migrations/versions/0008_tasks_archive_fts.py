@@ -0,0 +1,45 @@
+"""add an FTS5 index of tasks_archive on SQLite
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+
+Searches including archived tasks matched them by substring on SQLite, and active tasks by word
+prefix through tasks_fts. The archive gets the same kind of index, so both match the same words.
+PostgreSQL applies the same tsquery to both tables already.
+"""
+from alembic import op
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS tasks_archive_fts USING fts5(title, content, content='tasks_archive', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS tasks_archive_fts_insert AFTER INSERT ON tasks_archive BEGIN
+        INSERT INTO tasks_archive_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_archive_fts_delete AFTER DELETE ON tasks_archive BEGIN
+        INSERT INTO tasks_archive_fts(tasks_archive_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tasks_archive_fts_update AFTER UPDATE OF title, content ON tasks_archive BEGIN
+        INSERT INTO tasks_archive_fts(tasks_archive_fts, rowid, title, content) VALUES ('delete', old.id, old.title, old.content);
+        INSERT INTO tasks_archive_fts(rowid, title, content) VALUES (new.id, new.title, new.content);
+    END""",
+    # index the tasks archived so far
+    "INSERT INTO tasks_archive_fts(tasks_archive_fts) VALUES ('rebuild')",
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == "sqlite":
+        for statement in SQLITE_CREATE:
+            op.execute(statement)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "sqlite":
+        for trigger in ("insert", "delete", "update"):
+            op.execute(f"DROP TRIGGER IF EXISTS tasks_archive_fts_{trigger}")
+        op.execute("DROP TABLE IF EXISTS tasks_archive_fts")
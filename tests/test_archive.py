@@ -0,0 +1,136 @@
+from app import archive, events, models, writebehind
+from app.config import settings
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import select, update
+from sqlalchemy.orm import sessionmaker
+import asyncio
+import pytest
+
+
+@pytest.fixture
+def archiver(session):
+    archiver = archive.Archiver(after_days=30, interval_seconds=60, batch_size=2)
+    archiver.engines = [session.get_bind()]
+    return archiver
+
+
+@pytest.fixture
+def archived(test_tasks, session, archiver):
+    """The first two tasks of test_user and the one of test_user2 completed long ago and archived."""
+    ids = [task.id for task in test_tasks]
+    session.execute(update(models.Task).values(created_at=datetime.now(timezone.utc) - timedelta(days=60)))
+    session.execute(update(models.Task).where(models.Task.id.in_([ids[0], ids[1], ids[3]])).values(done=True))
+    session.commit()
+    archiver.archive_due()
+    return ids
+
+
+def table_ids(session, model):
+    session.expire_all()
+    return session.scalars(select(model.id).order_by(model.id)).all()
+
+
+def listed(client, **params):
+    return [task['id'] for task in client.get("/tasks", params=params).json()]
+
+
+def test_archiver_moves_old_completed_tasks(authorized_client, test_tasks, test_user, test_user2, session, archiver):
+    ids = [task.id for task in test_tasks]
+    stats = authorized_client.get("/tasks/stats").json()
+    tag = authorized_client.get("/tasks").headers["ETag"]
+    session.execute(update(models.Task).where(models.Task.id != ids[1]).values(created_at=datetime.now(timezone.utc) - timedelta(days=60)))
+    session.execute(update(models.Task).where(models.Task.id != ids[2]).values(done=True))
+    session.commit()
+
+    # the second task is done but recent, the third old but open
+    assert archiver.archive_due() == {test_user['id']: [ids[0]], test_user2['id']: [ids[3]]}
+    assert table_ids(session, models.Task) == [ids[1], ids[2]]
+    assert table_ids(session, models.TaskArchive) == [ids[0], ids[3]]
+    assert archiver.archive_due() == {}
+
+    assert authorized_client.get("/tasks", headers={"If-None-Match": tag}).status_code == 200
+    assert listed(authorized_client) == [ids[2], ids[1]]
+    assert listed(authorized_client, include_archived=True) == [ids[0], ids[2], ids[1]]
+    assert listed(authorized_client, include_archived=True, skip=1, limit=1) == [ids[2]]
+    assert listed(authorized_client, include_archived=True, search="first") == [ids[0]]
+    # archived tasks still count, and the counters agree with a recount
+    assert authorized_client.get("/tasks/stats").json() == {**stats, "done": 2, "open": 1}
+
+
+def test_archiver_batches_and_publishes(test_tasks, test_user, test_user2, session, archiver, monkeypatch):
+    ids = [task.id for task in test_tasks]
+    broker = events.Broker(replay_size=5, buffer_size=10)
+    monkeypatch.setattr(events, "broker", broker)
+    session.execute(update(models.Task).values(done=True, created_at=datetime.now(timezone.utc) - timedelta(days=60)))
+    session.commit()
+
+    async def archive():
+        subscriber = broker.subscribe(test_user['id'])
+        # batches of two, the last task goes in a second one
+        assert await archiver.archive() == {test_user['id']: ids[:3], test_user2['id']: [ids[3]]}
+        return subscriber.drain()
+
+    assert [(event["type"], event["ids"]) for event in asyncio.run(archive())] == [("archived", ids[:3])]
+    assert table_ids(session, models.Task) == []
+
+
+def test_archived_tasks_come_back_when_undone(authorized_client, archived, session):
+    assert authorized_client.patch(f"/tasks/{archived[0]}", json={"done": False}).status_code == 200
+    assert table_ids(session, models.TaskArchive) == [archived[1], archived[3]]
+    assert authorized_client.get(f"/tasks/{archived[0]}").json()["done"] is False
+    assert archived[0] in listed(authorized_client)
+
+    # marking it done again leaves it archived
+    assert authorized_client.patch(f"/tasks/{archived[1]}", json={"done": True}).status_code == 200
+    assert table_ids(session, models.TaskArchive) == [archived[1], archived[3]]
+
+    results = authorized_client.patch("/tasks/bulk", json={"ids": [archived[1], archived[3]], "done": False}).json()["results"]
+    assert [result["status"] for result in results] == [200, 403]
+    assert table_ids(session, models.TaskArchive) == [archived[3]]
+    assert authorized_client.get("/tasks/stats").json()["done"] == 0
+
+
+def test_archived_tasks_by_id(authorized_client, archived, session):
+    assert authorized_client.get(f"/tasks/{archived[0]}").json()["done"] is True
+    assert authorized_client.get(f"/tasks/{archived[3]}").status_code == 403
+
+    # editing brings it back
+    res = authorized_client.put(f"/tasks/{archived[1]}", json={"title": "edited", "content": "edited", "done": True})
+    assert res.status_code == 200
+    assert res.json()["id"] == archived[1]
+    assert table_ids(session, models.Task) == [archived[1], archived[2]]
+
+    assert authorized_client.delete(f"/tasks/{archived[0]}").status_code == 204
+    assert authorized_client.delete(f"/tasks/{archived[3]}").status_code == 403
+    assert authorized_client.get(f"/tasks/{archived[0]}").status_code == 404
+    assert table_ids(session, models.TaskArchive) == [archived[3]]
+    assert authorized_client.get("/tasks/stats").json()["total"] == 2
+
+
+def test_search_matches_archived_tasks_by_word_prefix(authorized_client, archived):
+    # the same words as in active tasks, "irst" is inside a word and not the start of one
+    assert listed(authorized_client, include_archived=True, search="fir") == [archived[0]]
+    assert listed(authorized_client, include_archived=True, search="irst") == []
+    assert listed(authorized_client, include_archived=True, search="title cont") == [archived[0], archived[1], archived[2]]
+
+
+def test_ranked_search_excludes_archived(authorized_client):
+    res = authorized_client.get("/tasks", params={"include_archived": True, "ranked": True, "search": "title"})
+    assert res.status_code == 400
+
+
+def test_export_includes_archived(authorized_client, archived):
+    exported = [line for line in authorized_client.get("/tasks/export").text.splitlines()]
+    assert len(exported) == 3
+
+
+def test_write_behind_undone_toggles_restore(authorized_client, archived, session, monkeypatch):
+    queue = writebehind.ToggleQueue(flush_seconds=60, max_items=100)
+    queue.session_factory = sessionmaker(autoflush=False, bind=session.get_bind())
+    monkeypatch.setattr(writebehind, "queue", queue)
+    monkeypatch.setattr(settings, "task_status_write_behind", True)
+
+    authorized_client.patch(f"/tasks/{archived[0]}", json={"done": False})
+    asyncio.run(queue.flush())
+    assert table_ids(session, models.TaskArchive) == [archived[1], archived[3]]
+    assert archived[0] in listed(authorized_client)
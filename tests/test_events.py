@@ -0,0 +1,183 @@
+from app import events, writebehind
+from app.config import settings
+from sqlalchemy.orm import sessionmaker
+from .conftest import engine
+import asyncio
+import pytest
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    broker = events.Broker(replay_size=5, buffer_size=10)
+    monkeypatch.setattr(events, "broker", broker)
+    return broker
+
+
+def subscribe(broker, user_id, owner_ids=()):
+    # the loop is gone once this returns, events stay buffered on the subscriber
+    async def subscribed():
+        subscriber = broker.subscribe(user_id)
+        broker.follow(subscriber, owner_ids)
+        return subscriber
+    return asyncio.run(subscribed())
+
+
+def received(subscriber):
+    return [{key: value for key, value in event.items() if key != "id"} for event in subscriber.drain()]
+
+
+def test_broker_delivers_to_followers(broker):
+    owner = subscribe(broker, 1)
+    recipient = subscribe(broker, 2, [1])
+    other = subscribe(broker, 3)
+
+    broker.deliver(events.tasks_channel(1), {"type": "created", "owner_id": 1, "ids": [10]})
+    assert received(owner) == received(recipient) == [{"type": "created", "owner_id": 1, "ids": [10]}]
+    assert received(other) == []
+
+    broker.unsubscribe(recipient)
+    broker.unsubscribe(owner)
+    broker.unsubscribe(other)
+    assert len(broker) == 0
+
+
+def test_broker_follows_shares(broker):
+    recipient = subscribe(broker, 2)
+
+    broker.deliver(events.shares_channel(2), {"type": "shared", "owner_id": 1})
+    broker.deliver(events.tasks_channel(1), {"type": "deleted", "owner_id": 1, "ids": [10]})
+    broker.deliver(events.shares_channel(2), {"type": "unshared", "owner_id": 1})
+    broker.deliver(events.tasks_channel(1), {"type": "deleted", "owner_id": 1, "ids": [11]})
+    assert [event["type"] for event in received(recipient)] == ["shared", "deleted", "unshared"]
+
+
+def test_broker_resets_slow_subscribers(broker):
+    subscriber = subscribe(broker, 1)
+    for id in range(11):
+        broker.deliver(events.tasks_channel(1), {"type": "deleted", "owner_id": 1, "ids": [id]})
+    assert received(subscriber) == [{"type": "reset"}]
+
+    broker.deliver(events.tasks_channel(1), {"type": "deleted", "owner_id": 1, "ids": [11]})
+    assert received(subscriber) == [{"type": "deleted", "owner_id": 1, "ids": [11]}]
+
+
+def test_broker_replay(broker):
+    subscriber = subscribe(broker, 1)
+    for id in range(3):
+        broker.deliver(events.tasks_channel(1 + id % 2), {"type": "deleted", "owner_id": 1 + id % 2, "ids": [id]})
+    ids = [event["id"] for event in subscriber.drain()]
+
+    assert [event["ids"] for event in broker.replay(subscriber, ids[0])] == [[2]]
+    assert broker.replay(subscriber, ids[1]) == []
+    assert broker.replay(subscriber, "other-1") is None
+    assert broker.replay(subscriber, "not an id") is None
+
+    for id in range(5):
+        broker.deliver(events.tasks_channel(1), {"type": "deleted", "owner_id": 1, "ids": [id]})
+    # the events after the first one were dropped from the replay buffer
+    assert broker.replay(subscriber, ids[0]) is None
+
+
+def test_stream(broker):
+    async def read():
+        subscriber = broker.subscribe(1)
+        chunks = events.stream(subscriber, keepalive_seconds=0.01)
+        first = [await anext(chunks), await anext(chunks)]
+        broker.deliver(events.tasks_channel(1), {"type": "deleted", "owner_id": 1, "ids": [10]})
+        event = await anext(chunks)
+
+        resumed = events.stream(broker.subscribe(1), event.split("\n")[0][len("id: "):], keepalive_seconds=0.01)
+        broker.deliver(events.tasks_channel(1), {"type": "created", "owner_id": 1, "ids": [11]})
+        assert (await anext(resumed)).startswith(f"id: {broker.epoch}-2\nevent: created\n")
+        gone = events.stream(broker.subscribe(1), "other-1", keepalive_seconds=0.01)
+        assert await anext(gone) == 'event: reset\ndata: {"type":"reset"}\n\n'
+
+        for stream in (chunks, resumed, gone):
+            await stream.aclose()
+        return first, event
+
+    first, event = asyncio.run(read())
+    assert first == [": connected\n\n", ": keepalive\n\n"]
+    assert event == f'id: {broker.epoch}-1\nevent: deleted\ndata: {{"type":"deleted","owner_id":1,"ids":[10]}}\n\n'
+    assert len(broker) == 0
+
+
+def test_task_mutations_publish_events(authorized_client, test_tasks, test_user, broker):
+    owner_id = test_user['id']
+    subscriber = subscribe(broker, owner_id)
+    id, other_id, _, foreign_id = [task.id for task in test_tasks]
+
+    new_id = authorized_client.post("/tasks", json={"title": "new title", "content": "new content"}).json()['id']
+    authorized_client.put(f"/tasks/{id}", json={"title": "updated title", "content": "updated content"})
+    authorized_client.patch(f"/tasks/{id}", json={"done": True})
+    authorized_client.patch("/tasks/bulk", json={"ids": [id, foreign_id], "done": False})
+    authorized_client.delete(f"/tasks/{new_id}")
+    authorized_client.request("DELETE", "/tasks/bulk", json={"ids": [other_id]})
+    assert received(subscriber) == [
+        {"type": "created", "owner_id": owner_id, "ids": [new_id]},
+        {"type": "updated", "owner_id": owner_id, "ids": [id]},
+        {"type": "status", "owner_id": owner_id, "ids": [id], "done": True},
+        {"type": "status", "owner_id": owner_id, "ids": [id], "done": False},
+        {"type": "deleted", "owner_id": owner_id, "ids": [new_id]},
+        {"type": "deleted", "owner_id": owner_id, "ids": [other_id]},
+    ]
+
+    # a refused mutation publishes nothing
+    authorized_client.delete(f"/tasks/{foreign_id}")
+    assert received(subscriber) == []
+
+
+def test_shared_tasks_events(authorized_client, test_tasks, test_user, test_user2, broker):
+    recipient = subscribe(broker, test_user2['id'])
+    id = test_tasks[0].id
+
+    authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": True})
+    authorized_client.patch(f"/tasks/{id}", json={"done": True})
+    authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": False})
+    authorized_client.patch(f"/tasks/{id}", json={"done": False})
+    assert [(event["type"], event["owner_id"]) for event in received(recipient)] == [
+        ("shared", test_user['id']), ("status", test_user['id']), ("unshared", test_user['id'])]
+
+
+def test_write_behind_toggles_publish_when_written(authorized_client, test_tasks, test_user, broker, session, monkeypatch):
+    queue = writebehind.ToggleQueue(flush_seconds=60, max_items=100)
+    queue.session_factory = sessionmaker(autoflush=False, bind=session.get_bind())
+    monkeypatch.setattr(writebehind, "queue", queue)
+    monkeypatch.setattr(settings, "task_status_write_behind", True)
+    subscriber = subscribe(broker, test_user['id'])
+    ids = [task.id for task in test_tasks]
+
+    # the last task isn't the user's, its toggle is dropped
+    for id, done in zip(ids, [True, False, True, True]):
+        authorized_client.patch(f"/tasks/{id}", json={"done": done})
+    assert received(subscriber) == []
+
+    asyncio.run(queue.flush())
+    assert received(subscriber) == [
+        {"type": "status", "owner_id": test_user['id'], "ids": [ids[0], ids[2]], "done": True},
+        {"type": "status", "owner_id": test_user['id'], "ids": [ids[1]], "done": False},
+    ]
+
+
+def test_unauthorized_task_events(client):
+    assert client.get("/tasks/events").status_code == 401
+
+
+@pytest.mark.skipif(engine.dialect.name != "postgresql", reason="LISTEN/NOTIFY needs PostgreSQL")
+def test_events_through_notify(broker, monkeypatch):
+    monkeypatch.setattr(settings, "task_events_backend", "postgresql")
+    listener = events.NotifyListener(engine)
+    monkeypatch.setattr(events, "listener", listener)
+
+    async def round_trip():
+        listener.start()
+        try:
+            subscriber = broker.subscribe(1)
+            await events.task_event("created", 1, list(range(5000)))
+            await asyncio.wait_for(subscriber.ready.wait(), 5)
+            return received(subscriber)
+        finally:
+            listener.stop()
+
+    # too many ids for a notification, they're left out
+    assert asyncio.run(round_trip()) == [{"type": "created", "owner_id": 1, "ids": None}]
@@ -0,0 +1,67 @@
+from app import database, metrics
+from app.config import settings
+from sqlalchemy import exc, text
+from .conftest import DATABASE_CONNECTION_STRING
+import logging
+import pytest
+
+
+def test_pool_stats(client):
+    res = client.get("/health/pool")
+    assert res.status_code == 200
+    stats = res.json()["pools"]["primary"]
+    assert {"size", "checked_out", "idle", "overflow", "checkouts", "wait_seconds_total", "wait_seconds_max", "timeouts"} <= stats.keys()
+
+
+def test_pool_records_checkout_timeout():
+    engine = database.make_engine(DATABASE_CONNECTION_STRING, poolclass=database.TimedQueuePool,
+                                  pool_size=1, max_overflow=0, pool_timeout=0.05)
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+            with pytest.raises(exc.TimeoutError):
+                engine.connect()
+            stats = engine.pool.stats()
+            assert stats["checked_out"] == 1
+            assert stats["timeouts"] == 1
+            assert stats["wait_seconds_max"] >= 0.05
+        assert engine.pool.stats()["idle"] == 1
+    finally:
+        engine.dispose()
+
+
+def test_metrics(authorized_client, test_tasks):
+    metrics.clear()
+    task_id = test_tasks[0].id
+    authorized_client.get(f"/tasks/{task_id}")
+    res = authorized_client.get("/metrics")
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain")
+    body = res.text
+    assert 'http_request_duration_seconds_count{method="GET",route="/tasks/{id}",status="200"} 1' in body
+    assert 'http_request_db_statements_count{route="/tasks/{id}"} 1' in body
+    assert 'db_pool_checked_out{pool="primary"}' in body
+    assert "principal_cache_hits_total" in body
+
+
+def test_metrics_count_statements_per_request(authorized_client, test_tasks):
+    authorized_client.get("/tasks/")
+    metrics.clear()
+    authorized_client.get("/tasks/")
+    body = authorized_client.get("/metrics").text
+    # the first request cached the principal, so listing tasks is the share lookup and a single page
+    assert 'http_request_db_statements_bucket{route="/tasks/",le="1"} 0' in body
+    assert 'http_request_db_statements_bucket{route="/tasks/",le="2"} 1' in body
+
+
+def test_verify_access_token_span(client, token):
+    metrics.clear()
+    client.get("/tasks", headers={"Authorization": f"Bearer {token}"})
+    assert 'span_duration_seconds_count{span="oauth2.verify_access_token"} 1' in metrics.render()
+
+
+def test_slow_query_log(monkeypatch, authorized_client, caplog):
+    monkeypatch.setattr(settings, "slow_query_threshold_ms", 0)
+    with caplog.at_level(logging.WARNING, logger="app.slow_query"):
+        authorized_client.get("/tasks")
+    assert any("tasks" in record.getMessage() for record in caplog.records)
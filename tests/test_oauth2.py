@@ -0,0 +1,61 @@
+from app import models
+from app.cache import TTLCache
+from app.oauth2 import principal_cache
+import time
+
+
+def test_principal_cache_hit(authorized_client, test_user):
+    authorized_client.get("/tasks")
+    hits = principal_cache.hits
+    res = authorized_client.get("/tasks")
+    assert res.status_code == 200
+    assert principal_cache.hits == hits + 1
+    assert len(principal_cache) == 1
+
+
+def test_principal_cache_invalidated_on_user_update(authorized_client, test_user, session):
+    authorized_client.get("/tasks")
+    assert len(principal_cache) == 1
+    user = session.get(models.User, test_user['id'])
+    user.username = "renamed"
+    session.commit()
+    assert len(principal_cache) == 0
+
+
+def test_principal_cache_invalidated_on_user_delete(authorized_client, test_user, session):
+    authorized_client.get("/tasks")
+    session.delete(session.get(models.User, test_user['id']))
+    session.commit()
+    res = authorized_client.get("/tasks")
+    assert res.status_code == 401
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1, ttl=0.01)
+    cache.set("b", 2, ttl=-1)
+    time.sleep(0.02)
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.stats() == {"hits": 0, "misses": 2, "size": 0, "maxsize": 2}
+
+
+def test_ttl_cache_invalidate_owner():
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1, owner=1)
+    cache.set("b", 2, owner=1)
+    cache.set("c", 3, owner=2)
+    cache.invalidate(1)
+    assert len(cache) == 1
+    assert cache.get("c") == 3
@@ -0,0 +1,157 @@
+from app import crud, database, models, versions, writebehind
+from app.config import settings
+from app.database import Base, PrimaryCookie, ReplicaRouter, RoutingSession, current_user_id, make_engine, primary_cookie, run
+from sqlalchemy.orm import sessionmaker
+from starlette.requests import Request
+import asyncio
+import pytest
+import time
+
+
+@pytest.fixture
+def databases(tmp_path):
+    """Two SQLite files standing in for a primary and its replica, with a user on each."""
+    primary = make_engine(f"sqlite:///{tmp_path / 'primary.db'}")
+    replica = make_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    for engine, username in ((primary, "on-primary"), (replica, "on-replica")):
+        Base.metadata.create_all(bind=engine)
+        with sessionmaker(bind=engine)() as db:
+            db.add(models.User(id=1, username=username, email=f"{username}@test.com", password="x"))
+            db.commit()
+    yield primary, replica
+    primary.dispose()
+    replica.dispose()
+
+
+def sessions(primary, replicas, sticky_seconds=60):
+    router = ReplicaRouter(replicas, sticky_seconds=sticky_seconds, retry_seconds=60)
+    return router, sessionmaker(class_=RoutingSession, bind=primary, router=router)
+
+
+def username(db):
+    return asyncio.run(run(db, crud.get_user, 1)).username
+
+
+def test_reads_go_to_replica_and_writes_to_primary(databases):
+    primary, replica = databases
+    router, Session = sessions(primary, [replica])
+
+    with Session(read_only=True) as db:
+        assert username(db) == "on-replica"
+    with Session() as db:
+        assert username(db) == "on-primary"
+
+
+def test_reads_stick_to_primary_after_a_write(databases):
+    primary, replica = databases
+    router, Session = sessions(primary, [replica], sticky_seconds=0.2)
+
+    token = current_user_id.set(1)
+    try:
+        with Session() as db:
+            asyncio.run(run(db, crud.update_user_password, 1, "y"))
+        with Session(read_only=True) as db:
+            assert username(db) == "on-primary"
+
+        current_user_id.set(2)
+        with Session(read_only=True) as db:
+            assert username(db) == "on-replica"
+
+        current_user_id.set(1)
+        time.sleep(0.3)
+        with Session(read_only=True) as db:
+            assert username(db) == "on-replica"
+    finally:
+        current_user_id.reset(token)
+
+
+def test_primary_cookie_carries_writes_to_other_workers(databases):
+    primary, replica = databases
+    # two workers, each with its own router
+    _, worker = sessions(primary, [replica])
+    _, other_worker = sessions(primary, [replica])
+
+    user = current_user_id.set(1)
+    cookie = PrimaryCookie()
+    request = primary_cookie.set(cookie)
+    try:
+        with worker() as db:
+            asyncio.run(run(db, crud.update_user_password, 1, "y"))
+        assert cookie.changed
+        value = cookie.header().split(";")[0].split("=", 1)[1]
+
+        # the next request reaches the other worker with the cookie
+        primary_cookie.set(PrimaryCookie.parse(value))
+        with other_worker(read_only=True) as db:
+            assert username(db) == "on-primary"
+        # only for the user it was set for
+        current_user_id.set(2)
+        with other_worker(read_only=True) as db:
+            assert username(db) == "on-replica"
+
+        current_user_id.set(1)
+        user_id, until, signature = value.split(":")
+        for forged in (f"{user_id}:{int(until) + 60}:{signature}", f"2:{until}:{signature}", "garbage"):
+            primary_cookie.set(PrimaryCookie.parse(forged))
+            with other_worker(read_only=True) as db:
+                assert username(db) == "on-replica"
+    finally:
+        primary_cookie.reset(request)
+        current_user_id.reset(user)
+
+
+def test_expired_primary_cookie_reads_from_replica(databases):
+    primary, replica = databases
+    _, Session = sessions(primary, [replica])
+    user = current_user_id.set(1)
+    request = primary_cookie.set(PrimaryCookie(1, time.time() - 1))
+    try:
+        with Session(read_only=True) as db:
+            assert username(db) == "on-replica"
+    finally:
+        primary_cookie.reset(request)
+        current_user_id.reset(user)
+
+
+def test_queued_toggles_set_the_primary_cookie(authorized_client, test_tasks, test_user, monkeypatch):
+    # the toggle commits with a later flush, the client reads from the primary until it has replicated
+    monkeypatch.setattr(writebehind, "queue", writebehind.ToggleQueue(flush_seconds=60, max_items=100))
+    monkeypatch.setattr(settings, "task_status_write_behind", True)
+    for router in (database.replica_router, database.async_replica_router):
+        monkeypatch.setattr(router, "replicas", [object()])
+    assert "primary_until" not in authorized_client.get("/tasks").headers.get("set-cookie", "")
+
+    res = authorized_client.patch(f"/tasks/{test_tasks[0].id}", json={"done": True})
+    assert res.status_code == 202
+    cookie = PrimaryCookie.parse(res.cookies["primary_until"])
+    assert cookie.user_id == test_user['id']
+    assert cookie.until >= time.time() + 60 + settings.replica_sticky_seconds - 1
+    assert "HttpOnly" in res.headers["set-cookie"]
+
+
+def test_failing_replica_falls_back_to_primary(databases, tmp_path):
+    primary, _ = databases
+    unreachable = make_engine(f"sqlite:///{tmp_path / 'missing' / 'replica.db'}")
+    router, Session = sessions(primary, [unreachable])
+
+    with Session(read_only=True) as db:
+        assert username(db) == "on-primary"
+    # skipped without trying it again until retry_seconds have passed
+    assert router.replica(None) is None
+    unreachable.dispose()
+
+
+@pytest.mark.parametrize("store, tagged", [(versions.MemoryVersionStore(), False), (versions.DatabaseVersionStore(), True)])
+def test_etags_from_replicas_need_shared_versions(databases, monkeypatch, store, tagged):
+    # in-process versions are the primary's, they can't describe what a lagging replica serves
+    primary, replica = databases
+    router, Session = sessions(primary, [replica])
+    monkeypatch.setattr(versions, "store", store)
+    request = Request({"type": "http", "path": "/tasks/", "query_string": b"", "headers": []})
+
+    with Session(read_only=True) as db:
+        tag, _ = asyncio.run(versions.etag(db, 1, request))
+        assert ("ETag" in versions.headers(tag)) == tagged
+    with Session() as db:
+        tag, _ = asyncio.run(versions.etag(db, 1, request))
+        assert tag is not None
@@ -0,0 +1,236 @@
+from app import archive, models, ratelimit, shards, transfer, versions
+from app.database import Base, RoutingSession, get_db, get_read_db, make_engine
+from app.main import app
+from app.oauth2 import create_access_token, principal_cache
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+import pytest
+
+# users 1 and 3 hash to shard 0 of three, user 2 to shard 1. Of two shards, all three hash to shard 1
+
+
+def shard_files(tmp_path, count):
+    """SQLite files standing in for the primary (shard 0) and the other shards, whatever the test database."""
+    engines = [make_engine(f"sqlite:///{tmp_path / f'shard_{shard}.db'}") for shard in range(count)]
+    for engine in engines:
+        Base.metadata.create_all(bind=engine)
+    shards.start_task_ids(shards.ShardRouter(engines, "hash", cache_seconds=0))
+    return engines
+
+
+@pytest.fixture(params=["hash", "directory"])
+def router(request, tmp_path):
+    router = shards.ShardRouter(shard_files(tmp_path, 3), request.param, cache_seconds=0)
+    yield router
+    for engine in router.engines:
+        engine.dispose()
+
+
+def serve(router):
+    """A client whose sessions route through `router`, reads included."""
+    Session = sessionmaker(class_=RoutingSession, autoflush=False, bind=router.engines[0], shard_router=router)
+
+    def override_get_db():
+        with Session() as db:
+            yield db
+
+    principal_cache.clear()
+    versions.store = versions.MemoryVersionStore()
+    ratelimit.store = ratelimit.MemoryBucketStore()
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_read_db] = override_get_db
+    return TestClient(app)
+
+
+@pytest.fixture
+def client(router):
+    yield serve(router)
+    app.dependency_overrides.clear()
+
+
+def sign_up(client, username):
+    res = client.post("/users/", json={"email": f"{username}@test.com", "username": username, "password": "test"})
+    assert res.status_code == 201
+    return res.json()['id']
+
+
+def authorized(client, user_id):
+    return {"Authorization": f"Bearer {create_access_token({'user_id': user_id})}"}
+
+
+def task_rows(engine):
+    with engine.connect() as connection:
+        return connection.execute(select(models.Task.id, models.Task.owner_id, models.Task.title).order_by(models.Task.id)).all()
+
+
+def titles(client, user_id, **params):
+    return [task['title'] for task in client.get("/tasks/", params=params, headers=authorized(client, user_id)).json()]
+
+
+def test_tasks_live_on_their_owners_shard(router, client):
+    first, second = sign_up(client, "first"), sign_up(client, "second")
+    for user_id in (first, second):
+        res = client.post("/tasks/bulk", json={"tasks": [{"title": f"{user_id}-{n}", "content": "c"} for n in range(2)]}, headers=authorized(client, user_id))
+        assert res.status_code == 201
+
+    assert [(owner, title) for _, owner, title in task_rows(router.engines[0])] == [(first, "1-0"), (first, "1-1")]
+    second_tasks = task_rows(router.engines[1])
+    assert [(owner, title) for _, owner, title in second_tasks] == [(second, "2-0"), (second, "2-1")]
+    # ids come from the one counter, whatever the shard
+    assert [id for id, _, _ in task_rows(router.engines[0]) + second_tasks] == [1, 2, 3, 4]
+
+    assert titles(client, second) == ["2-0", "2-1"]
+    assert client.get("/tasks/stats", headers=authorized(client, second)).json()["total"] == 2
+    id = second_tasks[0].id
+    assert client.put(f"/tasks/{id}", json={"title": "updated", "content": "c"}, headers=authorized(client, second)).status_code == 200
+    assert client.patch(f"/tasks/{id}", json={"done": True}, headers=authorized(client, second)).status_code == 200
+    assert client.get(f"/tasks/{id}", headers=authorized(client, second)).json()["done"] is True
+    assert client.delete(f"/tasks/{id}", headers=authorized(client, second)).status_code == 204
+    assert titles(client, second) == ["2-1"]
+
+
+def test_shared_tasks_across_shards(router, client):
+    first, second = sign_up(client, "first"), sign_up(client, "second")
+    for user_id, title in ((first, "a"), (second, "b"), (first, "c"), (second, "d")):
+        client.post("/tasks/", json={"title": title, "content": "shared"}, headers=authorized(client, user_id))
+    client.post("/tasks/share", json={"email": "second@test.com", "share": True}, headers=authorized(client, first))
+    first_id = task_rows(router.engines[0])[0].id
+    second_id = task_rows(router.engines[1])[0].id
+
+    # pages are merged from both shards in the usual order
+    assert titles(client, second) == ["a", "b", "c", "d"]
+    assert titles(client, second, skip=1, limit=2) == ["b", "c"]
+    page = client.get("/tasks/", params={"cursor": "", "limit": 3}, headers=authorized(client, second))
+    assert titles(client, second, cursor=page.headers["X-Next-Cursor"]) == ["d"]
+    # every task ranks the same, ties go by id, the order the tasks were created in whatever their shard
+    assert titles(client, second, search="shared", ranked=True, include_owner=False) == ["a", "b", "c", "d"]
+    assert client.get("/tasks/", headers=authorized(client, second)).json()[0]["owner"]["username"] == "first"
+
+    assert client.get(f"/tasks/{first_id}", headers=authorized(client, second)).json()["title"] == "a"
+    assert client.get(f"/tasks/{second_id}", headers=authorized(client, first)).status_code == 403
+    assert client.get("/tasks/1000000000", headers=authorized(client, first)).status_code == 404
+    assert client.delete(f"/tasks/{first_id}", headers=authorized(client, second)).status_code == 403
+    results = client.request("DELETE", "/tasks/bulk", json={"ids": [second_id, first_id, 1000000000]}, headers=authorized(client, second)).json()["results"]
+    assert [result["status"] for result in results] == [204, 403, 404]
+
+    stats = client.get("/tasks/stats", headers=authorized(client, second)).json()
+    assert (stats["total"], stats["shared"]["total"]) == (1, 2)
+
+
+def test_import_and_export_on_the_owners_shard(router, client):
+    sign_up(client, "first")
+    second = sign_up(client, "second")
+    body = b"".join(b'{"title": "imported %d", "content": "c"}\n' % n for n in range(3))
+    assert client.post("/tasks/import", content=body, headers=authorized(client, second)).json() == {"imported": 3}
+    assert len(task_rows(router.engines[1])) == 3
+
+    exported = client.get("/tasks/export", headers=authorized(client, second)).text.splitlines()
+    assert len(exported) == 3
+
+
+@pytest.mark.parametrize("router", ["directory"], indirect=True)
+def test_move_user(router, client):
+    first, second = sign_up(client, "first"), sign_up(client, "second")
+    client.post("/tasks/bulk", json={"tasks": [{"title": f"task {n}", "content": "c"} for n in range(3)]}, headers=authorized(client, second))
+    client.post("/tasks/share", json={"email": "first@test.com", "share": True}, headers=authorized(client, second))
+    with router.engines[1].begin() as connection:
+        archive.archive_rows(connection, models.Task.title == "task 1")
+    before = client.get("/tasks/", headers=authorized(client, first))
+    ids = [id for id, _, _ in task_rows(router.engines[1])]
+
+    assert shards.move_user(router, second, 2, grace_seconds=0) == 3
+    assert task_rows(router.engines[1]) == []
+    moved = task_rows(router.engines[2])
+    # the tasks keep their ids
+    assert [(id, title) for id, _, title in moved] == [(ids[0], "task 0"), (ids[1], "task 2")]
+    # archived tasks move along and stay archived
+    with router.engines[1].connect() as connection:
+        assert connection.execute(select(models.TaskArchive.id)).all() == []
+    assert titles(client, second, include_archived=True) == ["task 0", "task 1", "task 2"]
+
+    # the recipient's cached list and ids still hold
+    after = client.get("/tasks/", headers={**authorized(client, first), "If-None-Match": before.headers["ETag"]})
+    assert after.status_code == 304
+    assert client.get(f"/tasks/{ids[1]}", headers=authorized(client, first)).json()["title"] == "task 2"
+    assert client.patch(f"/tasks/{ids[0]}", json={"done": True}, headers=authorized(client, second)).status_code == 200
+    assert client.post("/tasks/", json={"title": "new", "content": "c"}, headers=authorized(client, second)).json()["id"] > ids[-1]
+
+
+def test_task_ids_come_in_blocks(tmp_path, monkeypatch):
+    engines = shard_files(tmp_path, 2)
+    monkeypatch.setattr(shards, "TASK_ID_BLOCK", 3)
+    # two workers, each taking its own blocks from the counter
+    first, second = (shards.ShardRouter(engines, "hash", cache_seconds=0) for _ in range(2))
+
+    def new_task_ids(router, count, commit=True):
+        with RoutingSession(bind=engines[0], shard_router=router) as db:
+            ids = router.new_task_ids(db, count)
+            if commit:
+                db.commit()
+        return ids
+
+    try:
+        assert new_task_ids(first, 2) + new_task_ids(second, 2) + new_task_ids(first, 4) == [1, 2, 4, 5, 3, 7, 8, 9]
+        # a block reserved by a transaction that rolled back is reserved again
+        assert new_task_ids(second, 2, commit=False) == [6, 10]
+        assert new_task_ids(second, 2) == [10, 11]
+        # init again leaves the counter where it is
+        shards.start_task_ids(first)
+        assert new_task_ids(second, 2) == [12, 13]
+    finally:
+        for engine in engines:
+            engine.dispose()
+
+
+@pytest.mark.parametrize("router", ["hash"], indirect=True)
+def test_import_more_than_a_block_on_the_primary(router, client, monkeypatch):
+    monkeypatch.setattr(shards, "TASK_ID_BLOCK", 3)
+    monkeypatch.setattr(transfer, "BATCH_SIZE", 4)
+    user_id = sign_up(client, "first")
+    body = b"".join(b'{"title": "imported %d", "content": "c"}\n' % n for n in range(10))
+    # reserving the next blocks waits on nothing the import itself holds
+    res = client.post("/tasks/import", content=body, headers=authorized(client, user_id))
+    assert res.status_code == 201
+    assert res.json() == {"imported": 10}
+    ids = [id for id, _, _ in task_rows(router.engines[0])]
+    assert ids == list(range(ids[0], ids[0] + 10))
+    assert client.post("/tasks/", json={"title": "new", "content": "c"}, headers=authorized(client, user_id)).json()["id"] > ids[-1]
+
+
+@pytest.mark.parametrize("router", ["directory"], indirect=True)
+def test_writes_wait_while_moving(router, client):
+    user_id = sign_up(client, "first")
+    client.post("/tasks/", json={"title": "before", "content": "c"}, headers=authorized(client, user_id))
+    shards.set_placement(router, user_id, 0, moving=True)
+
+    res = client.post("/tasks/", json={"title": "during", "content": "c"}, headers=authorized(client, user_id))
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+    # reads are still served from the old shard
+    assert titles(client, user_id) == ["before"]
+
+    shards.set_placement(router, user_id, 0, moving=False)
+    assert client.post("/tasks/", json={"title": "after", "content": "c"}, headers=authorized(client, user_id)).status_code == 201
+
+
+def test_hash_rebalance_after_adding_a_shard(tmp_path):
+    engines = shard_files(tmp_path, 3)
+    client = serve(shards.ShardRouter(engines[:2], "hash", cache_seconds=0))
+    try:
+        users = [sign_up(client, f"user{n}") for n in range(3)]
+        for user_id in users:
+            client.post("/tasks/", json={"title": f"{user_id}", "content": "c"}, headers=authorized(client, user_id))
+        assert len(task_rows(engines[1])) == 3
+
+        grown = shards.ShardRouter(engines, "hash", cache_seconds=0)
+        assert shards.rebalance(grown, log=lambda message: None) == 2
+        assert [(owner, title) for _, owner, title in task_rows(engines[0])] == [(1, "1"), (3, "3")]
+        assert [(owner, title) for _, owner, title in task_rows(engines[1])] == [(2, "2")]
+
+        client = serve(grown)
+        assert [titles(client, user_id) for user_id in users] == [["1"], ["2"], ["3"]]
+    finally:
+        app.dependency_overrides.clear()
+        for engine in engines:
+            engine.dispose()
@@ -1,4 +1,13 @@
-from app import schemas
+from app import crud, models, schemas, transfer, versions, writebehind
+from app.config import settings
+from app.oauth2 import create_access_token
+from datetime import datetime, timezone
+from sqlalchemy import event, select, update
+from sqlalchemy.orm import sessionmaker
+import asyncio
+import csv
+import io
+import json
 import pytest
 
 def test_get_all_tasks(authorized_client, test_tasks):
@@ -101,4 +110,591 @@ def test_update_task_non_exist(authorized_client, test_user, test_tasks):
         "id": test_tasks[3].id
     }
     res = authorized_client.put(f"/tasks/8000000", json=data)
-    assert res.status_code == 404
\ No newline at end of file
+    assert res.status_code == 404
+
+def test_get_tasks_legacy_skip(authorized_client, test_tasks):
+    res = authorized_client.get("/tasks", params={"limit": 2, "skip": 2})
+    assert res.status_code == 200
+    assert [task['id'] for task in res.json()] == [test_tasks[2].id]
+
+
+@pytest.mark.parametrize("params", [{"limit": -1}, {"skip": -1}, {"limit": -1, "include_archived": True}, {"skip": -1, "include_archived": True}])
+def test_get_tasks_negative_limit_or_skip(authorized_client, test_tasks, params):
+    res = authorized_client.get("/tasks", params=params)
+    assert res.status_code == 422
+
+def test_get_tasks_cursor_pagination(authorized_client, test_tasks):
+    res = authorized_client.get("/tasks", params={"limit": 2, "cursor": ""})
+    assert res.status_code == 200
+    first_page = [task['id'] for task in res.json()]
+    assert len(first_page) == 2
+    next_cursor = res.headers["X-Next-Cursor"]
+
+    res = authorized_client.get("/tasks", params={"limit": 2, "cursor": next_cursor})
+    assert res.status_code == 200
+    second_page = [task['id'] for task in res.json()]
+    assert "X-Next-Cursor" not in res.headers
+    assert first_page + second_page == [task.id for task in test_tasks[:3]]
+
+
+def test_get_tasks_invalid_cursor(authorized_client, test_tasks):
+    res = authorized_client.get("/tasks", params={"cursor": "not-a-cursor"})
+    assert res.status_code == 400
+
+
+@pytest.mark.parametrize("search, expected", [
+    ("", [0, 1, 2]),
+    ("first", [0]),
+    ("seco", [1]),
+    ("third content", [2]),
+    ("content", [0, 1, 2]),
+    ("fourth", []),
+    ("nothing", []),
+])
+def test_search_tasks(authorized_client, test_tasks, search, expected):
+    res = authorized_client.get("/tasks", params={"search": search})
+    assert res.status_code == 200
+    assert [task['id'] for task in res.json()] == [test_tasks[i].id for i in expected]
+
+
+def test_search_tasks_ranked(authorized_client, test_tasks, session):
+    session.add(models.Task(title="groceries", content="groceries, groceries and more groceries", owner_id=test_tasks[0].owner_id))
+    session.add(models.Task(title="errands", content="pick up groceries", owner_id=test_tasks[0].owner_id))
+    session.commit()
+    res = authorized_client.get("/tasks", params={"search": "groceries", "ranked": True})
+    assert res.status_code == 200
+    assert [task['title'] for task in res.json()] == ["groceries", "errands"]
+
+
+def test_search_tasks_ranked_with_cursor(authorized_client, test_tasks):
+    res = authorized_client.get("/tasks", params={"search": "first", "ranked": True, "cursor": ""})
+    assert res.status_code == 400
+
+
+def test_bulk_create_tasks(authorized_client, test_user):
+    tasks = [{"title": f"title {n}", "content": f"content {n}", "done": n % 2 == 0} for n in range(5)]
+    res = authorized_client.post("/tasks/bulk", json={"tasks": tasks})
+    assert res.status_code == 201
+    results = res.json()['results']
+    assert [result['status'] for result in results] == [201] * 5
+
+    res = authorized_client.get("/tasks", params={"limit": 10})
+    created = res.json()
+    assert [task['id'] for task in created] == [result['id'] for result in results]
+    assert [(task['title'], task['done']) for task in created] == [(task['title'], task['done']) for task in tasks]
+
+
+def test_bulk_create_tasks_empty(authorized_client):
+    res = authorized_client.post("/tasks/bulk", json={"tasks": []})
+    assert res.status_code == 422
+
+
+def test_bulk_update_tasks_status(authorized_client, test_tasks):
+    ids = [test_tasks[0].id, test_tasks[1].id, test_tasks[3].id, 8000000]
+    res = authorized_client.patch("/tasks/bulk", json={"ids": ids, "done": True})
+    assert res.status_code == 200
+    assert [(result['id'], result['status']) for result in res.json()['results']] == list(zip(ids, [200, 200, 403, 404]))
+
+    res = authorized_client.get("/tasks")
+    assert [task['done'] for task in res.json()] == [True, True, False]
+
+
+def test_bulk_delete_tasks(authorized_client, test_tasks):
+    ids = [test_tasks[0].id, test_tasks[3].id, 8000000]
+    remaining = [test_tasks[1].id, test_tasks[2].id]
+    res = authorized_client.request("DELETE", "/tasks/bulk", json={"ids": ids})
+    assert res.status_code == 200
+    assert [result['status'] for result in res.json()['results']] == [204, 403, 404]
+
+    res = authorized_client.get("/tasks")
+    assert [task['id'] for task in res.json()] == remaining
+
+
+def test_unauthorized_user_bulk_create_tasks(client):
+    res = client.post("/tasks/bulk", json={"tasks": [{"title": "title", "content": "content"}]})
+    assert res.status_code == 401
+
+
+@pytest.fixture
+def test_user2_headers(test_user2):
+    return {"Authorization": f"Bearer {create_access_token({'user_id': test_user2['id']})}"}
+
+
+def test_share_tasks(authorized_client, test_tasks, test_user2, test_user2_headers, session):
+    shared_ids = [task.id for task in test_tasks[:3]]
+    own_id = test_tasks[3].id
+    task_count = session.query(models.Task).count()
+
+    res = authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": True})
+    assert res.status_code == 200
+    # sharing twice is a no-op
+    res = authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": True})
+    assert res.status_code == 200
+    assert session.query(models.Task).count() == task_count
+
+    res = authorized_client.get("/tasks", headers=test_user2_headers)
+    assert sorted(task['id'] for task in res.json()) == sorted(shared_ids + [own_id])
+
+    res = authorized_client.get(f"/tasks/{shared_ids[0]}", headers=test_user2_headers)
+    assert res.status_code == 200
+    res = authorized_client.put(f"/tasks/{shared_ids[0]}", json={"title": "title", "content": "content"}, headers=test_user2_headers)
+    assert res.status_code == 403
+
+
+def test_unshare_tasks(authorized_client, test_tasks, test_user2, test_user2_headers):
+    shared_ids = [task.id for task in test_tasks[:3]]
+    own_id = test_tasks[3].id
+    authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": True})
+
+    res = authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": False})
+    assert res.status_code == 200
+
+    res = authorized_client.get("/tasks", headers=test_user2_headers)
+    assert [task['id'] for task in res.json()] == [own_id]
+    res = authorized_client.get(f"/tasks/{shared_ids[0]}", headers=test_user2_headers)
+    assert res.status_code == 403
+    # the owner keeps their tasks
+    res = authorized_client.get("/tasks")
+    assert [task['id'] for task in res.json()] == shared_ids
+
+
+def test_share_tasks_with_unknown_user(authorized_client, test_tasks):
+    res = authorized_client.post("/tasks/share", json={"email": "nobody@test.com", "share": True})
+    assert res.status_code == 404
+
+
+def test_shared_tasks_follow_owner_changes(authorized_client, test_tasks, test_user2, test_user2_headers):
+    authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": True})
+    res = authorized_client.post("/tasks", json={"title": "new title", "content": "new content"})
+    new_id = res.json()['id']
+
+    res = authorized_client.get("/tasks", headers=test_user2_headers)
+    assert new_id in [task['id'] for task in res.json()]
+
+
+# the mutation itself, plus the version bump when versions are kept in the database
+@pytest.mark.parametrize("method, path, body", [
+    ("put", "/tasks/{id}", {"title": "updated title", "content": "updated content"}),
+    ("patch", "/tasks/{id}", {"done": True}),
+    ("delete", "/tasks/{id}", None),
+    ("post", "/tasks", {"title": "new title", "content": "new content"}),
+])
+def test_task_mutation_statement_count(authorized_client, test_tasks, version_store, statements, method, path, body):
+    path = path.format(id=test_tasks[0].id)
+    # the first request also loads the caller into the principal cache
+    authorized_client.get("/tasks")
+    statements.clear()
+    res = authorized_client.request(method.upper(), path, json=body)
+    assert res.status_code < 300
+    assert len(statements) == 1 + version_store.shared
+
+
+@pytest.mark.parametrize("method, body, status_code", [
+    ("PUT", {"title": "updated title", "content": "updated content"}, 403),
+    ("PATCH", {"done": True}, 403),
+    ("DELETE", None, 403),
+])
+def test_task_mutation_statement_count_when_not_owned(authorized_client, test_tasks, statements, method, body, status_code):
+    id = test_tasks[3].id
+    authorized_client.get("/tasks")
+    statements.clear()
+    res = authorized_client.request(method, f"/tasks/{id}", json=body)
+    assert res.status_code == status_code
+    assert len(statements) == 2
+
+
+def test_get_tasks_statement_count(authorized_client, test_tasks, test_user2, test_user2_headers, session, statements):
+    # tasks of two different owners on the same page: who shares with the caller, then a page per owner
+    owner_ids = {test_tasks[0].owner_id, test_tasks[3].owner_id}
+    authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": True})
+    authorized_client.get("/tasks", headers=test_user2_headers)
+    statements.clear()
+    res = authorized_client.get("/tasks", headers=test_user2_headers)
+    assert len(res.json()) == 4
+    assert {task['owner']['id'] for task in res.json()} == owner_ids
+    assert len(statements) == 3
+    assert "task_shares" in statements[0]
+
+
+def page_plans(session, fetch):
+    """The query plan of each statement `fetch` runs against tasks. On PostgreSQL scans and sorts a plan can do without
+    are discouraged, a handful of rows would otherwise always be read whole and sorted."""
+    bind = session.get_bind()
+    executed = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        executed.append((statement, parameters))
+
+    event.listen(bind, "before_cursor_execute", record)
+    try:
+        fetch()
+    finally:
+        event.remove(bind, "before_cursor_execute", record)
+
+    explain = "EXPLAIN QUERY PLAN " if bind.dialect.name == "sqlite" else "EXPLAIN "
+    with bind.connect() as connection:
+        if bind.dialect.name == "postgresql":
+            for setting in ("enable_seqscan", "enable_bitmapscan", "enable_sort"):
+                connection.exec_driver_sql(f"SET {setting} = off")
+        return ["\n".join(str(row[-1]) for row in connection.exec_driver_sql(explain + statement, parameters))
+                for statement, parameters in executed if "FROM tasks" in statement]
+
+
+@pytest.mark.parametrize("cursor_position", [None, (datetime(2000, 1, 1, tzinfo=timezone.utc), 0)])
+def test_get_tasks_pages_follow_the_owner_index(test_tasks, test_user2, session, cursor_position):
+    # the pages of a user sharing nothing and of one with a share read rows in page order, no sort of every task
+    session.add(models.TaskShare(user_id=test_user2['id'], owner_id=test_tasks[0].owner_id))
+    session.commit()
+    for user_id, pages in ((test_tasks[0].owner_id, 1), (test_user2['id'], 2)):
+        plans = page_plans(session, lambda: crud.get_tasks(session, user_id, 10, 0, "", False, cursor_position))
+        assert len(plans) == pages
+        for plan in plans:
+            assert "ix_tasks_owner_id_created_at_id" in plan
+            assert "TEMP B-TREE" not in plan and "Sort" not in plan
+
+
+def test_get_tasks_without_owner(authorized_client, test_tasks, statements):
+    authorized_client.get("/tasks")
+    statements.clear()
+    res = authorized_client.get("/tasks", params={"include_owner": False})
+    assert res.status_code == 200
+    assert all("owner" not in task and "owner_id" in task for task in res.json())
+    assert len(statements) == 2
+    assert all("users" not in statement for statement in statements)
+
+
+def test_get_tasks_fields(authorized_client, test_tasks):
+    expected = [{"id": task.id, "title": task.title} for task in test_tasks[:2]]
+    res = authorized_client.get("/tasks", params={"fields": "id,title", "limit": 2})
+    assert res.status_code == 200
+    assert res.json() == expected
+    assert "X-Next-Cursor" in res.headers
+
+
+def test_get_tasks_documents_items(client):
+    # GET /tasks answers with ORJSONResponse directly, its items are only documented
+    response = client.get("/openapi.json").json()["paths"]["/tasks/"]["get"]["responses"]["200"]
+    assert response["content"]["application/json"]["schema"]["items"] == {"$ref": "#/components/schemas/TaskPartial"}
+
+
+def test_get_tasks_unknown_fields(authorized_client, test_tasks):
+    res = authorized_client.get("/tasks", params={"fields": "id,password"})
+    assert res.status_code == 400
+
+
+def test_get_one_task_fields(authorized_client, test_tasks, statements):
+    id = test_tasks[0].id
+    authorized_client.get("/tasks")
+    statements.clear()
+    res = authorized_client.get(f"/tasks/{id}", params={"fields": "title,owner"})
+    assert res.status_code == 200
+    assert set(res.json()) == {"title", "owner"}
+    # the versions behind the ETag, then the task and its owner
+    assert len(statements) == 2
+
+
+@pytest.mark.parametrize("format", ["ndjson", "csv"])
+def test_export_tasks(authorized_client, test_tasks, format):
+    expected = [(task.id, task.title) for task in test_tasks[:3]]
+    res = authorized_client.get("/tasks/export", params={"format": format})
+    assert res.status_code == 200
+    if format == "ndjson":
+        exported = [json.loads(line) for line in res.text.splitlines()]
+    else:
+        exported = list(csv.DictReader(io.StringIO(res.text)))
+    assert [(int(task['id']), task['title']) for task in exported] == expected
+
+
+@pytest.mark.parametrize("format", ["ndjson", "csv"])
+def test_export_import_round_trip(authorized_client, test_tasks, test_user2_headers, format):
+    exported = authorized_client.get("/tasks/export", params={"format": format}).content
+
+    res = authorized_client.post("/tasks/import", params={"format": format}, content=exported, headers=test_user2_headers)
+    assert res.status_code == 201
+    assert res.json() == {"imported": 3}
+
+    fields = {"fields": "title,content,done,created_at,owner_id"}
+    imported = authorized_client.get("/tasks", params=fields, headers=test_user2_headers).json()
+    original = authorized_client.get("/tasks", params=fields).json()
+    owner_id = imported[0]['owner_id']
+    assert [task for task in imported if task['title'] != "fourth title"] == [{**task, "owner_id": owner_id} for task in original]
+
+
+def test_import_tasks_csv_quoting(authorized_client, test_user):
+    body = 'title,content,done\r\n"multi, line","first\r\nsecond ""quoted""",true\r\nplain,text,false'
+    res = authorized_client.post("/tasks/import", params={"format": "csv"}, content=body.encode())
+    assert res.status_code == 201
+    assert res.json() == {"imported": 2}
+
+    res = authorized_client.get("/tasks", params={"fields": "title,content,done"})
+    assert res.json() == [
+        {"title": "multi, line", "content": 'first\r\nsecond "quoted"', "done": True},
+        {"title": "plain", "content": "text", "done": False},
+    ]
+
+
+@pytest.mark.parametrize("format, body", [
+    ("ndjson", b'{"title": "", "content": ""}\n{"title": "t", "content": ""}\n'),
+    ("csv", b'title,content\n"",""\nt,\n'),
+])
+def test_import_empty_strings(authorized_client, test_user, format, body):
+    res = authorized_client.post("/tasks/import", params={"format": format}, content=body)
+    assert res.status_code == 201
+    res = authorized_client.get("/tasks", params={"fields": "title,content"})
+    assert res.json() == [{"title": "", "content": ""}, {"title": "t", "content": ""}]
+
+
+def test_insert_batch_keeps_empty_strings(session, test_user, statements):
+    # PostgreSQL's psycopg2 sessions load through COPY, which sends no statement
+    rows = [{"title": "", "content": "", "done": False, "created_at": datetime.now(timezone.utc), "owner_id": test_user['id']}]
+    transfer.insert_batch(session, rows)
+    session.commit()
+    assert (statements == []) == (session.get_bind().dialect.name == "postgresql")
+    task = session.scalars(select(models.Task)).one()
+    assert (task.title, task.content) == ("", "")
+
+
+@pytest.mark.parametrize("format, chunks", [
+    ("csv", [b"title,content\nd\xc3", b"\xa9j\xc3\xa0,vu\n"]),
+    ("ndjson", [b'{"title": "d\xc3', b'\xa9j\xc3\xa0", "content": "vu"}\n']),
+])
+def test_import_characters_split_across_chunks(format, chunks):
+    async def body():
+        for chunk in chunks:
+            yield chunk
+
+    async def records():
+        return [record async for record in transfer.parse_records(body(), format)]
+
+    assert asyncio.run(records()) == [{"title": "déjà", "content": "vu"}]
+
+
+def test_import_invalid_task(authorized_client, test_user):
+    body = b'{"title": "ok", "content": "ok"}\n{"title": "missing content"}\n'
+    res = authorized_client.post("/tasks/import", content=body)
+    assert res.status_code == 400
+
+    res = authorized_client.get("/tasks")
+    assert res.json() == []
+
+
+@pytest.mark.parametrize("format, body, record", [
+    ("ndjson", b'{"title": "ok", "content": "ok"}\n{not json\n', 2),
+    ("ndjson", b'{"title": "ok", "content": "ok"}\n{"title": "cut', 2),
+    ("csv", b'title,content\nok,ok\nbad,\xff\xfe\n', 2),
+    ("csv", b'title,content\nok,ok\ncut,\xc3', 2),
+])
+def test_import_undecodable_record(authorized_client, test_user, format, body, record):
+    res = authorized_client.post("/tasks/import", params={"format": format}, content=body)
+    assert res.status_code == 400
+    assert res.json()["detail"].startswith(f"Invalid task at record {record}:")
+
+    res = authorized_client.get("/tasks")
+    assert res.json() == []
+
+
+@pytest.fixture(params=["memory", "database"])
+def version_store(request, monkeypatch):
+    store = versions.MemoryVersionStore() if request.param == "memory" else versions.DatabaseVersionStore()
+    monkeypatch.setattr(versions, "store", store)
+    return store
+
+
+def test_get_tasks_not_modified(authorized_client, test_tasks, version_store, statements):
+    res = authorized_client.get("/tasks/")
+    etag = res.headers["ETag"]
+
+    statements.clear()
+    res = authorized_client.get("/tasks/", headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.headers["ETag"] == etag
+    assert res.content == b""
+    # only the owners sharing with the caller, and their versions when kept in the database
+    assert len(statements) == 1
+    assert "task_shares" in statements[0] and "tasks" not in statements[0]
+
+
+def test_get_task_not_modified(authorized_client, test_tasks, version_store):
+    path = f"/tasks/{test_tasks[0].id}"
+    etag = authorized_client.get(path).headers["ETag"]
+    assert authorized_client.get(path, headers={"If-None-Match": f'W/{etag}, "other"'}).status_code == 304
+
+
+def test_etag_depends_on_query(authorized_client, test_tasks, version_store):
+    etag = authorized_client.get("/tasks/").headers["ETag"]
+    res = authorized_client.get("/tasks/", params={"limit": 2}, headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+
+
+@pytest.mark.parametrize("method, path, body", [
+    ("POST", "/tasks", {"title": "new title", "content": "new content"}),
+    ("PUT", "/tasks/{id}", {"title": "updated title", "content": "updated content"}),
+    ("PATCH", "/tasks/{id}", {"done": True}),
+    ("DELETE", "/tasks/{id}", None),
+    ("PATCH", "/tasks/bulk", {"ids": ["{id}"], "done": True}),
+])
+def test_mutations_change_etag(authorized_client, test_tasks, version_store, method, path, body):
+    id = test_tasks[0].id
+    etag = authorized_client.get("/tasks/").headers["ETag"]
+
+    if body is not None and "ids" in body:
+        body = {**body, "ids": [id]}
+    res = authorized_client.request(method, path.format(id=id), json=body)
+    assert res.status_code < 300
+
+    res = authorized_client.get("/tasks/", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert res.headers["ETag"] != etag
+
+
+def test_version_bump_commits_with_the_mutation(authorized_client, test_tasks, session, monkeypatch):
+    # the versions are written in the mutation's transaction, a failed bump leaves the task as it was
+    store = versions.DatabaseVersionStore()
+    monkeypatch.setattr(versions, "store", store)
+    etag = authorized_client.get("/tasks/").headers["ETag"]
+
+    def failing_bump(db, user_ids):
+        raise RuntimeError("versions unavailable")
+
+    monkeypatch.setattr(store, "bump", failing_bump)
+    with pytest.raises(RuntimeError):
+        authorized_client.put(f"/tasks/{test_tasks[0].id}", json={"title": "updated title", "content": "updated content"})
+    monkeypatch.undo()
+    monkeypatch.setattr(versions, "store", store)
+
+    session.expire_all()
+    assert session.get(models.Task, test_tasks[0].id).title == "first title"
+    assert authorized_client.get("/tasks/", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_memory_versions_move_on_commit(session, test_user):
+    store = versions.MemoryVersionStore()
+    versions.store, previous = store, versions.store
+    try:
+        versions.bump_owner(session, test_user['id'])
+        assert store.versions(session, test_user['id']) == [(test_user['id'], 0)]
+        session.rollback()
+        session.commit()
+        assert store.versions(session, test_user['id']) == [(test_user['id'], 0)]
+
+        versions.bump_owner(session, test_user['id'])
+        session.commit()
+        assert store.versions(session, test_user['id']) == [(test_user['id'], 1)]
+    finally:
+        versions.store = previous
+
+
+def test_owner_changes_reach_share_recipients(authorized_client, test_tasks, test_user2, test_user2_headers, version_store):
+    authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": True})
+    etag = authorized_client.get("/tasks/", headers=test_user2_headers).headers["ETag"]
+
+    new_id = authorized_client.post("/tasks", json={"title": "new title", "content": "new content"}).json()['id']
+    res = authorized_client.get("/tasks/", headers={**test_user2_headers, "If-None-Match": etag})
+    assert res.status_code == 200
+    etag = res.headers["ETag"]
+
+    authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": False})
+    res = authorized_client.get("/tasks/", headers={**test_user2_headers, "If-None-Match": etag})
+    assert res.status_code == 200
+    assert new_id not in [task['id'] for task in res.json()]
+
+
+def test_task_stats(authorized_client, test_tasks, statements):
+    authorized_client.get("/tasks")
+    statements.clear()
+    res = authorized_client.get("/tasks/stats")
+    assert res.status_code == 200
+    assert res.json() == {"total": 3, "done": 0, "open": 3, "shared": {"total": 0, "done": 0, "open": 0}}
+    assert len(statements) == 1
+
+
+def test_task_stats_follow_mutations(authorized_client, test_tasks, test_user2, test_user2_headers):
+    ids = [task.id for task in test_tasks[:3]]
+    authorized_client.post("/tasks", json={"title": "new title", "content": "new content", "done": True})
+    authorized_client.patch(f"/tasks/{ids[0]}", json={"done": True})
+    authorized_client.put(f"/tasks/{ids[0]}", json={"title": "updated title", "content": "updated content", "done": True})
+    authorized_client.delete(f"/tasks/{ids[1]}")
+    authorized_client.patch("/tasks/bulk", json={"ids": ids, "done": False})
+    authorized_client.post("/tasks/import", content=b'{"title": "imported", "content": "imported", "done": true}\n')
+    authorized_client.post("/tasks/share", json={"email": test_user2['email'], "share": True})
+
+    tasks = authorized_client.get("/tasks", params={"limit": 100}).json()
+    done = sum(task['done'] for task in tasks)
+    expected = {"total": len(tasks), "done": done, "open": len(tasks) - done}
+    assert authorized_client.get("/tasks/stats").json() == {**expected, "shared": {"total": 0, "done": 0, "open": 0}}
+    assert authorized_client.get("/tasks/stats", headers=test_user2_headers).json() == {"total": 1, "done": 0, "open": 1, "shared": expected}
+
+
+def test_backfill_task_counters(authorized_client, test_tasks, test_user, session):
+    session.execute(update(models.TaskCounter).values(total=100, done=50))
+    session.commit()
+
+    assert crud.backfill_task_counters(session, test_user['id']) == 1
+    assert authorized_client.get("/tasks/stats").json()["total"] == 3
+    assert crud.backfill_task_counters(session) == 2
+
+
+@pytest.fixture
+def write_behind(session, monkeypatch):
+    # no background flushes, the tests flush by hand
+    queue = writebehind.ToggleQueue(flush_seconds=60, max_items=3)
+    queue.session_factory = sessionmaker(autoflush=False, bind=session.get_bind())
+    monkeypatch.setattr(writebehind, "queue", queue)
+    monkeypatch.setattr(settings, "task_status_write_behind", True)
+    return queue
+
+
+def task_statuses(session, tasks):
+    session.expire_all()
+    return [session.scalar(select(models.Task.done).where(models.Task.id == task.id)) for task in tasks]
+
+
+def test_write_behind_coalesces_toggles(authorized_client, test_tasks, write_behind, session, statements):
+    authorized_client.get("/tasks")
+    statements.clear()
+    for id, done in [(test_tasks[0].id, True), (test_tasks[1].id, True), (test_tasks[0].id, False), (test_tasks[0].id, True)]:
+        res = authorized_client.patch(f"/tasks/{id}", json={"done": done})
+        assert res.status_code == 202
+        assert res.json() == {"status": "task marked as done" if done else "task marked as undone"}
+    assert statements == []
+    assert len(write_behind) == 2
+
+    asyncio.run(write_behind.flush())
+    assert len(write_behind) == 0
+    assert [statement.split()[0] for statement in statements] == ["UPDATE"]
+    assert task_statuses(session, test_tasks) == [True, True, False, False]
+
+
+def test_write_behind_flushes_when_full(authorized_client, test_tasks, write_behind, session):
+    for task in test_tasks[:3]:
+        assert authorized_client.patch(f"/tasks/{task.id}", json={"done": True}).status_code == 202
+    assert len(write_behind) == 0
+    assert task_statuses(session, test_tasks[:3]) == [True, True, True]
+
+
+def test_write_behind_reads_see_queued_toggles(authorized_client, test_tasks, write_behind):
+    etag = authorized_client.get("/tasks/").headers["ETag"]
+    authorized_client.patch(f"/tasks/{test_tasks[0].id}", json={"done": True})
+
+    res = authorized_client.get("/tasks/", headers={"If-None-Match": etag})
+    assert res.status_code == 200
+    assert [task['done'] for task in res.json()] == [True, False, False]
+    assert authorized_client.get(f"/tasks/{test_tasks[0].id}").json()['done'] is True
+    assert authorized_client.get("/tasks/stats").json()['done'] == 1
+
+
+def test_write_behind_ignores_foreign_tasks(authorized_client, test_tasks, write_behind, session):
+    assert authorized_client.patch(f"/tasks/{test_tasks[3].id}", json={"done": True}).status_code == 202
+    assert authorized_client.patch("/tasks/8000000", json={"done": True}).status_code == 202
+
+    asyncio.run(write_behind.flush())
+    assert task_statuses(session, test_tasks[3:]) == [False]
+
+
+def test_write_behind_flushes_on_shutdown(authorized_client, test_tasks, write_behind, session):
+    with authorized_client:
+        authorized_client.patch(f"/tasks/{test_tasks[0].id}", json={"done": True})
+        assert len(write_behind) == 1
+    assert len(write_behind) == 0
+    assert task_statuses(session, test_tasks[:1]) == [True]
@@ -1,5 +1,6 @@
-from app import schemas
+from app import models, ratelimit, schemas, utils
 from jose import jwt
+from passlib.hash import bcrypt
 from app.config import settings
 from app.oauth2 import ALGORITHM
 import pytest
@@ -34,3 +35,61 @@ def test_login_user(client, test_user):
 def test_incorrect_login(test_user, client, username, password, status_code):
     res = client.post("/login/", data={"username": username, "password": password})
     assert res.status_code == status_code
+
+
+def test_login_rehashes_outdated_password(client, session):
+    session.add(models.User(username="legacy", email="legacy@test.com", password=bcrypt.using(rounds=5).hash("test")))
+    session.commit()
+    res = client.post("/login", data={"username": "legacy", "password": "test"})
+    assert res.status_code == 200
+    session.expire_all()
+    user = session.query(models.User).filter(models.User.username == "legacy").first()
+    assert user.password.startswith(f"$2b${utils.settings.bcrypt_rounds:02d}$")
+    assert utils.verify("test", user.password)
+
+
+def test_login_when_hashing_pool_is_full(client, test_user, monkeypatch):
+    monkeypatch.setattr(utils.hashing_pool, "max_pending", 0)
+    res = client.post("/login", data={"username": test_user['username'], "password": test_user['password']})
+    assert res.status_code == 503
+    assert int(res.headers["Retry-After"]) >= 1
+
+
+def test_login_rate_limited_per_username(client, test_user, test_user2, monkeypatch):
+    monkeypatch.setattr(settings, "rate_limit_username_burst", 2)
+    for _ in range(2):
+        res = client.post("/login", data={"username": test_user['username'], "password": "wrong"})
+        assert res.status_code == 403
+
+    verified = utils.hashing_pool.stats()["timings"]["verify_and_update"]["count"]
+    res = client.post("/login", data={"username": test_user['username'].upper(), "password": test_user['password']})
+    assert res.status_code == 429
+    assert int(res.headers["Retry-After"]) >= 1
+    assert utils.hashing_pool.stats()["timings"]["verify_and_update"]["count"] == verified
+
+    # other usernames still have tokens
+    res = client.post("/login", data={"username": test_user2['username'], "password": test_user2['password']})
+    assert res.status_code == 200
+
+
+def test_sign_up_rate_limited_per_ip(client, monkeypatch):
+    monkeypatch.setattr(settings, "rate_limit_ip_burst", 1)
+    res = client.post("/users", json={"email": "first@test.com", "username": "first", "password": "test"})
+    assert res.status_code == 201
+    res = client.post("/users", json={"email": "second@test.com", "username": "second", "password": "test"})
+    assert res.status_code == 429
+
+
+@pytest.mark.parametrize("store_class", [ratelimit.MemoryBucketStore, ratelimit.SQLiteBucketStore])
+def test_token_bucket_refills(store_class, tmp_path, monkeypatch):
+    store = store_class(str(tmp_path / "buckets.db")) if store_class is ratelimit.SQLiteBucketStore else store_class()
+    clock = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(ratelimit.time, "time", lambda: clock[0])
+
+    assert [store.take("key", 2, 60) for _ in range(3)] == [0, 0, 1]
+    clock[0] += 1
+    assert store.take("key", 2, 60) == 0
+    assert store.take("key", 2, 60) == 1
+    clock[0] += 30
+    assert store.take("key", 2, 60) == 0